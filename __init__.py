@@ -25,6 +25,7 @@ from Products.CPSCore.interfaces import ICPSSite
 
 # various registrations are done therein
 import widgets
+import patches
 
 registerDirectory('skins', globals())
 
@@ -0,0 +1,661 @@
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Batch workflow transitions, in the request or in the background.
+
+Transitions are triggered on chunks of documents, each chunk being
+committed on its own and retried on conflict errors.
+
+Large batches are run as jobs by a worker thread, that has its own ZODB
+connection. Jobs are stored in a BTree of the portal, together with their
+progress, which is committed along with each chunk. They therefore survive
+restarts: unfinished jobs are resumed by the first Zope process that
+handles a batch request or a status request afterwards, and then by its
+worker, that scans portals periodically.
+"""
+
+import os
+import errno
+import socket
+import logging
+import threading
+from time import time, sleep
+from random import randrange
+from Queue import Queue, Empty
+
+import transaction
+from persistent import Persistent
+from persistent.list import PersistentList
+from BTrees.OOBTree import OOBTree
+from ZODB.POSException import ConflictError
+from Acquisition import aq_base, aq_inner, aq_parent
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from Testing.makerequest import makerequest
+
+from Products.CMFCore.utils import getToolByName
+
+try:
+    from zope.app.component.hooks import setSite
+except ImportError:
+    setSite = None
+
+logger = logging.getLogger('CPSDashboards.batchjobs')
+
+# attribute of the portal holding jobs
+PERSISTENT_JOBS = '_cpsdashboards_batch_jobs'
+
+# jobs still running after that many seconds without progress are
+# considered abandoned (Zope process stopped), and get resumed
+STALE_DELAY = 600
+
+# minimal number of seconds between two scans of a portal for jobs to resume
+RESCAN_INTERVAL = 60
+
+# finished jobs are removed after that many seconds
+JOB_LIFETIME = 7 * 86400
+
+# how long the worker waits for a job to be committed by the request that
+# submitted it
+SUBMIT_TIMEOUT = 30
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+ERROR = 'error'
+
+def getDocumentTitle(portal, rpath):
+    """Return the title of the document at rpath, or rpath if it's gone."""
+    proxy = portal.unrestrictedTraverse(rpath, None)
+    if proxy is None:
+        return rpath
+    return proxy.Title()
+
+def triggerTransitionChunk(portal, transition, rpaths, kw, conflict_retries=3,
+                           conflict_backoff=0.1, before_commit=None):
+    """Trigger transition on a chunk of documents and commit.
+
+    The chunk is aborted and retried on conflict errors, waiting longer
+    each time. Other errors are logged, and the chunk is aborted and
+    started again without the faulty document. before_commit is called
+    with the outcomes right before committing, so that it can record them
+    in the same transaction.
+
+    Return the list of outcomes and the number of retries. Outcomes are
+    dicts with 'rpath', 'title' and 'status' keys. Status is 'done',
+    'retried' (done after conflict errors), or 'failed'.
+    """
+    wftool = getToolByName(portal, 'portal_workflow')
+    retries = 0
+    faulty = {}
+    while True:
+        outcomes = []
+        try:
+            error_rpath = None
+            for rpath in rpaths:
+                if rpath in faulty:
+                    outcomes.append({'rpath': rpath,
+                                     'title': getDocumentTitle(portal, rpath),
+                                     'status': 'failed',
+                                     })
+                    continue
+                try:
+                    proxy = portal.unrestrictedTraverse(rpath)
+                    wf = wftool.getWorkflowsFor(proxy)[0]
+                    if wf.isActionSupported(proxy, transition):
+                        wftool.doActionFor(proxy, transition, **kw)
+                        status = retries and 'retried' or 'done'
+                    else:
+                        status = 'failed'
+                    title = proxy.Title()
+                except ConflictError:
+                    raise
+                except Exception:
+                    logger.exception("Could not trigger %r on %s",
+                                     transition, rpath)
+                    error_rpath = rpath
+                    break
+                outcomes.append({'rpath': rpath,
+                                 'title': title,
+                                 'status': status,
+                                 })
+            if error_rpath is not None:
+                # changes on the previous documents are lost as well
+                transaction.abort()
+                faulty[error_rpath] = None
+                continue
+            if before_commit is not None:
+                before_commit(outcomes)
+            transaction.commit()
+            return outcomes, retries
+        except ConflictError:
+            transaction.abort()
+            if retries >= conflict_retries:
+                logger.warning("Giving up %r on %d documents after %d "
+                               "conflicts", transition, len(rpaths),
+                               retries + 1)
+                outcomes = [{'rpath': rpath,
+                             'title': getDocumentTitle(portal, rpath),
+                             'status': 'failed',
+                             } for rpath in rpaths]
+                if before_commit is not None:
+                    before_commit(outcomes)
+                    transaction.commit()
+                return outcomes, retries
+            delay = conflict_backoff * (2 ** retries)
+            retries += 1
+            logger.info("Conflict error on %r, retry %d in %ss",
+                        transition, retries, delay)
+            sleep(delay)
+
+
+def isDeadOwner(owner):
+    """Tell whether owner ('host:pid') is a process of this host that is gone.
+
+    >>> isDeadOwner('%s:%d' % (socket.gethostname(), os.getpid()))
+    False
+    >>> isDeadOwner('%s:%d' % (socket.gethostname(), 2 ** 30))
+    True
+    >>> isDeadOwner('elsewhere.example.com:%d' % (2 ** 30))
+    False
+    >>> isDeadOwner('')
+    False
+    """
+    try:
+        host, pid = owner.rsplit(':', 1)
+        pid = int(pid)
+    except ValueError:
+        return False
+    if host != socket.gethostname() or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+def getRequestInfo(request):
+    """Return what the worker needs to build URLs the way request does.
+
+    That's the server URL and the virtual hosting settings.
+
+    >>> class FakeRequest(dict):
+    ...     _script = ['site']
+    >>> info = getRequestInfo(FakeRequest(
+    ...     SERVER_URL='https://example.com',
+    ...     VirtualRootPhysicalPath=('', 'cps')))
+    >>> info['SERVER_URL'], info['VirtualRootPhysicalPath'], info['script']
+    ('https://example.com', ('', 'cps'), ['site'])
+    """
+    return {'SERVER_URL': request.get('SERVER_URL', ''),
+            'VirtualRootPhysicalPath': request.get('VirtualRootPhysicalPath'),
+            'script': list(getattr(request, '_script', ())),
+            }
+
+def setupRequest(request, info):
+    """Have request build URLs like the one info was taken from.
+
+    See getRequestInfo().
+
+    >>> class FakeRequest(dict):
+    ...     def setServerURL(self, protocol, hostname, port):
+    ...         print 'server', protocol, hostname, port
+    ...     def setVirtualRoot(self, path):
+    ...         print 'root', path
+    >>> request = FakeRequest()
+    >>> setupRequest(request, {'SERVER_URL': 'https://example.com:8443',
+    ...                        'VirtualRootPhysicalPath': ('', 'cps'),
+    ...                        'script': ['site']})
+    server https example.com 8443
+    root ['site']
+    >>> request['VirtualRootPhysicalPath']
+    ('', 'cps')
+    >>> setupRequest(request, {'SERVER_URL': 'http://example.com'})
+    server http example.com None
+    """
+    server_url = info.get('SERVER_URL')
+    if server_url:
+        protocol, host = server_url.split('://', 1)
+        port = None
+        if ':' in host:
+            host, port = host.split(':', 1)
+        request.setServerURL(protocol, host, port)
+    vrpp = info.get('VirtualRootPhysicalPath')
+    if vrpp is not None:
+        request['VirtualRootPhysicalPath'] = vrpp
+    script = info.get('script')
+    if script:
+        request.setVirtualRoot(script)
+
+def findUser(context, user_id):
+    """Return the user with user_id, wrapped in its user folder, or None.
+
+    User folders are looked up from context to the root. In each of them,
+    the user is looked up by id, then by login.
+
+    >>> from Acquisition import Implicit
+    >>> class FakeUser(Implicit):
+    ...     pass
+    >>> class FakeUserFolder(Implicit):
+    ...     def __init__(self, users):
+    ...         self.users = users
+    ...     def getUserById(self, user_id):
+    ...         return None
+    ...     def getUser(self, name):
+    ...         return self.users.get(name)
+    >>> class Folder(Implicit):
+    ...     pass
+    >>> root = Folder()
+    >>> root.acl_users = FakeUserFolder({'admin': FakeUser()})
+    >>> root.portal = Folder()
+    >>> root.portal.acl_users = FakeUserFolder({'joe': FakeUser()})
+    >>> user = findUser(root.portal, 'joe')
+    >>> aq_base(aq_parent(user)) is aq_base(root.portal.acl_users)
+    True
+    >>> user = findUser(root.portal, 'admin')
+    >>> aq_base(aq_parent(user)) is aq_base(root.acl_users)
+    True
+    >>> findUser(root.portal, 'nobody') is None
+    True
+    """
+    container = context
+    while container is not None:
+        if getattr(aq_base(container), 'acl_users', None) is not None:
+            aclu = container.acl_users
+            user = aclu.getUserById(user_id)
+            if user is None:
+                user = aclu.getUser(user_id)
+            if user is not None:
+                return user.__of__(aclu)
+        container = aq_parent(aq_inner(container))
+    return None
+
+
+class BatchJob(Persistent):
+    """A batch transition to be performed in the background.
+
+    Only outcomes other than 'done' are kept, with counts for all.
+
+    >>> job = BatchJob('the_job', 'joe', 'publish', ['ws/a', 'ws/b', 'ws/c'],
+    ...                {'comment': 'Go'}, chunk_size=2)
+    >>> job.getNextChunk()
+    ['ws/a', 'ws/b']
+    >>> job.recordOutcomes([{'rpath': 'ws/a', 'title': 'A', 'status': 'done'},
+    ...                     {'rpath': 'ws/b', 'title': 'B',
+    ...                      'status': 'failed'}])
+    >>> job.getNextChunk()
+    ['ws/c']
+    >>> job.recordOutcomes([{'rpath': 'ws/c', 'title': 'C',
+    ...                      'status': 'retried'}])
+    >>> job.getNextChunk()
+    []
+    >>> from pprint import pprint
+    >>> status = job.getStatus()
+    >>> del status['created'], status['modified']
+    >>> pprint(status)
+    {'counts': {'done': 1, 'failed': 1, 'retried': 1},
+     'error': '',
+     'failed': ['B'],
+     'id': 'the_job',
+     'position': 3,
+     'status': 'queued',
+     'total': 3,
+     'transition': 'publish'}
+
+    A running job is abandoned if it's stale, or if its owner is a process
+    that is gone:
+
+    >>> job.status = RUNNING
+    >>> job.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+    >>> job.isAbandoned()
+    False
+    >>> job.isAbandoned(now=job.modified + STALE_DELAY + 1)
+    True
+    >>> job.owner = '%s:%d' % (socket.gethostname(), 2 ** 30)
+    >>> job.isAbandoned()
+    True
+    """
+
+    status = QUEUED
+    owner = ''
+    error = ''
+    conflict_retries = 3
+    conflict_backoff = 0.1
+    request_info = {}
+
+    def __init__(self, job_id, user_id, transition, rpaths, kw,
+                 chunk_size=20, conflict_retries=3, conflict_backoff=0.1,
+                 request_info=None):
+        self.id = job_id
+        self.user_id = user_id
+        # see getRequestInfo()
+        self.request_info = request_info or {}
+        self.transition = transition
+        # a separate record, so that progress commits don't rewrite it
+        self.rpaths = PersistentList(rpaths)
+        self.kw = kw
+        self.chunk_size = max(1, chunk_size)
+        self.conflict_retries = conflict_retries
+        self.conflict_backoff = conflict_backoff
+        self.position = 0
+        self.counts = {'done': 0, 'retried': 0, 'failed': 0}
+        self.outcomes = []
+        self.created = self.modified = time()
+
+    def getNextChunk(self):
+        """Return the rpaths of the next chunk to process."""
+        return list(self.rpaths[self.position:
+                                self.position + self.chunk_size])
+
+    def recordOutcomes(self, outcomes):
+        """Record the outcomes of the chunk, and move on to the next one."""
+        counts = self.counts.copy()
+        kept = []
+        for outcome in outcomes:
+            counts[outcome['status']] += 1
+            if outcome['status'] != 'done':
+                kept.append(outcome)
+        self.counts = counts
+        if kept:
+            self.outcomes = self.outcomes + kept
+        self.position += len(outcomes)
+        self.modified = time()
+
+    def isStale(self, now=None):
+        """Tell whether the job is running without any recent progress."""
+        if now is None:
+            now = time()
+        return self.status == RUNNING and now - self.modified > STALE_DELAY
+
+    def isAbandoned(self, now=None):
+        """Tell whether the job is running, but not by its owner anymore.
+
+        That's the case if it's stale, or if its owner is a process of this
+        host that is gone (restart within STALE_DELAY).
+        """
+        if self.status != RUNNING:
+            return False
+        return self.isStale(now=now) or isDeadOwner(self.owner)
+
+    def getStatus(self):
+        """Return a mapping describing the job and its progress."""
+        return {'id': self.id,
+                'transition': self.transition,
+                'status': self.status,
+                'error': self.error,
+                'total': len(self.rpaths),
+                'position': self.position,
+                'counts': self.counts.copy(),
+                'failed': [o['title'] for o in self.outcomes
+                           if o['status'] == 'failed'],
+                'created': self.created,
+                'modified': self.modified,
+                }
+
+
+def getJobs(portal, create=False):
+    """Return the BTree of jobs of the portal, or None."""
+    jobs = getattr(aq_base(portal), PERSISTENT_JOBS, None)
+    if jobs is None and create:
+        jobs = OOBTree()
+        setattr(portal, PERSISTENT_JOBS, jobs)
+    return jobs
+
+def getJob(portal, job_id):
+    """Return the job or None."""
+    jobs = getJobs(portal)
+    if jobs is None:
+        return None
+    return jobs.get(job_id)
+
+def purgeJobs(jobs, now=None):
+    """Remove finished jobs that are older than JOB_LIFETIME."""
+    if now is None:
+        now = time()
+    for job_id, job in list(jobs.items()):
+        if job.status in (FINISHED, ERROR) and (
+            now - job.modified > JOB_LIFETIME):
+            del jobs[job_id]
+
+
+class JobRunner(object):
+    """Process jobs one at a time, in a worker thread.
+
+    The thread is started on demand. Jobs are identified by the database,
+    the physical path of the portal and their id, so that the thread can
+    open its own connection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._thread = None
+        self._portals = {} # portal path -> (database, time of last scan)
+        self.owner = '%s:%s' % (socket.gethostname(), os.getpid())
+
+    def submit(self, portal, user_id, transition, rpaths, kw, chunk_size=20,
+               conflict_retries=3, conflict_backoff=0.1, request_info=None):
+        """Create a job and schedule it. Return its id.
+
+        The job is processed once the current transaction is committed.
+        request_info is used to build URLs in the worker, as the
+        submitting request would (see getRequestInfo()).
+        """
+        jobs = getJobs(portal, create=True)
+        purgeJobs(jobs)
+        job_id = '%d-%06d' % (int(time() * 1000), randrange(1000000))
+        jobs[job_id] = BatchJob(job_id, user_id, transition, rpaths, kw,
+                                chunk_size=chunk_size,
+                                conflict_retries=conflict_retries,
+                                conflict_backoff=conflict_backoff,
+                                request_info=request_info)
+        self.schedule(portal, job_id)
+        return job_id
+
+    def schedule(self, portal, job_id):
+        """Queue the job for processing."""
+        self._start()
+        self._queue.put((portal._p_jar.db(),
+                         '/'.join(portal.getPhysicalPath()), job_id))
+
+    def resume(self, portal):
+        """Schedule unfinished jobs of the portal.
+
+        Jobs that are running in another process are left alone, unless
+        they're abandoned. The portal is scanned at most once per
+        RESCAN_INTERVAL, and is then rescanned by the worker.
+        """
+        path = '/'.join(portal.getPhysicalPath())
+        now = time()
+        self._lock.acquire()
+        try:
+            last_scan = self._portals.get(path, (None, 0))[1]
+            if now - last_scan < RESCAN_INTERVAL:
+                return
+            self._portals[path] = (portal._p_jar.db(), now)
+        finally:
+            self._lock.release()
+        self._start()
+        jobs = getJobs(portal)
+        if jobs is None:
+            return
+        for job_id, job in jobs.items():
+            if job.status == QUEUED or job.isAbandoned():
+                logger.info("Resuming batch job %s", job_id)
+                self.schedule(portal, job_id)
+
+    def _rescan(self):
+        """Resume jobs of the portals known to the runner, if due."""
+        self._lock.acquire()
+        try:
+            portals = self._portals.items()
+        finally:
+            self._lock.release()
+        now = time()
+        for path, (db, last_scan) in portals:
+            if now - last_scan < RESCAN_INTERVAL:
+                continue
+            conn = db.open()
+            try:
+                try:
+                    app = conn.root()['Application']
+                    self.resume(app.unrestrictedTraverse(path))
+                except Exception:
+                    logger.exception("Couldn't scan %s for batch jobs", path)
+            finally:
+                transaction.abort()
+                conn.close()
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            if self._thread is not None and self._thread.isAlive():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='CPSDashboards batch jobs')
+            self._thread.setDaemon(True)
+            self._thread.start()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            try:
+                db, portal_path, job_id = self._queue.get(
+                    timeout=RESCAN_INTERVAL)
+            except Empty:
+                job_id = None
+            if job_id is not None:
+                try:
+                    self.process(db, portal_path, job_id)
+                except:
+                    logger.exception("Batch job %s failed", job_id)
+            try:
+                self._rescan()
+            except:
+                logger.exception("Scan for batch jobs failed")
+
+    def _claim(self, conn, portal_path, job_id):
+        """Return (portal, job) once the job is marked as ours, or None."""
+        deadline = time() + SUBMIT_TIMEOUT
+        while True:
+            app = makerequest(conn.root()['Application'])
+            portal = app.unrestrictedTraverse(portal_path)
+            job = getJob(portal, job_id)
+            if job is not None:
+                break
+            # not committed yet by the submitting request
+            transaction.abort()
+            if time() > deadline:
+                logger.warning("Batch job %s not found", job_id)
+                return None
+            sleep(1)
+            conn.sync()
+        setupRequest(app.REQUEST, job.request_info)
+
+        if job.status == QUEUED or job.isAbandoned():
+            job.status = RUNNING
+            job.owner = self.owner
+            job.modified = time()
+            try:
+                transaction.commit()
+            except ConflictError:
+                # another process took it
+                transaction.abort()
+                return None
+            return portal, job
+        return None
+
+    def process(self, db, portal_path, job_id):
+        """Process the job, with a connection of its own."""
+        conn = db.open()
+        try:
+            claimed = self._claim(conn, portal_path, job_id)
+            if claimed is None:
+                return
+            portal, job = claimed
+            try:
+                user = findUser(portal, job.user_id)
+            except Exception, e:
+                logger.exception("Couldn't look up user %s for batch job %s",
+                                 job.user_id, job_id)
+                self._commitStatus(job, ERROR, error='Lookup of user %s '
+                                   'failed: %s' % (job.user_id, e))
+                return
+            if user is None:
+                logger.error("Unknown user %s for batch job %s",
+                             job.user_id, job_id)
+                self._commitStatus(job, ERROR,
+                                   error='Unknown user %s' % job.user_id)
+                return
+            if setSite is not None:
+                setSite(portal)
+            newSecurityManager(None, user)
+
+            logger.info("Starting batch job %s (%r on %d documents)",
+                        job_id, job.transition, len(job.rpaths))
+            start = time()
+            try:
+                while True:
+                    chunk = job.getNextChunk()
+                    if not chunk:
+                        break
+                    triggerTransitionChunk(
+                        portal, job.transition, chunk, job.kw,
+                        conflict_retries=job.conflict_retries,
+                        conflict_backoff=job.conflict_backoff,
+                        before_commit=job.recordOutcomes)
+            except Exception, e:
+                # conflict errors included: the chunk has been retried
+                # already, or it's the commit of a given up chunk
+                transaction.abort()
+                logger.exception("Batch job %s failed", job_id)
+                self._commitStatus(job, ERROR, error='%s: %s' % (
+                    e.__class__.__name__, e))
+                return
+            if not self._commitStatus(job, FINISHED):
+                return
+            logger.info("Batch job %s done in %.1fs: %r", job_id,
+                        time() - start, job.counts)
+        finally:
+            noSecurityManager()
+            if setSite is not None:
+                setSite(None)
+            transaction.abort()
+            conn.close()
+
+    def _commitStatus(self, job, status, error=''):
+        """Set the status of the job and commit, retrying on conflicts.
+
+        Return whether the commit succeeded.
+        """
+        for i in range(job.conflict_retries + 1):
+            job.status = status
+            job.error = error
+            job.modified = time()
+            try:
+                transaction.commit()
+                return True
+            except ConflictError:
+                transaction.abort()
+                sleep(job.conflict_backoff * (2 ** i))
+        logger.error("Couldn't set batch job %s to %r", job.id, status)
+        return False
+
+# process wide instance, fed by the batch perform view
+JOB_RUNNER = JobRunner()
@@ -22,11 +22,14 @@ logger = logging.getLogger('CPSDashboards.braindatamodel')
 
 from zope.interface import implements
 
+from Acquisition import aq_parent
+from Missing import MV
 from OFS.Image import File
 
 from Products.CMFCore.utils import getToolByName
 
 from Products.CPSCore.interfaces import ICPSProxy
+from Products.CPSDashboards.cache import fingerprint
 from Products.CPSSchemas.DataModel import DataModel
 
 class FakeDataModel(dict):
@@ -108,10 +111,30 @@ class BrainDataModel(DataModel):
     Adapters have been saved for the widgets that want to take a look at them:
     >>> dm._adapters
     ['the', 'fake', 'adapter']
+
+    Keys that caused such a fallback are recorded, so that tabular widgets
+    can report about them:
+    >>> dm.getFallbackKeys()
+    ['foo']
+    >>> dm.isObjectLoaded()
+    True
+
+    In strict mode, looking up the object is forbidden. Missing metadata
+    get a default value if one is provided, otherwise it's a configuration
+    error:
+    >>> dm = BrainDataModel(d, strict=True, defaults={'bar': ''})
+    >>> dm['spam'], dm['bar']
+    ('eggs', '')
+    >>> dm['foo']
+    Traceback (most recent call last):
+    ...
+    ValueError: 'foo' is not a catalog metadata (brain only mode)
+    >>> dm.isObjectLoaded()
+    False
     """
 
 
-    def __init__(self, brain, context=None):
+    def __init__(self, brain, context=None, strict=False, defaults=None):
         self._brain = brain
         if context is None:
             self._context = self._brain
@@ -126,6 +149,9 @@ class BrainDataModel(DataModel):
         self._brain_obj = _lazy
         self._object = _lazy
         self._proxy = _lazy
+        self._fallback_keys = []
+        self._strict = strict
+        self._defaults = defaults or {}
 
     def getObject(self):
         """ Return the object as if self was a regular datamodel. """
@@ -165,6 +191,110 @@ class BrainDataModel(DataModel):
         self._brain_obj = obj
         return obj
 
+    def isObjectLoaded(self):
+        """Tell whether the object has been fetched from the ZODB."""
+        return self._brain_obj is not _lazy and self._brain_obj is not None
+
+    def getFallbackKeys(self):
+        """Return keys that were looked up in the object's datamodel."""
+        return self._fallback_keys
+
+    def recordFallbackKey(self, key):
+        """Record that key required to fetch the object.
+
+        This is for widgets that fetch the object by themselves.
+        """
+        self._fallback_keys.append(key)
+
+    def getBrainMetadata(self, key, default=None):
+        """Return the catalog metadata for key, without any fallback.
+
+        Missing values are considered absent:
+
+        >>> from Missing import MV
+        >>> dm = BrainDataModel(FakeBrain({'review_state': 'work',
+        ...                                'Subject': MV}))
+        >>> dm.getBrainMetadata('review_state')
+        'work'
+        >>> dm.getBrainMetadata('Subject', 'none')
+        'none'
+        >>> dm.getBrainMetadata('Creator', 'none')
+        'none'
+        """
+        value = getattr(self._brain, key, MV)
+        if value is MV:
+            return default
+        return value
+
+    def getAllowedRolesAndUsers(self):
+        """Return the allowedRolesAndUsers of the brain as a tuple or None.
+
+        The metadata column is used if there's one, otherwise the value is
+        read from the catalog index. None means that it couldn't be found.
+
+        >>> BrainDataModel(FakeBrain({'allowedRolesAndUsers':
+        ...                           ['Manager', 'user:joe']})
+        ...               ).getAllowedRolesAndUsers()
+        ('Manager', 'user:joe')
+        >>> BrainDataModel(FakeBrain({})).getAllowedRolesAndUsers() is None
+        True
+        """
+        brain = self._brain
+        value = getattr(brain, 'allowedRolesAndUsers', MV)
+        if value is MV:
+            catalog = getattr(aq_parent(brain), '_catalog', None)
+            getRID = getattr(brain, 'getRID', None)
+            if catalog is None or getRID is None:
+                return None
+            try:
+                index = catalog.getIndex('allowedRolesAndUsers')
+            except KeyError:
+                return None
+            value = index.getEntryForObject(getRID(), None)
+            if value is None:
+                return None
+        return tuple(value)
+
+    def getBrainStamp(self):
+        """Return (path, fingerprint of the metadata) for the brain or None.
+
+        This is used to key caches of things computed out of the brain. The
+        whole metadata record is taken into account, because workflow
+        transitions change the review state but not the modification
+        date, and so are the roles and users allowed to view the
+        document, that change along with local roles. No stamp can be
+        provided for brains that aren't catalog records.
+
+        >>> brain = FakeBrain({'modified': '2012/01/21',
+        ...                    'review_state': 'work',
+        ...                    'allowedRolesAndUsers': ['Manager']})
+        >>> brain.__record_schema__ = {'modified': 0, 'review_state': 1}
+        >>> brain.getPath = lambda: '/portal/doc'
+        >>> dm = BrainDataModel(brain)
+        >>> stamp = dm.getBrainStamp()
+        >>> stamp[0]
+        '/portal/doc'
+        >>> brain.review_state = 'published'
+        >>> BrainDataModel(brain).getBrainStamp() == stamp
+        False
+        >>> stamp = BrainDataModel(brain).getBrainStamp()
+        >>> brain.allowedRolesAndUsers = ['Manager', 'user:joe']
+        >>> BrainDataModel(brain).getBrainStamp() == stamp
+        False
+        >>> BrainDataModel(FakeBrain({})).getBrainStamp() is None
+        True
+        """
+        brain = self._brain
+        schema = getattr(brain, '__record_schema__', None)
+        getPath = getattr(brain, 'getPath', None)
+        if schema is None or getPath is None:
+            return None
+        names = [(index, name) for name, index in schema.items()]
+        names.sort()
+        values = [repr(getattr(brain, name, None)) for index, name in names]
+        values.append(repr(self.getAllowedRolesAndUsers()))
+        return (getPath(), fingerprint(*values))
+
     def get(self, key, default=_missing):
         """Examples with callables:
 
@@ -216,8 +346,14 @@ class BrainDataModel(DataModel):
                 rpath = self.__getitem__('rpath')
                 # we are now sure that self.utool has been set
                 value = self.utool.getUrlFromRpath(rpath)
+            elif key in self._defaults:
+                value = self._defaults[key]
+            elif self._strict:
+                raise ValueError(
+                    "%r is not a catalog metadata (brain only mode)" % key)
             else:
                 logger.debug('Fetching field %s from ZODB', key)
+                self._fallback_keys.append(key)
                 # fallback on object's datamodel
                 dm = getattr(self, '_obj_dm', None)
                 if dm is None:
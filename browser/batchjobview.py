@@ -0,0 +1,65 @@
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+from zExceptions import NotFound
+from AccessControl import Unauthorized
+
+from Products.Five.browser import BrowserView
+from Products.CMFCore.utils import getToolByName
+from Products.CMFCore.utils import _checkPermission
+from Products.CMFCore.permissions import ManagePortal
+from Products.CPSUtil import minjson as json
+
+from Products.CPSDashboards.batchjobs import JOB_RUNNER, getJob
+
+class BatchJobStatusView(BrowserView):
+    """Progress of background batch jobs, polled by the batch perform page.
+
+    Only the user that submitted the job and managers can see it.
+    """
+
+    def getStatus(self, job_id=None):
+        """Return the status mapping of the job (see BatchJob.getStatus)."""
+        if job_id is None:
+            job_id = self.request.form.get('job_id')
+        portal = getToolByName(self.context, 'portal_url').getPortalObject()
+        # jobs left unfinished by a restart
+        JOB_RUNNER.resume(portal)
+        job = getJob(portal, job_id)
+        if job is None:
+            raise NotFound(job_id)
+        mtool = getToolByName(self.context, 'portal_membership')
+        user_id = mtool.getAuthenticatedMember().getId()
+        if user_id != job.user_id and not _checkPermission(ManagePortal,
+                                                           portal):
+            raise Unauthorized(job_id)
+        return job.getStatus()
+
+    def renderJson(self):
+        """Return the status of the job asked in the request, as JSON."""
+        status = self.getStatus()
+        failed = []
+        for title in status['failed']:
+            if isinstance(title, str):
+                title = title.decode('iso-8859-15')
+            failed.append(title)
+        status['failed'] = failed
+        response = self.request.RESPONSE
+        response.setHeader('Content-Type', 'application/json')
+        response.setHeader('Cache-Control', 'no-cache')
+        return json.write(status)
@@ -17,23 +17,84 @@
 #
 # $Id$
 
-import transaction
-
+from time import time
 from urllib import urlencode
 from logging import getLogger, DEBUG
 
-from Acquisition import aq_inner, aq_parent
+from Acquisition import aq_base, aq_inner, aq_parent
 from OFS.CopySupport import CopyError
 from Products.CMFCore.utils import getToolByName
 from Products.CMFCore.WorkflowCore import WorkflowException
+from Products.DCWorkflow.Transitions import TRIGGER_USER_ACTION
 from Products.CPSCore.EventServiceTool import getPublicEventService
 from Products.CPSUtil.session import sessionHasKey
 from Products.CPSUtil.timer import Timer
 
+from Products.CPSDashboards.batchjobs import JOB_RUNNER, getRequestInfo
+from Products.CPSDashboards.batchjobs import triggerTransitionChunk
+from Products.CPSDashboards.widgets.foldercontents import VIEW_LANGUAGE
+
 from searchview import SearchView
 
 logger = getLogger('CPSDashboards.browser.batchperformview')
 
+def getContainerRpath(rpath):
+    """Return the rpath of the container of rpath, '' for the portal.
+
+    >>> getContainerRpath('workspaces/folder/doc')
+    'workspaces/folder'
+    >>> getContainerRpath('workspaces')
+    ''
+    """
+    if '/' not in rpath:
+        return ''
+    return rpath.rsplit('/', 1)[0]
+
+def isTransitionPossible(wf, state, action):
+    """Tell whether action can be triggered by users in wf from state.
+
+    This doesn't depend on the document, unlike transition guards. None is
+    returned if it can't be decided this way (unknown state, workflow
+    that isn't based on states and transitions or whose state variable
+    isn't the review state).
+
+    >>> from Products.DCWorkflow.Transitions import TRIGGER_AUTOMATIC
+    >>> class FakeDef:
+    ...     def __init__(self, **kw):
+    ...         self.__dict__.update(kw)
+    >>> class FakeContainer(dict):
+    ...     pass
+    >>> wf = FakeDef(state_var='review_state',
+    ...              states=FakeContainer(
+    ...                  work=FakeDef(transitions=('submit', 'auto')),
+    ...                  pending=FakeDef(transitions=('accept',))),
+    ...              transitions=FakeContainer(
+    ...                  submit=FakeDef(trigger_type=TRIGGER_USER_ACTION),
+    ...                  accept=FakeDef(trigger_type=TRIGGER_USER_ACTION),
+    ...                  auto=FakeDef(trigger_type=TRIGGER_AUTOMATIC)))
+    >>> isTransitionPossible(wf, 'work', 'submit')
+    True
+    >>> isTransitionPossible(wf, 'pending', 'submit')
+    False
+    >>> isTransitionPossible(wf, 'work', 'auto')
+    False
+    >>> isTransitionPossible(wf, 'unknown', 'submit') is None
+    True
+    """
+    base = aq_base(wf)
+    states = getattr(base, 'states', None)
+    transitions = getattr(base, 'transitions', None)
+    if (states is None or transitions is None
+        or getattr(base, 'state_var', None) != 'review_state'):
+        return None
+    sdef = states.get(state)
+    if sdef is None:
+        return None
+    if action not in sdef.transitions:
+        return False
+    tdef = transitions.get(action)
+    return tdef is not None and tdef.trigger_type == TRIGGER_USER_ACTION
+
 
 class BatchPerformView(SearchView):
     """A generic view class to perform batch actions on documents.
@@ -54,6 +115,10 @@ class BatchPerformView(SearchView):
        - non_wf_actions: you can register hear your handlers.
        - submit_button_prefix: the action to be done is deduced from the
        submit button's name, with this prefix cut out.
+       - commit_chunk_size, conflict_retries, conflict_backoff: how batch
+       transitions are committed and retried on conflict errors.
+       - background_threshold: number of documents above which batch
+       transitions are run in the background (see batchjobs.py).
 
     Subclasses can be hooked as browser pages either
        - by using a different page name that the default one in CPSDashboards
@@ -72,9 +137,15 @@ class BatchPerformView(SearchView):
                       'paste': '_doCutCopyPaste'}
     submit_button_prefix = "cpsdashboards_batch_"
     session_key = "CPSDASHBOARDS_BATCH_PERFORM"
+    commit_chunk_size = 20 # documents per commit in batch transitions
+    conflict_retries = 3 # retries of a chunk on conflict errors
+    conflict_backoff = 0.1 # seconds before first retry, doubled afterwards
+    background_threshold = 200 # bigger batches are run as jobs, 0 for never
 
     action = None # id of the action to be performed
     rpaths = () # rpaths of documents as target of the action
+    report = () # outcomes of the last batch transition
+    job_id = None # id of the background job, if any
 
     #
     # Helpers to maintain current session
@@ -109,16 +180,89 @@ class BatchPerformView(SearchView):
         rpath = getToolByName(self.context, 'portal_url').getRpath(self.context)
         del request.SESSION[self.session_key][rpath]
 
+    def _getCatalogInfos(self, rpaths):
+        """Return a mapping from rpaths to (portal_type, review_state).
+
+        Catalog records are looked up by their unique ids, that are the
+        paths of documents, followed by the language for proxies. The
+        cost depends on the number of rpaths only, not on the size of
+        their containers. Rpaths that the catalog doesn't know of are not
+        in the mapping.
+        """
+        catalog = getToolByName(self.context, 'portal_catalog')
+        uids = catalog._catalog.uids
+        portal_path = getToolByName(self.context, 'portal_url').getPortalPath()
+
+        infos = {}
+        for rpath in rpaths:
+            path = '/'.join((portal_path, rpath))
+            rid = uids.get(path)
+            if rid is None:
+                # proxies are indexed once per language
+                prefix = path + VIEW_LANGUAGE
+                for rid in uids.values(prefix, prefix + '\xff'):
+                    break
+            if rid is None:
+                continue
+            metadata = catalog.getMetadataForRID(rid)
+            infos[rpath] = (metadata.get('portal_type'),
+                            metadata.get('review_state'))
+        return infos
+
     def _filterMatchingRpaths(self, action, rpaths):
-        """Helper method to filter out non p-matching rpaths"""
+        """Helper method to filter out non p-matching rpaths
+
+        Documents are grouped by container and portal type, thanks to a
+        catalog query, and workflows are resolved once per group. Whether
+        a workflow can have the transition from a given state is decided
+        once per (workflow, state) pair. Only the remaining documents are
+        traversed, to check transition guards.
+        """
         portal = getToolByName(self.context, 'portal_url').getPortalObject()
         wftool = getToolByName(self.context, 'portal_workflow')
-        filtered = []
+
+        unique = []
+        seen = {}
         for rpath in rpaths:
-            proxy = portal.unrestrictedTraverse(rpath)
-            for wf in wftool.getWorkflowsFor(proxy):
+            if rpath not in seen:
+                seen[rpath] = None
+                unique.append(rpath)
+        infos = self._getCatalogInfos(unique)
+
+        group_wfs = {} # (container rpath, portal_type) -> workflows
+        possible = {} # (workflow id, state) -> True, False or None
+        filtered = []
+        for rpath in unique:
+            info = infos.get(rpath)
+            proxy = None
+            if info is None:
+                proxy = portal.unrestrictedTraverse(rpath)
+                wfs = wftool.getWorkflowsFor(proxy)
+            else:
+                ptype, state = info
+                group = (getContainerRpath(rpath), ptype)
+                wfs = group_wfs.get(group)
+                if wfs is None:
+                    proxy = portal.unrestrictedTraverse(rpath)
+                    wfs = group_wfs[group] = wftool.getWorkflowsFor(proxy)
+                candidates = []
+                for wf in wfs:
+                    key = (wf.getId(), state)
+                    if key not in possible:
+                        possible[key] = isTransitionPossible(wf, state,
+                                                             action)
+                    if possible[key] is not False:
+                        candidates.append(wf)
+                wfs = candidates
+                if not wfs:
+                    continue
+
+            if proxy is None:
+                proxy = portal.unrestrictedTraverse(rpath)
+            for wf in wfs:
                 if wf.isActionSupported(proxy, action):
                     filtered.append(rpath)
+                    break
         return filtered
 
     def _getSessionData(self):
@@ -274,17 +418,40 @@ class BatchPerformView(SearchView):
             })
         return infos
 
+    def _triggerChunk(self, transition, rpaths, kw):
+        """Trigger transition on a chunk of documents and commit.
+
+        See batchjobs.triggerTransitionChunk().
+        """
+        portal = getToolByName(self.context, 'portal_url').getPortalObject()
+        return triggerTransitionChunk(portal, transition, rpaths, kw,
+                                      conflict_retries=self.conflict_retries,
+                                      conflict_backoff=self.conflict_backoff)
+
+    def getReport(self):
+        """Return the outcomes of the last batch transition.
+
+        This is a list of dicts with 'rpath', 'title' and 'status' keys.
+        Status is 'done', 'retried' (done after conflict errors), or 'failed'.
+        """
+        return self.report
+
     def batchTriggerTransition(self, transition, kwargs=None):
         """Do the WF update when possible and return the result as psm
 
         Optional kwargs dict is passed to the transition.
+
+        Documents are processed and committed by chunks of
+        commit_chunk_size (see _triggerChunk).
+
+        Batches of more than background_threshold documents are handed
+        over to the job runner instead, and 'job_queued' is returned for
+        the template to poll the job status.
         """
 
         t = Timer('CPSDashboards.browser.batchperformview.batchTriggerTransition',
                   level=DEBUG)
 
-        wftool = getToolByName(self.context, 'portal_workflow')
-        portal = getToolByName(self.context, 'portal_url').getPortalObject()
         form = self.request.form
 
         kw = {
@@ -295,28 +462,47 @@ class BatchPerformView(SearchView):
 
         t.mark('Process form data')
 
-        failed = set()
-        proxies = [portal.unrestrictedTraverse(rpath) for rpath in self.rpaths]
-
-        t.mark('Grab proxies')
-
-        for i, proxy in enumerate(proxies):
-            wf = wftool.getWorkflowsFor(proxy)[0]
-
-            if wf.isActionSupported(proxy, transition):
-                wftool.doActionFor(proxy, transition, **kw)
-
-                t.mark("Do action '%s' for proxy %d" % (transition, i))
-
-                # each proxy is independant, thus commit to avoid conflict
-                # errors on portal_proxies between two batch performers
-                transaction.commit()
-
-                t.mark('Commit for proxy %d' % i)
-
-            else:
-                failed.add(proxy)
-
+        if self.background_threshold and (
+            len(self.rpaths) > self.background_threshold):
+            portal = getToolByName(self.context,
+                                   'portal_url').getPortalObject()
+            mtool = getToolByName(self.context, 'portal_membership')
+            user_id = mtool.getAuthenticatedMember().getId()
+            JOB_RUNNER.resume(portal)
+            self.job_id = JOB_RUNNER.submit(
+                portal, user_id, transition, self.rpaths, kw,
+                chunk_size=self.commit_chunk_size,
+                conflict_retries=self.conflict_retries,
+                conflict_backoff=self.conflict_backoff,
+                request_info=getRequestInfo(self.request))
+            self._expireSession()
+            t.mark('Submit job %s' % self.job_id)
+            t.log()
+            return 'job_queued'
+
+        self.report = []
+        rpaths = list(self.rpaths)
+        size = max(1, self.commit_chunk_size)
+        nb_conflicts = 0
+        start = time()
+        for i, c_start in enumerate(range(0, len(rpaths), size)):
+            outcomes, retries = self._triggerChunk(
+                transition, rpaths[c_start:c_start+size], kw)
+            self.report.extend(outcomes)
+            nb_conflicts += retries
+            t.mark("Chunk %d: %d documents, %d failed, %d conflicts" % (
+                i, len(outcomes),
+                len([o for o in outcomes if o['status'] == 'failed']),
+                retries))
+
+        failed = [o['title'] for o in self.report if o['status'] == 'failed']
+        elapsed = time() - start
+        if elapsed > 0:
+            throughput = len(rpaths) / elapsed
+        else:
+            throughput = 0.0
+        t.mark("Did '%s' on %d documents (%.1f/s), %d failed, %d conflicts" % (
+            transition, len(rpaths), throughput, len(failed), nb_conflicts))
 
         # this is the end of the batch session
         self._expireSession()
@@ -331,7 +517,7 @@ class BatchPerformView(SearchView):
             # display time for psms
             psm = mcat("psm_no_action_performed_for")
             psm = psm.encode('iso-8859-15')
-            psm += ', '.join(proxy.Title() for proxy in failed)
+            psm += ', '.join(failed)
 
         t.mark('Compute psm')
         t.log()
@@ -0,0 +1,39 @@
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+
+from Products.Five.browser import BrowserView
+
+from Products.CPSDashboards.loadstats import LOAD_STATS
+
+class LoadStatisticsView(BrowserView):
+    """Display objects woken up by tabular widgets, for managers.
+
+    Figures are those of the Zope process that serves the request.
+    """
+
+    def dispatchSubmit(self):
+        """Reset statistics if asked to."""
+        if 'clear_submit' in self.request.form:
+            LOAD_STATS.clear()
+
+    def getStatistics(self):
+        """Return statistics, adding average loads per rendering."""
+        stats = LOAD_STATS.getStatistics()
+        for entry in stats:
+            entry['loads_per_render'] = entry['zodb_loads'] / entry['renders']
+        return stats
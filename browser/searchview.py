@@ -25,7 +25,9 @@ from Products.CMFCore.utils import getToolByName
 
 from Products.CPSSchemas.Widget import widgetname
 from Products.CPSSchemas.BasicWidgets import renderHtmlTag
-from Products.CPSDashboards.utils import unserializeFromCookie
+from Products.CPSDashboards.utils import decodeCookie
+from Products.CPSDashboards.filterstate import FILTER_STATES
+from Products.CPSDashboards.filterstate import isFilterStateToken
 
 logger = logging.getLogger('CPSDashboards.browser.searchview')
 
@@ -104,9 +106,10 @@ class SearchView(BrowserView):
             cookie = self.request.cookies.get(cookie_id)
         else:
             cookie = None
-        if cookie is not None:
-            cookie = unserializeFromCookie(cookie,
-                                           charset=self.default_charset)
+        if cookie is not None and isFilterStateToken(cookie):
+            cookie = FILTER_STATES.lookup(self.context, cookie)
+        elif cookie is not None:
+            cookie = decodeCookie(cookie, charset=self.default_charset)
         for wid in widgets:
             name = widgetname(wid)
             if cookie is not None:
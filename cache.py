@@ -0,0 +1,256 @@
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Process wide caches used by CPSDashboards.
+
+These are RAM caches, hence local to a Zope process. They are meant to hold
+values that can be recomputed at any time (rendered rows, etc.) and must
+never be relied upon for correctness.
+"""
+
+import threading
+from time import time
+
+from Acquisition import aq_base
+from BTrees.Length import Length
+
+try:
+    from hashlib import md5
+except ImportError: # python < 2.5
+    from md5 import new as md5
+
+# indexes in linked list nodes
+PREV, NEXT, KEY, VALUE, SIZE, EXPIRES = range(6)
+
+# attribute of catalogs holding their generation counter
+CATALOG_GENERATION = '_cpsdashboards_generation'
+
+class LRUCache(object):
+    """A thread-safe mapping with LRU eviction.
+
+    Both the number of entries and their total size can be bounded. The size
+    of an entry is computed by the ``sizeof`` callable (defaults to ``len``).
+
+    >>> cache = LRUCache(max_entries=2)
+    >>> cache.set('a', 'A')
+    >>> cache.set('b', 'B')
+    >>> cache.get('a')
+    'A'
+    >>> cache.set('c', 'C')
+
+    'b' was the least recently used entry, therefore it's been evicted:
+
+    >>> cache.get('b') is None
+    True
+    >>> len(cache)
+    2
+
+    Now with a size cap:
+
+    >>> cache = LRUCache(max_entries=10, max_size=10)
+    >>> cache.set('a', 'x' * 6)
+    >>> cache.set('b', 'y' * 3)
+    >>> cache.size
+    9
+    >>> cache.set('c', 'z' * 4)
+    >>> cache.get('a') is None
+    True
+    >>> cache.size
+    7
+
+    Values too big to ever fit are simply not stored:
+
+    >>> cache.set('d', 'w' * 11)
+    >>> cache.get('d', 'missed')
+    'missed'
+
+    Statistics are maintained for monitoring purposes:
+
+    >>> from pprint import pprint
+    >>> pprint(cache.getStatistics())
+    {'entries': 2,
+     'evictions': 1,
+     'hits': 0,
+     'max_entries': 10,
+     'max_size': 10,
+     'misses': 2,
+     'size': 7}
+    >>> cache.clear()
+    >>> len(cache)
+    0
+
+    Entries can also expire after ``ttl`` seconds:
+
+    >>> cache = LRUCache(max_entries=10, max_size=10, ttl=60)
+    >>> cache.set('a', 'x' * 6)
+    >>> cache.get('a')
+    'xxxxxx'
+    >>> cache._data['a'][EXPIRES] -= 61 # simulate time
+    >>> cache.get('a') is None
+    True
+    """
+
+    def __init__(self, max_entries=1000, max_size=0, sizeof=len, ttl=0):
+        self.max_entries = max_entries
+        self.max_size = max_size # 0 means no size cap
+        self.ttl = ttl # 0 means no expiration
+        self._sizeof = sizeof
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data = {}
+            root = self._root = []
+            root[:] = [root, root, None, None, 0, 0]
+            self.size = 0
+            self.hits = self.misses = self.evictions = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def _unlink(self, node):
+        node[PREV][NEXT] = node[NEXT]
+        node[NEXT][PREV] = node[PREV]
+
+    def _linkLast(self, node):
+        root = self._root
+        last = root[PREV]
+        node[PREV] = last
+        node[NEXT] = root
+        last[NEXT] = root[PREV] = node
+
+    def _remove(self, node):
+        self._unlink(node)
+        del self._data[node[KEY]]
+        self.size -= node[SIZE]
+
+    def get(self, key, default=None):
+        """Return the value for key or default, and mark it as recently used.
+        """
+        self._lock.acquire()
+        try:
+            node = self._data.get(key)
+            if node is not None and self.ttl and node[EXPIRES] < time():
+                self._remove(node)
+                node = None
+            if node is None:
+                self.misses += 1
+                return default
+            self._unlink(node)
+            self._linkLast(node)
+            self.hits += 1
+            return node[VALUE]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        """Store value for key, evicting least recently used entries."""
+        size = self._sizeof(value)
+        if self.max_size and size > self.max_size:
+            self.invalidate(key)
+            return
+
+        self._lock.acquire()
+        try:
+            node = self._data.get(key)
+            if node is not None:
+                self._remove(node)
+            node = [None, None, key, value, size, time() + self.ttl]
+            self._linkLast(node)
+            self._data[key] = node
+            self.size += size
+
+            root = self._root
+            while (len(self._data) > self.max_entries
+                   or (self.max_size and self.size > self.max_size)):
+                self._remove(root[NEXT])
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self, key):
+        """Remove the entry for key, if any."""
+        self._lock.acquire()
+        try:
+            node = self._data.get(key)
+            if node is not None:
+                self._remove(node)
+        finally:
+            self._lock.release()
+
+    def getStatistics(self):
+        """Return a dict of figures about the cache usage."""
+        return {'entries': len(self._data),
+                'size': self.size,
+                'max_entries': self.max_entries,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                }
+
+
+def fingerprint(*values):
+    """Return a short stable hexadecimal digest of a list of strings.
+
+    Unicode values are encoded in UTF-8.
+
+    >>> fingerprint('Manager', 'Member')
+    '8776113bee1e46c225d5438ab58c46ad'
+    >>> fingerprint(u'Manager', 'Member') == fingerprint('Manager', 'Member')
+    True
+    """
+    digest = md5()
+    for value in values:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        digest.update(str(value))
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+def getCatalogGeneration(catalog):
+    """Return the generation of catalog.
+
+    The generation is a counter that gets incremented on each (un)indexation
+    (see patches.py). Since it's stored in the catalog, it is shared among
+    ZEO clients. Catalogs that never changed since the counter was introduced
+    are at generation 0.
+    """
+    counter = getattr(aq_base(catalog), CATALOG_GENERATION, None)
+    if counter is None:
+        return 0
+    return counter()
+
+def bumpCatalogGeneration(catalog):
+    """Increment the generation of catalog.
+
+    The counter is a BTrees.Length object, that resolves conflicts.
+    """
+    base = aq_base(catalog)
+    counter = getattr(base, CATALOG_GENERATION, None)
+    if counter is None:
+        counter = Length()
+        setattr(base, CATALOG_GENERATION, counter)
+    counter.change(1)
@@ -0,0 +1,309 @@
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Server side storage of filter states.
+
+Tabular widgets can keep the state of their filters here instead of
+serializing it in a cookie, that the browser sends back with each request.
+The cookie then holds a short token, that filter widgets resolve without
+any decoding.
+
+States are kept in a RAM cache, local to the Zope process, and optionally
+in a BTree stored in the portal, so that they survive restarts and are
+shared among ZEO clients. Tokens are derived from the states themselves:
+storing an already known state doesn't write anything, except to refresh
+its timestamp once a day at most.
+
+Persisted states expire after STATE_LIFETIME, and are purged by the
+process storing a state, once per PURGE_INTERVAL at most. A purge is
+done by slices of PURGE_SLICE states, one per call to store, so that no
+request pays for the whole walk. Beyond MAX_PERSISTENT_STATES, as counted
+by the last purge, new states are only kept in RAM.
+"""
+
+from time import time
+
+from Acquisition import aq_base
+from BTrees.OOBTree import OOBTree
+
+from Products.CMFCore.utils import getToolByName
+
+from Products.CPSDashboards.cache import LRUCache, fingerprint
+from Products.CPSDashboards.query import normalizeValue
+
+# distinguishes tokens from base64 serialized cookies
+TOKEN_PREFIX = '~'
+
+# attribute of the portal holding persisted states
+PERSISTENT_STATES = '_cpsdashboards_filter_states'
+
+# seconds after which persisted states are purged, unless stored again
+STATE_LIFETIME = 30 * 86400
+
+# seconds after which storing a known state refreshes its timestamp
+REFRESH_DELAY = 86400
+
+# minimal number of seconds between two purges of a portal, per process
+PURGE_INTERVAL = 3600
+
+# maximal number of persisted states visited by a call to store
+PURGE_SLICE = 1000
+
+# number of persisted states beyond which new states are kept in RAM only
+MAX_PERSISTENT_STATES = 100000
+
+def isFilterStateToken(value):
+    """Tell whether a cookie value is a filter state token.
+
+    >>> isFilterStateToken('~d2f1e8b2a3c4')
+    True
+    >>> isFilterStateToken('eyJxX29uZSI6ICJ2YWx1ZSJ9')
+    False
+    """
+    return value.startswith(TOKEN_PREFIX)
+
+def makeFilterStateToken(state):
+    """Return the token for a state mapping.
+
+    It doesn't depend on the order of keys, nor on the type of strings:
+
+    >>> makeFilterStateToken({'q_one': 'a', 'q_two': [1, 2]}) == (
+    ...     makeFilterStateToken({'q_two': [1, 2], 'q_one': u'a'}))
+    True
+    >>> len(makeFilterStateToken({}))
+    21
+    """
+    return TOKEN_PREFIX + fingerprint(repr(normalizeValue(state)))[:20]
+
+def purgeStates(states, now=None, start=None, max_visits=PURGE_SLICE):
+    """Remove persisted states older than STATE_LIFETIME, by slices.
+
+    At most max_visits states are visited, from the start token on.
+    Return the number of states kept and removed, and the token to start
+    the next slice from, or None if the end has been reached.
+
+    >>> from BTrees.OOBTree import OOBTree
+    >>> states = OOBTree({'~a': (1000.0, {}), '~b': (2000.0, {}),
+    ...                   '~c': (1000.0, {})})
+    >>> now = 1000.0 + STATE_LIFETIME + 500
+    >>> purgeStates(states, now=now, max_visits=2)
+    (1, 1, '~c')
+    >>> purgeStates(states, now=now, start='~c', max_visits=2)
+    (0, 1, None)
+    >>> list(states.keys())
+    ['~b']
+    """
+    if now is None:
+        now = time()
+    visited = []
+    for item in states.items(start):
+        if len(visited) == max_visits:
+            start = item[0]
+            break
+        visited.append(item)
+    else:
+        start = None
+
+    nb_kept = nb_removed = 0
+    for token, (stamp, state) in visited:
+        if now - stamp > STATE_LIFETIME:
+            del states[token]
+            nb_removed += 1
+        else:
+            nb_kept += 1
+    return nb_kept, nb_removed, start
+
+class FilterStateStore(object):
+    """Store filter states, keyed by tokens.
+
+    >>> store = FilterStateStore()
+    >>> token = store.store(None, {'q_one': 'value'})
+    >>> isFilterStateToken(token)
+    True
+    >>> store.lookup(None, token)
+    {'q_one': 'value'}
+
+    Unknown tokens (RAM cache cleared by a restart, etc.) give None:
+
+    >>> store.clear()
+    >>> store.lookup(None, token) is None
+    True
+
+    Now with persistence. States are stored in the portal, which is
+    found through the URL tool of the context:
+
+    >>> class FakePortal:
+    ...     def getPhysicalPath(self):
+    ...         return ('', 'portal')
+    >>> class FakeUrlTool:
+    ...     portal = FakePortal()
+    ...     def getPortalObject(self):
+    ...         return self.portal
+    >>> class FakeContext:
+    ...     portal_url = FakeUrlTool()
+    >>> context = FakeContext()
+    >>> token = store.store(context, {'q_one': 'value'}, persistent=True)
+    >>> store.clear()
+    >>> store.lookup(context, token)
+    {'q_one': 'value'}
+    >>> len(store.getPersistentStates(context))
+    1
+
+    Persisted states expire:
+
+    >>> later = time() + STATE_LIFETIME + 1
+    >>> store.clear()
+    >>> store.lookup(context, token, now=later) is None
+    True
+
+    They are purged by the next store, as soon as PURGE_INTERVAL is
+    elapsed since the last purge:
+
+    >>> other = store.store(context, {'q_one': 'other'}, persistent=True,
+    ...                     now=later)
+    >>> list(store.getPersistentStates(context).keys()) == [other]
+    True
+
+    Storing a known state doesn't write anything, unless its timestamp
+    is older than REFRESH_DELAY:
+
+    >>> states = store.getPersistentStates(context)
+    >>> stamp = states[other][0]
+    >>> token = store.store(context, {'q_one': 'other'}, persistent=True,
+    ...                     now=later + 60)
+    >>> states[other][0] == stamp
+    True
+    >>> token = store.store(context, {'q_one': 'other'}, persistent=True,
+    ...                     now=later + REFRESH_DELAY + 1)
+    >>> states[other][0] == later + REFRESH_DELAY + 1
+    True
+
+    Beyond max_persistent states, new states are kept in RAM only:
+
+    >>> store.max_persistent = 1
+    >>> token = store.store(context, {'q_one': 'third'}, persistent=True,
+    ...                     now=later + REFRESH_DELAY + 2)
+    >>> store.lookup(context, token)
+    {'q_one': 'third'}
+    >>> len(store.getPersistentStates(context))
+    1
+
+    Each store visits PURGE_SLICE states at most. A purge that hasn't
+    reached the end goes on with the next store, whatever the delay:
+
+    >>> store.max_persistent = MAX_PERSISTENT_STATES
+    >>> for i in range(3):
+    ...     states['~old%s' % i] = (later, {})
+    >>> store.purge_slice = 2
+    >>> token = store.store(context, {'q_one': 'other'}, persistent=True,
+    ...                     now=later + STATE_LIFETIME + 2 * PURGE_INTERVAL)
+    >>> len(states)
+    3
+    >>> token = store.store(context, {'q_one': 'other'}, persistent=True,
+    ...                     now=later + STATE_LIFETIME + 2 * PURGE_INTERVAL)
+    >>> list(states.keys()) == [other]
+    True
+    >>> store.purge_slice = PURGE_SLICE
+    """
+
+    def __init__(self, max_entries=10000,
+                 max_persistent=MAX_PERSISTENT_STATES,
+                 purge_slice=PURGE_SLICE):
+        self._cache = LRUCache(max_entries=max_entries)
+        self.max_persistent = max_persistent
+        self.purge_slice = purge_slice
+        # portal path -> (end time of last purge, token to resume the
+        #                 current purge from, states kept by the current
+        #                 purge, number of persisted states)
+        self._purges = {}
+
+    def clear(self):
+        """Clear the RAM cache."""
+        self._cache.clear()
+
+    def getPortal(self, context):
+        """Return the portal of context, or None."""
+        utool = getToolByName(context, 'portal_url', None)
+        if utool is None:
+            return None
+        return utool.getPortalObject()
+
+    def getPersistentStates(self, context, create=False):
+        """Return the BTree of persisted states, or None."""
+        portal = self.getPortal(context)
+        if portal is None:
+            return None
+        states = getattr(aq_base(portal), PERSISTENT_STATES, None)
+        if states is None and create:
+            states = OOBTree()
+            setattr(portal, PERSISTENT_STATES, states)
+        return states
+
+    def store(self, context, state, persistent=False, now=None):
+        """Store the state mapping and return its token."""
+        token = makeFilterStateToken(state)
+        self._cache.set(token, state)
+        if not persistent:
+            return token
+        if now is None:
+            now = time()
+        states = self.getPersistentStates(context, create=True)
+        portal_path = self.getPortal(context).getPhysicalPath()
+        last_purge, resume, nb_kept, nb_states = self._purges.get(
+            portal_path, (0, None, 0, 0))
+        if resume is not None or now - last_purge > PURGE_INTERVAL:
+            kept, removed, resume = purgeStates(states, now=now, start=resume,
+                                                max_visits=self.purge_slice)
+            nb_kept += kept
+            nb_states = max(nb_states - removed, 0)
+            if resume is None:
+                # purge complete
+                last_purge = now
+                nb_states = nb_kept
+                nb_kept = 0
+
+        stored = states.get(token)
+        if stored is None:
+            if nb_states < self.max_persistent:
+                states[token] = (now, state)
+                nb_states += 1
+        elif now - stored[0] > REFRESH_DELAY:
+            states[token] = (now, state)
+        self._purges[portal_path] = (last_purge, resume, nb_kept, nb_states)
+        return token
+
+    def lookup(self, context, token, now=None):
+        """Return the state mapping for token, or None if unknown."""
+        state = self._cache.get(token)
+        if state is not None or context is None:
+            return state
+        states = self.getPersistentStates(context)
+        if states is None:
+            return None
+        stored = states.get(token)
+        if stored is None:
+            return None
+        if now is None:
+            now = time()
+        stamp, state = stored
+        if now - stamp > STATE_LIFETIME:
+            return None
+        self._cache.set(token, state)
+        return state
+
+# process wide instance, used by tabular and filter widgets
+FILTER_STATES = FilterStateStore()
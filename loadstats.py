@@ -0,0 +1,138 @@
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Accounting of objects woken up while rendering tabular widgets.
+
+Brain datamodels fall back to the object's datamodel for keys that aren't
+catalog metadata. This is silent and costly. Tabular widgets record here,
+for each rendering, which keys caused that and how many ZODB loads
+occurred. Figures are aggregated per widget and row layout, and local to
+the Zope process.
+"""
+
+import threading
+
+class LoadStatistics(object):
+    """Aggregated object loads per (widget, row layout).
+
+    >>> stats = LoadStatistics()
+    >>> stats.record('/portal/dash/w__tab', 'row_layout', rows=10,
+    ...              woken_rows=10, fallback_keys={'Creator': 10},
+    ...              zodb_loads=42)
+    >>> stats.record('/portal/dash/w__tab', 'row_layout', rows=5,
+    ...              woken_rows=0, fallback_keys={}, zodb_loads=3)
+    >>> stats.record('/portal/other/w__tab', 'row_layout', rows=10,
+    ...              woken_rows=0, fallback_keys={}, zodb_loads=1)
+
+    Statistics are listed by decreasing number of ZODB loads:
+
+    >>> from pprint import pprint
+    >>> pprint(stats.getStatistics()[0])
+    {'fallback_keys': [('Creator', 10)],
+     'max_zodb_loads': 42,
+     'renders': 2,
+     'row_layout': 'row_layout',
+     'rows': 15,
+     'widget': '/portal/dash/w__tab',
+     'woken_rows': 10,
+     'zodb_loads': 45}
+    >>> len(stats.getStatistics())
+    2
+    >>> stats.clear()
+    >>> stats.getStatistics()
+    []
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data = {}
+        finally:
+            self._lock.release()
+
+    def record(self, widget, row_layout, rows=0, woken_rows=0,
+               fallback_keys=None, zodb_loads=0):
+        """Record figures of a rendering.
+
+        fallback_keys maps keys to the number of rows for which they caused
+        a fallback on the object's datamodel.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._data.get((widget, row_layout))
+            if entry is None:
+                entry = self._data[(widget, row_layout)] = {
+                    'widget': widget,
+                    'row_layout': row_layout,
+                    'renders': 0,
+                    'rows': 0,
+                    'woken_rows': 0,
+                    'zodb_loads': 0,
+                    'max_zodb_loads': 0,
+                    'fallback_keys': {},
+                    }
+            entry['renders'] += 1
+            entry['rows'] += rows
+            entry['woken_rows'] += woken_rows
+            entry['zodb_loads'] += zodb_loads
+            entry['max_zodb_loads'] = max(entry['max_zodb_loads'],
+                                          zodb_loads)
+            keys = entry['fallback_keys']
+            for key, count in (fallback_keys or {}).items():
+                keys[key] = keys.get(key, 0) + count
+        finally:
+            self._lock.release()
+
+    def getStatistics(self):
+        """Return a list of dicts, by decreasing number of ZODB loads.
+
+        Fallback keys are given as a list of (key, count), by decreasing
+        count.
+        """
+        self._lock.acquire()
+        try:
+            entries = [dict(entry, fallback_keys=entry['fallback_keys'].copy())
+                       for entry in self._data.values()]
+        finally:
+            self._lock.release()
+
+        for entry in entries:
+            keys = [(-count, key)
+                    for key, count in entry['fallback_keys'].items()]
+            keys.sort()
+            entry['fallback_keys'] = [(key, -count) for count, key in keys]
+        entries = [(-entry['zodb_loads'], entry['widget'], entry)
+                   for entry in entries]
+        entries.sort()
+        return [entry[2] for entry in entries]
+
+# process wide instance, fed by TabularWidget.render()
+LOAD_STATS = LoadStatistics()
+
+def getTransferCount(obj):
+    """Return the number of objects loaded so far by obj's connection.
+
+    Return None if obj isn't attached to a connection.
+    """
+    jar = getattr(obj, '_p_jar', None)
+    if jar is None or not hasattr(jar, 'getTransferCounts'):
+        return None
+    return jar.getTransferCounts()[0]
@@ -0,0 +1,187 @@
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Cached computation of merged local roles.
+
+The membership tool's getMergedLocalRoles() walks the whole acquisition
+chain of the object each time it is called. Listings call it for each row,
+although rows mostly share their ancestors.
+
+Here, merged local roles are cached for each level of the chain, keyed by
+its path and the modification times of the level and of all its
+ancestors. Siblings therefore share the roles of their parents, and any
+committed change of local roles (local roles forms, workflow, ZMI...)
+invalidates the whole subtree below the changed object, on all ZEO
+clients. Objects with uncommitted changes aren't cached.
+"""
+
+from Acquisition import aq_base, aq_inner, aq_parent
+
+from Products.CPSDashboards.cache import LRUCache
+
+# keys are (physical path, modification times of the chain)
+MERGED_LOCAL_ROLES = LRUCache(max_entries=10000, sizeof=lambda v: 1)
+
+# local role that blocks acquisition of local roles from above
+BLOCKING_ROLE = '-'
+
+def getOwnLocalRoles(ob):
+    """Return the local roles defined on ob itself.
+
+    The format is the same as the one of getMergedLocalRoles(): keys are
+    user and group ids, prefixed by 'user:' and 'group:'.
+    """
+    ob = aq_base(ob)
+    res = {}
+    for prefix, attr in (('user:', '__ac_local_roles__'),
+                         ('group:', '__ac_local_group_roles__')):
+        local_roles = getattr(ob, attr, None) or {}
+        if callable(local_roles):
+            local_roles = local_roles()
+        for uid, roles in local_roles.items():
+            if roles:
+                res[prefix + uid] = list(roles)
+    return res
+
+def isBlocking(own_roles):
+    """Tell whether own local roles block acquisition from above.
+
+    >>> isBlocking({'group:role:Anonymous': ['-'], 'user:joe': ['Owner']})
+    True
+    >>> isBlocking({'user:joe': ['Owner']})
+    False
+    """
+    for roles in own_roles.values():
+        if BLOCKING_ROLE in roles:
+            return True
+    return False
+
+def getStamp(ob):
+    """Return the modification time of ob, or None if not reliable."""
+    ob = aq_base(ob)
+    if getattr(ob, '_p_changed', False):
+        return None
+    return getattr(ob, '_p_mtime', None)
+
+def getMergedLocalRoles(ob):
+    """Return the merged local roles of ob, as the membership tool does.
+
+    The returned mapping is shared with the cache and must not be
+    modified.
+
+    Let's build a folder hierarchy, with fake persistence stamps:
+
+    >>> from Acquisition import Implicit
+    >>> class FakeObject(Implicit):
+    ...     _p_mtime = 1000.0
+    ...     _p_changed = False
+    ...     def __init__(self, oid, **local_roles):
+    ...         self.oid = oid
+    ...         self.__ac_local_roles__ = local_roles
+    ...     def getPhysicalPath(self):
+    ...         parent = aq_parent(aq_inner(self))
+    ...         if parent is None:
+    ...             return ('', self.oid)
+    ...         return parent.getPhysicalPath() + (self.oid,)
+    >>> root = FakeObject('portal', admin=['Manager'])
+    >>> folder = FakeObject('folder', joe=['WorkspaceManager']).__of__(root)
+    >>> doc = FakeObject('doc', jane=['Owner'],
+    ...                  joe=['Owner']).__of__(folder)
+
+    Roles of the object come first:
+
+    >>> MERGED_LOCAL_ROLES.clear()
+    >>> from pprint import pprint
+    >>> pprint(getMergedLocalRoles(doc))
+    {'user:admin': ['Manager'],
+     'user:jane': ['Owner'],
+     'user:joe': ['Owner', 'WorkspaceManager']}
+
+    A sibling reuses the roles computed for the parents:
+
+    >>> other = FakeObject('other').__of__(folder)
+    >>> MERGED_LOCAL_ROLES.hits = 0
+    >>> pprint(getMergedLocalRoles(other))
+    {'user:admin': ['Manager'], 'user:joe': ['WorkspaceManager']}
+    >>> MERGED_LOCAL_ROLES.hits
+    1
+
+    Once a change of the folder is committed, its stamp changes, and the
+    subtree gets computed again:
+
+    >>> folder.__ac_local_roles__ = {'jim': ['WorkspaceReader']}
+    >>> folder._p_mtime = 2000.0
+    >>> pprint(getMergedLocalRoles(doc))
+    {'user:admin': ['Manager'],
+     'user:jane': ['Owner'],
+     'user:jim': ['WorkspaceReader'],
+     'user:joe': ['Owner']}
+
+    Local roles can be blocked:
+
+    >>> folder.__ac_local_group_roles__ = {'role:Anonymous': ['-']}
+    >>> folder._p_mtime = 3000.0
+    >>> pprint(getMergedLocalRoles(doc))
+    {'group:role:Anonymous': ['-'],
+     'user:jane': ['Owner'],
+     'user:jim': ['WorkspaceReader'],
+     'user:joe': ['Owner']}
+    """
+
+    # acquisition chain, top first
+    chain = []
+    while ob is not None:
+        if getattr(aq_base(ob), 'getPhysicalPath', None) is None:
+            # request container etc.
+            break
+        chain.append(ob)
+        ob = aq_parent(aq_inner(ob))
+    chain.reverse()
+
+    # cache keys of each level, None for levels that can't be cached
+    keys = []
+    stamps = ()
+    for ob in chain:
+        stamp = stamps is not None and getStamp(ob) or None
+        if stamp is None:
+            stamps = None
+            keys.append(None)
+        else:
+            stamps = stamps + (stamp,)
+            keys.append((ob.getPhysicalPath(), stamps))
+
+    # deepest cached level
+    merged = {}
+    start = 0
+    for i in range(len(chain) - 1, -1, -1):
+        if keys[i] is None:
+            continue
+        cached = MERGED_LOCAL_ROLES.get(keys[i])
+        if cached is not None:
+            merged = cached
+            start = i + 1
+            break
+
+    for i in range(start, len(chain)):
+        own = getOwnLocalRoles(chain[i])
+        if not isBlocking(own):
+            for uid, roles in merged.items():
+                own[uid] = own.get(uid, []) + roles
+        merged = own
+        if keys[i] is not None:
+            MERGED_LOCAL_ROLES.set(keys[i], merged)
+    return merged
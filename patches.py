@@ -0,0 +1,45 @@
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Patches applied at product import time.
+
+The catalog generation counter (see cache.py) has to be incremented on each
+(un)indexation, whatever the code path. CMF and CPS catalog tools end up
+calling the ZCatalog methods patched here.
+"""
+
+import logging
+
+from Products.ZCatalog.ZCatalog import ZCatalog
+from Products.CPSDashboards.cache import bumpCatalogGeneration
+
+logger = logging.getLogger('CPSDashboards.patches')
+
+def patchForCatalogGeneration(klass, meth_name):
+    orig = klass.__dict__[meth_name]
+
+    def patched(self, *args, **kw):
+        bumpCatalogGeneration(self)
+        return orig(self, *args, **kw)
+
+    patched.__doc__ = orig.__doc__
+    setattr(klass, meth_name, patched)
+    logger.debug("Patched %s.%s for catalog generation",
+                 klass.__name__, meth_name)
+
+for meth_name in ('catalog_object', 'uncatalog_object', 'manage_catalogClear'):
+    patchForCatalogGeneration(ZCatalog, meth_name)
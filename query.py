@@ -0,0 +1,150 @@
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Canonical forms of queries.
+
+Queries built by tabular widgets from filters depend on cookie order, order
+of tokens in fulltext inputs, lists vs tuples etc. The canonical form
+provided here is hashable and doesn't depend on any of these, so that
+caches, logs and metrics can key on it.
+"""
+
+from Products.CPSDashboards.cache import fingerprint
+
+# keys for which the order of values in a sequence is meaningful
+ORDERED_KEYS = ('sort_on', 'sort-on', 'sort_order', 'sort-order')
+
+RANGE_ALIASES = {'minmax': 'min:max'}
+
+def normalizeFulltext(value):
+    """Normalize an OR fulltext expression as built by filtersToQuery.
+
+    >>> normalizeFulltext('(foo OR  eggs OR foo)')
+    '(eggs OR foo)'
+    >>> normalizeFulltext(' spam ')
+    'spam'
+    """
+    value = value.strip()
+    if value.startswith('(') and value.endswith(')'):
+        value = value[1:-1]
+    tokens = {}
+    for token in value.split(' OR '):
+        token = ' '.join(token.split())
+        if token:
+            tokens[token] = None
+    tokens = tokens.keys()
+    tokens.sort()
+    if len(tokens) == 1:
+        return tokens[0]
+    return '(%s)' % ' OR '.join(tokens)
+
+def normalizeValue(value, ordered=False):
+    """Return a canonical hashable form of a query value.
+
+    Sequences are considered as sets (scopes, etc.), unless ``ordered``
+    is True:
+
+    >>> normalizeValue(['b', u'a', 'b'])
+    ('a', 'b')
+    >>> normalizeValue(('b', 'a'), ordered=True)
+    ('b', 'a')
+
+    Dates are converted to timestamps, so that different spellings of the
+    same date are equal. Here's a fake DateTime for the example:
+
+    >>> class FakeDateTime:
+    ...     def __init__(self, t):
+    ...         self.t = t
+    ...     def timeTime(self):
+    ...         return self.t
+    >>> normalizeValue(FakeDateTime(1327156800.0))
+    ('DateTime', 1327156800.0)
+
+    Mappings are handled recursively. Ranges get their bounds kept in
+    order and their spelling normalized:
+
+    >>> normalizeValue({'range': 'minmax', 'query': [3, 1]})
+    (('query', (3, 1)), ('range', 'min:max'))
+    >>> normalizeValue({'query': ['b', 'a'], 'insert_condition': 'NOT'})
+    (('insert_condition', 'NOT'), ('query', ('a', 'b')))
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, dict):
+        rng = value.get('range')
+        items = []
+        for key, item in value.items():
+            if key == 'range':
+                item = RANGE_ALIASES.get(item, item)
+            else:
+                item = normalizeValue(item, ordered=rng is not None)
+            items.append((key, item))
+        items.sort()
+        return tuple(items)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        values = [normalizeValue(v) for v in value]
+        if ordered:
+            return tuple(values)
+        values = dict.fromkeys(values).keys()
+        values.sort()
+        return tuple(values)
+    if hasattr(value, 'timeTime'):
+        return ('DateTime', value.timeTime())
+    if hasattr(value, 'isoformat'): # python datetime
+        return ('datetime', value.isoformat())
+    return value
+
+def normalizeQuery(query, fulltext_keys=()):
+    """Return a canonical and hashable form of query.
+
+    >>> q1 = {'portal_type': ['News Item', 'File'],
+    ...       'SearchableText': '(foo OR eggs)',
+    ...       'sort-on': 'modified'}
+    >>> q2 = {'sort-on': 'modified',
+    ...       'SearchableText': '(eggs OR foo)',
+    ...       'portal_type': ('File', u'News Item')}
+    >>> normalizeQuery(q1, fulltext_keys=['SearchableText'])
+    (('SearchableText', '(eggs OR foo)'), ('portal_type', ('File', 'News Item')), ('sort-on', 'modified'))
+    >>> normalizeQuery(q1, fulltext_keys=['SearchableText']) == (
+    ...     normalizeQuery(q2, fulltext_keys=['SearchableText']))
+    True
+
+    The order of sort keys is meaningful:
+
+    >>> normalizeQuery({'sort_on': ['modified', 'Title']})
+    (('sort_on', ('modified', 'Title')),)
+    """
+    items = []
+    for key, value in query.items():
+        if key in fulltext_keys and isinstance(value, basestring):
+            value = normalizeFulltext(normalizeValue(value))
+        else:
+            value = normalizeValue(value, ordered=key in ORDERED_KEYS)
+        items.append((key, value))
+    items.sort()
+    return tuple(items)
+
+def queryFingerprint(query, fulltext_keys=()):
+    """Return a stable digest of the canonical form of query.
+
+    >>> queryFingerprint({'a': [1, 2], 'b': 'x'}) == (
+    ...     queryFingerprint({'b': u'x', 'a': (2, 1)}))
+    True
+    >>> len(queryFingerprint({}))
+    32
+    """
+    return fingerprint(repr(normalizeQuery(query, fulltext_keys)))
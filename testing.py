@@ -18,6 +18,8 @@
 # $Id$
 
 """CPSDashboards utilities for unit tests."""
+from ZODB.POSException import ConflictError
+from Products.CMFCore.WorkflowCore import WorkflowException
 from Products.CPSDashboards.braindatamodel import FakeBrain
 
 class FakeResponse:
@@ -34,7 +36,7 @@ class FakeResponse:
         self.status = 302
 
     def getHeader(self, key):
-        return self.headers[key]
+        return self.headers.get(key)
 
     def setHeader(self, key, value):
         self.headers[key] = value
@@ -102,12 +104,149 @@ class FakeLuceneCatalog:
 
     _nb_results = 0
     wrong_out_of = 0
+    nb_queries = 0
 
     def setNbResults(self, nb):
         self._nb_results = nb
 
     def __call__(self, b_start=0, b_size=10, **kw):
+        self.nb_queries += 1
         out_of = self.wrong_out_of or self._nb_results
         return [self._makeBrain(i, out_of=out_of)
                 for i in range(self._nb_results)[b_start:b_start+b_size]]
 
+class FakeClampingLuceneCatalog(FakeLuceneCatalog):
+    """A fake lucene catalog that can switch to the last page by itself."""
+
+    def clampedSearchResults(self, b_start=0, b_size=10, **kw):
+        """Return results, total number of results and actual b_start."""
+        self.nb_queries += 1
+        nb = self._nb_results
+        if nb and b_start >= nb:
+            b_start = ((nb-1) / b_size) * b_size
+        return ([self._makeBrain(i, out_of=nb)
+                 for i in range(nb)[b_start:b_start+b_size]], nb, b_start)
+
+
+class FakeTransaction:
+    """Stands for the transaction module, counting commits and aborts.
+
+    The first commits can raise conflict errors:
+
+    >>> txn = FakeTransaction(conflicts=1)
+    >>> try:
+    ...     txn.commit()
+    ... except ConflictError:
+    ...     print 'conflict'
+    conflict
+    >>> txn.commit()
+    >>> txn.commits, txn.aborts
+    (1, 0)
+    """
+
+    def __init__(self, conflicts=0):
+        self.conflicts = conflicts
+        self.commits = 0
+        self.aborts = 0
+
+    def commit(self):
+        if self.conflicts:
+            self.conflicts -= 1
+            raise ConflictError
+        self.commits += 1
+
+    def abort(self):
+        self.aborts += 1
+
+class FakeProxy:
+
+    def __init__(self, rpath):
+        self.rpath = rpath
+
+    def Title(self):
+        return 'Title of %s' % self.rpath
+
+class FakeTransitionWorkflow:
+    """Supports any transition, except on documents whose rpath ends with
+    'locked'."""
+
+    def isActionSupported(self, proxy, transition):
+        return not proxy.rpath.endswith('locked')
+
+class FakeWorkflowTool:
+    """A workflow tool whose transitions raise a number of conflict errors.
+
+    Transitions always fail on documents whose rpath ends with 'broken'.
+
+    >>> from ZODB.POSException import ConflictError
+    >>> wftool = FakeWorkflowTool(conflicts=1)
+    >>> try:
+    ...     wftool.doActionFor(FakeProxy('ws/a'), 'publish')
+    ... except ConflictError:
+    ...     print 'conflict'
+    conflict
+    >>> wftool.doActionFor(FakeProxy('ws/a'), 'publish')
+    >>> wftool.done
+    ['ws/a']
+    >>> try:
+    ...     wftool.doActionFor(FakeProxy('ws/broken'), 'publish')
+    ... except WorkflowException:
+    ...     print 'failed'
+    failed
+    """
+
+    def __init__(self, conflicts=0):
+        self.conflicts = conflicts
+        self.done = []
+
+    def getWorkflowsFor(self, proxy):
+        return [FakeTransitionWorkflow()]
+
+    def doActionFor(self, proxy, transition, **kw):
+        if self.conflicts:
+            self.conflicts -= 1
+            raise ConflictError
+        if proxy.rpath.endswith('broken'):
+            raise WorkflowException("Broken document %s" % proxy.rpath)
+        self.done.append(proxy.rpath)
+
+_marker = object()
+
+class FakeTransitionPortal:
+    """A portal to trigger transitions in, see FakeWorkflowTool.
+
+    Documents whose rpath ends with 'deleted' don't exist.
+    """
+
+    def __init__(self, conflicts=0):
+        self.portal_workflow = FakeWorkflowTool(conflicts=conflicts)
+
+    def unrestrictedTraverse(self, rpath, default=_marker):
+        if rpath.endswith('deleted'):
+            if default is _marker:
+                raise KeyError(rpath)
+            return default
+        return FakeProxy(rpath)
+
+    def getPortalObject(self):
+        return self
+
+class FakeUserFolder:
+    """A user folder that knows of no one."""
+
+    def getUserById(self, user_id):
+        return None
+
+    def getUser(self, name):
+        return None
+
+class FakeConnection:
+
+    def close(self):
+        pass
+
+class FakeDatabase:
+    """Stands for a ZODB database, see JobRunner.process()."""
+
+    def open(self):
+        return FakeConnection()
@@ -0,0 +1,194 @@
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+#$Id$
+
+import unittest
+from zope.testing import doctest
+
+from ZODB.POSException import ConflictError
+
+from Products.CPSDashboards import batchjobs
+from Products.CPSDashboards.batchjobs import triggerTransitionChunk
+from Products.CPSDashboards.batchjobs import BatchJob, JobRunner, getJob
+from Products.CPSDashboards.batchjobs import ERROR, FINISHED
+from Products.CPSDashboards.testing import FakeTransaction
+from Products.CPSDashboards.testing import FakeTransitionPortal
+from Products.CPSDashboards.testing import FakeUserFolder, FakeDatabase
+
+class ChunkTestCase(unittest.TestCase):
+    """Base class for tests of chunked transitions.
+
+    Commits are counted, instead of happening, and there's no sleeping
+    between retries.
+    """
+
+    def setUp(self):
+        self.transaction = FakeTransaction()
+        self.sleeps = []
+        self._orig = batchjobs.transaction, batchjobs.sleep
+        batchjobs.transaction = self.transaction
+        batchjobs.sleep = self.sleeps.append
+
+    def tearDown(self):
+        batchjobs.transaction, batchjobs.sleep = self._orig
+
+    def getStatuses(self, outcomes):
+        return [outcome['status'] for outcome in outcomes]
+
+
+class TriggerTransitionChunkTest(ChunkTestCase):
+
+    rpaths = ['ws/a', 'ws/b', 'ws/c']
+
+    def test_done(self):
+        portal = FakeTransitionPortal()
+        outcomes, retries = triggerTransitionChunk(portal, 'publish',
+                                                   self.rpaths, {})
+        self.assertEquals(self.getStatuses(outcomes), ['done'] * 3)
+        self.assertEquals(outcomes[0]['title'], 'Title of ws/a')
+        self.assertEquals(retries, 0)
+        self.assertEquals(self.transaction.commits, 1)
+        self.assertEquals(self.transaction.aborts, 0)
+        self.assertEquals(portal.portal_workflow.done, self.rpaths)
+
+    def test_not_supported(self):
+        portal = FakeTransitionPortal()
+        outcomes, retries = triggerTransitionChunk(
+            portal, 'publish', ['ws/a', 'ws/locked'], {})
+        self.assertEquals(self.getStatuses(outcomes), ['done', 'failed'])
+        self.assertEquals(self.transaction.commits, 1)
+
+    def test_document_errors(self):
+        # faulty documents fail, the others of the chunk are done
+        portal = FakeTransitionPortal()
+        outcomes, retries = triggerTransitionChunk(
+            portal, 'publish', ['ws/a', 'ws/broken', 'ws/deleted', 'ws/c'],
+            {})
+        self.assertEquals(self.getStatuses(outcomes),
+                          ['done', 'failed', 'failed', 'done'])
+        self.assertEquals(outcomes[2]['title'], 'ws/deleted')
+        self.assertEquals(retries, 0)
+        self.assertEquals(self.transaction.commits, 1)
+        self.assertEquals(self.transaction.aborts, 2)
+
+    def test_retried(self):
+        portal = FakeTransitionPortal(conflicts=2)
+        outcomes, retries = triggerTransitionChunk(portal, 'publish',
+                                                   self.rpaths, {},
+                                                   conflict_retries=3,
+                                                   conflict_backoff=0.5)
+        self.assertEquals(self.getStatuses(outcomes), ['retried'] * 3)
+        self.assertEquals(retries, 2)
+        self.assertEquals(self.transaction.commits, 1)
+        self.assertEquals(self.transaction.aborts, 2)
+        # exponential backoff
+        self.assertEquals(self.sleeps, [0.5, 1.0])
+
+    def test_given_up(self):
+        portal = FakeTransitionPortal(conflicts=10)
+        outcomes, retries = triggerTransitionChunk(portal, 'publish',
+                                                   self.rpaths, {},
+                                                   conflict_retries=3)
+        self.assertEquals(self.getStatuses(outcomes), ['failed'] * 3)
+        self.assertEquals(retries, 3)
+        self.assertEquals(self.transaction.commits, 0)
+        self.assertEquals(self.transaction.aborts, 4)
+        self.assertEquals(len(self.sleeps), 3)
+        self.assertEquals(portal.portal_workflow.done, [])
+
+    def test_given_up_deleted(self):
+        # titles of given up documents are looked up safely
+        portal = FakeTransitionPortal(conflicts=10)
+        outcomes, retries = triggerTransitionChunk(
+            portal, 'publish', ['ws/a', 'ws/deleted'], {}, conflict_retries=1)
+        self.assertEquals([outcome['title'] for outcome in outcomes],
+                          ['Title of ws/a', 'ws/deleted'])
+
+    def test_given_up_before_commit(self):
+        # outcomes of a given up chunk are recorded and committed
+        portal = FakeTransitionPortal(conflicts=10)
+        recorded = []
+        outcomes, retries = triggerTransitionChunk(
+            portal, 'publish', self.rpaths, {}, conflict_retries=1,
+            before_commit=recorded.extend)
+        self.assertEquals(self.getStatuses(recorded), ['failed'] * 3)
+        self.assertEquals(self.transaction.commits, 1)
+
+    def test_given_up_commit_conflict(self):
+        # conflict errors of the commit of a given up chunk are raised
+        portal = FakeTransitionPortal()
+        self.transaction.conflicts = 3
+        self.assertRaises(ConflictError, triggerTransitionChunk, portal,
+                          'publish', self.rpaths, {}, conflict_retries=1,
+                          before_commit=lambda outcomes: None)
+        self.assertEquals(self.transaction.commits, 0)
+
+
+class JobRunnerTest(ChunkTestCase):
+
+    def makeJob(self):
+        return BatchJob('the_job', 'joe', 'publish', ['ws/a'], {},
+                        conflict_retries=2, conflict_backoff=0.5)
+
+    def test_commitStatus(self):
+        job = self.makeJob()
+        self.transaction.conflicts = 2
+        self.assert_(JobRunner()._commitStatus(job, ERROR, error='Oops'))
+        self.assertEquals((job.status, job.error), (ERROR, 'Oops'))
+        self.assertEquals(self.transaction.commits, 1)
+        self.assertEquals(self.transaction.aborts, 2)
+        self.assertEquals(self.sleeps, [0.5, 1.0])
+
+    def test_commitStatus_given_up(self):
+        job = self.makeJob()
+        self.transaction.conflicts = 3
+        self.failIf(JobRunner()._commitStatus(job, FINISHED))
+        self.assertEquals(self.transaction.commits, 0)
+
+    def test_submit(self):
+        # conflict settings are kept on the job
+        portal = FakeTransitionPortal()
+        runner = JobRunner()
+        runner.schedule = lambda portal, job_id: None
+        job_id = runner.submit(portal, 'joe', 'publish', ['ws/a'], {},
+                               conflict_retries=5, conflict_backoff=2.0,
+                               request_info={'SERVER_URL': 'http://cps'})
+        job = getJob(portal, job_id)
+        self.assertEquals((job.conflict_retries, job.conflict_backoff),
+                          (5, 2.0))
+        self.assertEquals(job.request_info, {'SERVER_URL': 'http://cps'})
+
+    def test_process_unknown_user(self):
+        # the job ends in error, without running any transition
+        portal = FakeTransitionPortal()
+        portal.acl_users = FakeUserFolder()
+        job = self.makeJob()
+        runner = JobRunner()
+        runner._claim = lambda conn, portal_path, job_id: (portal, job)
+        runner.process(FakeDatabase(), '/portal', 'the_job')
+        self.assertEquals((job.status, job.error),
+                          (ERROR, 'Unknown user joe'))
+        self.assertEquals(self.transaction.commits, 1)
+        self.assertEquals(portal.portal_workflow.done, [])
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TriggerTransitionChunkTest),
+        unittest.makeSuite(JobRunnerTest),
+        doctest.DocTestSuite('Products.CPSDashboards.batchjobs'),
+        ))
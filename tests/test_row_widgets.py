@@ -71,6 +71,17 @@ class TestUsersWithRolesWidget(CPSTestCase):
         self.assert_('the_wid' in ds)
         self.assertEquals(ds['the_wid'], [])
 
+    def test_prepareBatch(self):
+        self.widget.merge_roles = True
+        self.widget.roles = ['TestingRole']
+        self.folder.manage_setLocalRoles('user_roleswidget', ['TestingRole'])
+        other = self.portal.workspaces
+        dss = [DataStructure(datamodel=DataModel(None, proxy=self.folder)),
+               DataStructure(datamodel=DataModel(None, proxy=other))]
+        self.widget.prepareBatch(dss)
+        self.assertEquals(dss[0]['the_wid'], ['Roles Tester'])
+        self.assertEquals(dss[1]['the_wid'], [])
+
 
 def test_suite():
     return unittest.TestSuite((
@@ -272,6 +272,88 @@ class IntegrationTestFolderContentsPortlet(IntegrationTestCase):
             'Title 2|<div class="ddefault">', 'content 2', '</div>',
             ])
 
+    def test_foldercontents_catalog(self):
+        wftool = self.portal.portal_workflow
+        container = self.portal.workspaces
+        for i in (1, 2):
+            wftool.invokeFactoryFor(container, 'News Item', 'item%d' % i,
+                                    Title='Title %d' % i,
+                                    content='content %d' % i)
+
+        self.widget.manage_changeProperties(use_catalog=True)
+        rendered = self.widget.render('view', self.ds, context_obj=container)
+        # order of an unsorted catalog query is not specified
+        lines = rendered.split('\n')
+        lines.sort()
+        self.assertEquals(lines, [
+            '</div>', '</div>',
+            'Title 1|<div class="ddefault">', 'Title 2|<div class="ddefault">',
+            'content 1', 'content 2',
+            ])
+
+    def test_foldercontents_catalog_languages(self):
+        # proxies are cataloged once per language
+        wftool = self.portal.portal_workflow
+        container = self.portal.workspaces
+        for i in (1, 2):
+            wftool.invokeFactoryFor(container, 'News Item', 'item%d' % i,
+                                    Title='Title %d' % i,
+                                    content='content %d' % i)
+        container.item1.addLanguageToProxy('fr')
+        paths = [brain.getPath() for brain in self.portal.portal_catalog(
+            container_path='/'.join(container.getPhysicalPath()))]
+        self.assert_(len(paths) > 2)
+
+        self.widget.manage_changeProperties(use_catalog=True,
+                                            items_per_page=1)
+        self.widget.render_method = 'widget_render_logging'
+        self.widget.render('view', self.ds, context_obj=container)
+        self.assertEquals(len(self.widget.passed_rows), 1)
+        self.assertEquals(self.widget.passed_batching_info['nb_pages'], 2)
+
+        self.widget.manage_changeProperties(items_per_page=10)
+        self.widget.render('view', self.ds, context_obj=container)
+        self.assertEquals(len(self.widget.passed_rows), 2)
+
+    def test_foldercontents_filters(self):
+        wftool = self.portal.portal_workflow
+        container = self.portal.workspaces
+        for i in (1, 2):
+            wftool.invokeFactoryFor(container, 'News Item', 'item%d' % i,
+                                    Title='Title %d' % i,
+                                    content='content %d' % i)
+        self.widget.manage_changeProperties(items_per_page=1)
+        self.widget.render_method = 'widget_render_logging'
+
+        # pushed down filter: correct number of pages
+        self.ds['f_portal_type'] = 'News Item'
+        self.widget.render('view', self.ds, context_obj=container)
+        self.assertEquals(len(self.widget.passed_rows), 1)
+        self.assertEquals(self.widget.passed_batching_info['nb_pages'], 2)
+
+        # filter on prepared rows
+        self.ds['f_Title'] = 'Title 2'
+        self.widget.render('view', self.ds, context_obj=container)
+        self.assertEquals(len(self.widget.passed_rows), 1)
+        self.assert_('Title 2' in self.widget.passed_rows[0])
+        self.assertEquals(self.widget.passed_batching_info['nb_pages'], 1)
+
+    def test_foldercontents_filters_nb_pages(self):
+        # matches beyond the next page are counted too
+        wftool = self.portal.portal_workflow
+        container = self.portal.workspaces
+        for i in range(3):
+            wftool.invokeFactoryFor(container, 'News Item', 'item%d' % i,
+                                    Title='Same title',
+                                    content='content %d' % i)
+        self.widget.manage_changeProperties(items_per_page=1)
+        self.widget.render_method = 'widget_render_logging'
+
+        self.ds['f_Title'] = 'Same title'
+        self.widget.render('view', self.ds, context_obj=container)
+        self.assertEquals(len(self.widget.passed_rows), 1)
+        self.assertEquals(self.widget.passed_batching_info['nb_pages'], 3)
+
 #
 # Sub classes
 #
@@ -312,6 +394,52 @@ class IntegrationTestDirectoryTabularWidget(IntegrationTestCase):
             'test_dirtab2|dirtab',
             ])
 
+    def test_dirsearch_projection(self):
+        layout = self.portal.portal_layouts['test_dir_row']
+        fields = self.widget.getProjectedFields(layout, self.dir)
+        self.assert_('sn' in fields)
+        self.assert_(self.dir.id_field in fields)
+
+        dms, nb = self.widget._doBatchedQuery(self.dir, 1, 10,
+                                              {'id': 'test_dirtab'},
+                                              return_fields=fields)
+        self.assertEquals(nb, 3)
+        self.assertEquals([dm['sn'] for dm in dms], ['dirtab', 'dirtab'])
+        # no full datamodel has been fetched
+        self.assertEquals([dm.getFallbackKeys() for dm in dms], [[], []])
+
+    def test_dirsearch_projection_acl(self):
+        # fields with read access control go through the full datamodel
+        layout = self.portal.portal_layouts['test_dir_row']
+        field = dict(self.dir._getFieldItems())['sn']
+        field.manage_changeProperties(acl_read_roles='Manager')
+        fields = self.widget.getProjectedFields(layout, self.dir)
+        self.failIf('sn' in fields)
+
+        dms, nb = self.widget._doBatchedQuery(self.dir, 0, 10,
+                                              {'id': 'test_dirtab'},
+                                              return_fields=fields)
+        self.assertEquals([dm['sn'] for dm in dms], ['dirtab'] * 3)
+        self.assertEquals([dm.getFallbackKeys() for dm in dms], [['sn']] * 3)
+
+    def test_dirsearch_not_viewable(self):
+        # entries that can't be viewed are neither listed nor counted
+        entry_local_roles = self.dir.entry_local_roles
+        self.dir.entry_local_roles = (('Owner', 'python: 1'),)
+        self.dir.isViewEntryAllowed = (
+            lambda id=None, entry=None: id != 'test_dirtab1')
+        try:
+            dms, nb = self.widget._doBatchedQuery(self.dir, 0, 2,
+                                                  {'id': 'test_dirtab'},
+                                                  return_fields=['id', 'sn'])
+        finally:
+            self.dir.entry_local_roles = entry_local_roles
+            del self.dir.isViewEntryAllowed
+        self.assertEquals(nb, 2)
+        self.assertEquals([dm['id'] for dm in dms],
+                          ['test_dirtab0', 'test_dirtab2'])
+        self.assertEquals([dm['sn'] for dm in dms], ['dirtab', 'dirtab'])
+
 
 def test_suite():
     return unittest.TestSuite((
@@ -319,6 +447,7 @@ def test_suite():
         unittest.makeSuite(IntegrationTestFolderContentsPortlet),
         unittest.makeSuite(IntegrationTestDirectoryTabularWidget),
         doctest.DocTestSuite('Products.CPSDashboards.widgets.tabular'),
+        doctest.DocTestSuite('Products.CPSDashboards.widgets.foldercontents'),
         doctest.DocFileTest('doc/developer/tabular_widget.txt',
                             package='Products.CPSDashboards'),
         ))
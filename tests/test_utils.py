@@ -20,6 +20,7 @@
 
 # testing module and harness
 import unittest
+from zope.testing import doctest
 
 # what we test
 from Products.CPSDashboards import utils
@@ -33,4 +34,7 @@ class UtilsTest(unittest.TestCase):
         self.assertEquals(res, {u'a': [], u'abc': u'\xe9'})
 
 def test_suite():
-    return unittest.TestSuite((unittest.makeSuite(UtilsTest),))
+    return unittest.TestSuite((
+        unittest.makeSuite(UtilsTest),
+        doctest.DocTestSuite('Products.CPSDashboards.utils'),
+        ))
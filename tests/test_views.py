@@ -24,10 +24,13 @@ import unittest
 from zope.testing import doctest
 from Products.CPSDefault.tests.CPSTestCase import CPSTestCase
 from Products.CPSDashboards.testing import FakeRequestWithCookies
+from Products.CPSDashboards.testing import FakeTransitionPortal
 from layer import CPSDashboardsLayer
+from test_batchjobs import ChunkTestCase
 
 # what we test
 from Products.CPSDashboards.browser.localrolesview import LocalRolesView
+from Products.CPSDashboards.browser.batchperformview import BatchPerformView
 
 class LocalRolesViewIntegrationTestCase(CPSTestCase):
     layer = CPSDashboardsLayer
@@ -47,9 +50,108 @@ class LocalRolesViewIntegrationTestCase(CPSTestCase):
 
         self.view.renderGroupsLayout()
 
+class BatchPerformViewIntegrationTestCase(CPSTestCase):
+    layer = CPSDashboardsLayer
+
+    def afterSetUp(self):
+        self.login('manager')
+        self.request = FakeRequestWithCookies()
+        self.view = BatchPerformView(self.portal.workspaces,
+                                     self.request).__of__(self.portal)
+
+    def test_filterMatchingRpaths(self):
+        wftool = self.portal.portal_workflow
+        wftool.invokeFactoryFor(self.portal.workspaces, 'News Item', 'batch_file')
+        proxy = self.portal.workspaces.batch_file
+        rpath = 'workspaces/batch_file'
+        filterRpaths = self.view._filterMatchingRpaths
+
+        wf = wftool.getWorkflowsFor(proxy)[0]
+        state = wftool.getInfoFor(proxy, wf.state_var)
+        self.assertEquals(wf.getId(), 'workspace_content_wf')
+        self.assertEquals(state, 'work')
+        supported = [tid for tid in wf.states[state].transitions
+                     if wf.isActionSupported(proxy, tid)]
+        self.assert_(supported)
+        transition = supported[0]
+
+        # catalog grouping
+        self.assertEquals(self.view._getCatalogInfos([rpath]),
+                          {rpath: ('News Item', state)})
+        self.assertEquals(filterRpaths('no_such_transition', [rpath]), [])
+        # duplicates are removed
+        self.assertEquals(filterRpaths(transition, [rpath, rpath]), [rpath])
+
+        # traversal fallback, for documents the catalog doesn't know of
+        self.portal.portal_catalog.unindexObject(proxy)
+        self.assertEquals(self.view._getCatalogInfos([rpath]), {})
+        self.assertEquals(filterRpaths('no_such_transition', [rpath]), [])
+        self.assertEquals(filterRpaths(transition, [rpath, rpath]), [rpath])
+
+    def test_getCatalogInfos_root(self):
+        # documents right under the portal are looked up in the portal
+        infos = self.view._getCatalogInfos(['workspaces'])
+        self.assertEquals(infos.keys(), ['workspaces'])
+
+class ChunkingBatchPerformView(BatchPerformView):
+    """Gives the psm back instead of redirecting."""
+
+    def _expireSession(self):
+        pass
+
+    def _doRedirect(self, psm):
+        return psm
+
+class BatchTriggerTransitionTest(ChunkTestCase):
+
+    def makeView(self, conflicts=0):
+        portal = FakeTransitionPortal(conflicts=conflicts)
+        portal.portal_url = portal
+        portal.translation_service = lambda msgid: u'Not done for: '
+        portal.default_charset = 'iso-8859-15'
+        view = ChunkingBatchPerformView(portal, FakeRequestWithCookies())
+        view.commit_chunk_size = 2
+        view.background_threshold = 0
+        view.rpaths = ['ws/a', 'ws/b', 'ws/c', 'ws/d', 'ws/e']
+        return view
+
+    def test_chunks(self):
+        view = self.makeView()
+        psm = view.batchTriggerTransition('publish')
+        self.assertEquals(psm, 'psm_status_changed')
+        self.assertEquals(self.getStatuses(view.getReport()), ['done'] * 5)
+        # one commit per chunk
+        self.assertEquals(self.transaction.commits, 3)
+
+    def test_chunks_retried(self):
+        # the first chunk gets two conflict errors
+        view = self.makeView(conflicts=2)
+        psm = view.batchTriggerTransition('publish')
+        self.assertEquals(psm, 'psm_status_changed')
+        self.assertEquals(self.getStatuses(view.getReport()),
+                          ['retried'] * 2 + ['done'] * 3)
+        self.assertEquals(self.transaction.commits, 3)
+        self.assertEquals(self.transaction.aborts, 2)
+        self.assertEquals(self.sleeps, [0.1, 0.2])
+
+    def test_chunks_failed(self):
+        # the first chunk is given up, the next ones are done
+        view = self.makeView(conflicts=4)
+        view.conflict_retries = 3
+        psm = view.batchTriggerTransition('publish')
+        self.assertEquals(self.getStatuses(view.getReport()),
+                          ['failed'] * 2 + ['done'] * 3)
+        self.assertEquals(psm, 'Not done for: Title of ws/a, Title of ws/b')
+        self.assertEquals(self.transaction.commits, 2)
+        self.assertEquals(self.transaction.aborts, 4)
+
 def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(LocalRolesViewIntegrationTestCase),
+        unittest.makeSuite(BatchPerformViewIntegrationTestCase),
+        unittest.makeSuite(BatchTriggerTransitionTest),
+        doctest.DocTestSuite(
+            'Products.CPSDashboards.browser.batchperformview'),
         doctest.DocFileTest('doc/developer/views.txt',
                             package='Products.CPSDashboards'),
         doctest.DocFileTest('doc/developer/searchview.txt',
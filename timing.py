@@ -0,0 +1,128 @@
+# (C) Copyright 2012 Nuxeo SAS <http://nuxeo.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# $Id$
+"""Timings of the rendering phases of widgets.
+
+Unlike CPSUtil's Timer, that logs a whole sequence of marks, timings are
+accumulated per phase, so that phases occurring once per row can be
+summed up, and are emitted both as a log line and a Server-Timing header.
+"""
+
+import re
+import logging
+from time import time
+
+logger = logging.getLogger('CPSDashboards.timing')
+
+SERVER_TIMING = 'Server-Timing'
+
+_unsafe_chars = re.compile(r'[^A-Za-z0-9_.-]')
+
+class PhaseTimer(object):
+    """Accumulate durations of named phases.
+
+    A fake clock for the example:
+
+    >>> class FakeClock:
+    ...     now = 0.0
+    ...     def __call__(self):
+    ...         return self.now
+    >>> clock = FakeClock()
+    >>> timer = PhaseTimer('the portlet', clock=clock)
+
+    ``mark()`` attributes the time elapsed since the previous mark to the
+    given phase:
+
+    >>> clock.now = 0.002
+    >>> timer.mark('buildFilters')
+    >>> clock.now = 0.012
+    >>> timer.mark('query')
+
+    Durations of a phase that occurs several times are summed up:
+
+    >>> for i in range(3):
+    ...     clock.now += 0.001
+    ...     timer.mark('rows')
+    >>> timer.getPhases()
+    [('buildFilters', 2.0), ('query', 10.0), ('rows', 3.0)]
+    >>> timer.getTotal()
+    15.0
+
+    Phases are emitted in the Server-Timing header format, prefixed by the
+    widget id, made safe for that:
+
+    >>> timer.getServerTiming()
+    'the_portlet.buildFilters;dur=2.0, the_portlet.query;dur=10.0, the_portlet.rows;dur=3.0, the_portlet.total;dur=15.0'
+
+    and as a log line made of key=value pairs:
+
+    >>> timer.getLogLine()
+    'widget=the_portlet total=15.0 buildFilters=2.0 query=10.0 rows=3.0'
+    """
+
+    def __init__(self, widget_id, clock=time):
+        self.widget_id = _unsafe_chars.sub('_', widget_id)
+        self._clock = clock
+        self._start = self._last = clock()
+        self._phases = [] # ordered phase names
+        self._durations = {}
+
+    def mark(self, phase):
+        """Attribute time elapsed since last mark to phase."""
+        now = self._clock()
+        if phase not in self._durations:
+            self._phases.append(phase)
+            self._durations[phase] = 0.0
+        self._durations[phase] += now - self._last
+        self._last = now
+
+    def getPhases(self):
+        """Return the list of (phase, duration in milliseconds)."""
+        return [(phase, round(self._durations[phase] * 1000, 2))
+                for phase in self._phases]
+
+    def getTotal(self):
+        """Return the total duration in milliseconds."""
+        return round((self._last - self._start) * 1000, 2)
+
+    def getServerTiming(self):
+        """Return a value for the Server-Timing HTTP header."""
+        wid = self.widget_id
+        metrics = ['%s.%s;dur=%s' % (wid, phase, dur)
+                   for phase, dur in self.getPhases()]
+        metrics.append('%s.total;dur=%s' % (wid, self.getTotal()))
+        return ', '.join(metrics)
+
+    def getLogLine(self):
+        """Return a log line made of key=value pairs."""
+        items = ['widget=%s' % self.widget_id, 'total=%s' % self.getTotal()]
+        items.extend(['%s=%s' % (phase, dur)
+                      for phase, dur in self.getPhases()])
+        return ' '.join(items)
+
+    def emit(self, response=None):
+        """Log timings and add them to the Server-Timing header of response.
+        """
+        logger.info(self.getLogLine())
+        if response is None:
+            return
+        value = self.getServerTiming()
+        previous = response.getHeader(SERVER_TIMING)
+        if previous:
+            # several widgets on the same page
+            value = '%s, %s' % (previous, value)
+        response.setHeader(SERVER_TIMING, value)
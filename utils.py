@@ -19,10 +19,26 @@
 #$Id$
 
 import base64
+import hmac
+import logging
 
+try:
+    from hashlib import sha1
+except ImportError: # python < 2.5
+    import sha as sha1
 
+try:
+    import json as std_json # python >= 2.6
+except ImportError:
+    std_json = None
+
+from DateTime import DateTime
+
+from Products.CMFCore.utils import getToolByName
 from Products.CPSUtil import minjson as json
 
+logger = logging.getLogger('CPSDashboards.utils')
+
 # based on CPSSkins versions, but can handle non ascii-chars
 # here not to break possible CPSSkins assumptions
 
@@ -60,3 +76,270 @@ def unserializeFromCookie(string='', default=None, charset='ascii'):
         pass
 
     return value
+
+# compact cookie format, see encodeCookie()
+COOKIE_VERSION = 'v1'
+DATE_TAG = '$d'
+SIGNATURE_LENGTH = 20
+
+# conversions for minjson, the standard json module has hooks for that
+
+def _toJson(obj, charset):
+    """Convert obj for JSON: unicode strings, DateTime as tagged dicts."""
+    if isinstance(obj, str):
+        return obj.decode(charset)
+    if isinstance(obj, DateTime):
+        return {DATE_TAG: obj.timeTime()}
+    if isinstance(obj, dict):
+        return dict((_toJson(k, charset), _toJson(v, charset))
+                    for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [_toJson(v, charset) for v in obj]
+    return obj
+
+def _fromJson(obj):
+    """Reverse of _toJson, except that strings stay unicode."""
+    if isinstance(obj, dict):
+        if len(obj) == 1 and DATE_TAG in obj:
+            return DateTime(obj[DATE_TAG])
+        return dict((k, _fromJson(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [_fromJson(v) for v in obj]
+    return obj
+
+def _jsonDefault(obj):
+    if isinstance(obj, DateTime):
+        return {DATE_TAG: obj.timeTime()}
+    raise TypeError(repr(obj))
+
+def _jsonObjectHook(obj):
+    if len(obj) == 1 and DATE_TAG in obj:
+        return DateTime(obj[DATE_TAG])
+    return obj
+
+def _dumps(obj, charset):
+    """Return a compact JSON string, encoded in UTF-8."""
+    if std_json is not None:
+        string = std_json.dumps(obj, separators=(',', ':'), encoding=charset,
+                                default=_jsonDefault)
+    else:
+        string = json.write(_toJson(obj, charset))
+    if isinstance(string, unicode):
+        string = string.encode('utf-8')
+    return string
+
+def _loads(string):
+    string = string.decode('utf-8')
+    if std_json is not None:
+        return std_json.loads(string, object_hook=_jsonObjectHook)
+    return _fromJson(json.read(string))
+
+def _sign(value, secret):
+    return hmac.new(secret, value, sha1).hexdigest()[:SIGNATURE_LENGTH]
+
+def _equals(a, b):
+    """String comparison in constant time, for signatures."""
+    if len(a) != len(b):
+        return False
+    diff = 0
+    for x, y in zip(a, b):
+        diff |= ord(x) ^ ord(y)
+    return diff == 0
+
+def encodeCookie(obj, charset='ascii', secret=None):
+    """Encode a python data structure for a cookie, in the compact format.
+
+    This supersedes serializeForCookie: the JSON is compact, the base64
+    encoding is URL safe without padding nor newlines, and DateTime
+    objects are supported. Strings are decoded according to charset.
+    If a secret is provided, the value is signed (HMAC-SHA1).
+
+    The value is prefixed by the format version:
+
+    >>> cookie = encodeCookie({'q_one': 'value'})
+    >>> cookie[:3], '=' in cookie
+    ('v1.', False)
+    >>> decodeCookie(cookie)
+    {u'q_one': u'value'}
+
+    DateTime objects are kept, with timezone conversion to local time:
+
+    >>> cookie = encodeCookie({'q_from': DateTime('2012/01/21 15:00 GMT')})
+    >>> decodeCookie(cookie)['q_from'].timeTime()
+    1327158000.0
+
+    Non ascii strings:
+
+    >>> decodeCookie(encodeCookie({'q_acc': '\\xe9'}, charset='iso-8859-15'))
+    {u'q_acc': u'\\xe9'}
+
+    Signed values. Tampered or unsigned ones are rejected:
+
+    >>> cookie = encodeCookie({'q_one': 'value'}, secret='s3cr3t')
+    >>> decodeCookie(cookie, secret='s3cr3t')
+    {u'q_one': u'value'}
+    >>> cookie = encodeCookie({'q_one': 'forged'}) + cookie[-21:]
+    >>> decodeCookie(cookie, default='rejected', secret='s3cr3t')
+    'rejected'
+
+    Values in the former format are still read:
+
+    >>> decodeCookie(serializeForCookie({'q_one': 'value'}))
+    {u'q_one': u'value'}
+    """
+    if charset == 'unicode':
+        charset = 'utf-8'
+    payload = base64.urlsafe_b64encode(_dumps(obj, charset))
+    value = '%s.%s' % (COOKIE_VERSION, payload.rstrip('='))
+    if secret:
+        value = '%s.%s' % (value, _sign(value, secret))
+    return value
+
+def decodeCookie(string='', default=None, charset='ascii', secret=None):
+    """Decode a cookie value made by encodeCookie or serializeForCookie.
+
+    Strings are returned as unicode, as with unserializeFromCookie. The
+    charset is used for values in the former format only. If a secret is
+    provided, values that aren't properly signed give the default, and so
+    do values that can't be decoded.
+    """
+    if not string:
+        return default
+    if not string.startswith(COOKIE_VERSION + '.'):
+        if secret:
+            return default
+        return unserializeFromCookie(string=string, default=default,
+                                     charset=charset)
+
+    parts = string.split('.')
+    if len(parts) not in (2, 3):
+        return default
+    if secret:
+        signed = '.'.join(parts[:2])
+        if len(parts) != 3 or not _equals(parts[2], _sign(signed, secret)):
+            logger.warn("Rejected cookie value with a wrong signature")
+            return default
+
+    payload = parts[1]
+    payload += '=' * (-len(payload) % 4)
+    try:
+        return _loads(base64.urlsafe_b64decode(payload))
+    except Exception:
+        # cookie values come from the browser, anything can happen
+        return default
+
+# keys of request memos in REQUEST.other
+REQUEST_TOOLS = '_cpsdashboards_tools'
+REQUEST_TRANSLATIONS = '_cpsdashboards_translations'
+
+def getRequestMemo(context, key):
+    """Return a dict stored in the request for key, or None if no request.
+    """
+    request = getattr(context, 'REQUEST', None)
+    other = getattr(request, 'other', None)
+    if not isinstance(other, dict):
+        return None
+    memo = other.get(key)
+    if memo is None:
+        memo = other[key] = {}
+    return memo
+
+def getRequestTool(context, name):
+    """Same as getToolByName, memoized for the duration of the request.
+
+    Row widgets look up the same tools for each row. Acquisition of a tool
+    from deep within a widget is not free, hence this memo.
+
+    >>> class FakeRequest:
+    ...     def __init__(self):
+    ...         self.other = {}
+    >>> class FakeContext:
+    ...     REQUEST = FakeRequest()
+    ...     portal_url = 'the url tool'
+    >>> context = FakeContext()
+    >>> getRequestTool(context, 'portal_url')
+    'the url tool'
+    >>> context.portal_url = 'another url tool'
+    >>> getRequestTool(context, 'portal_url')
+    'the url tool'
+
+    Without a request, this is getToolByName:
+
+    >>> FakeContext.REQUEST = None
+    >>> getRequestTool(context, 'portal_url')
+    'another url tool'
+    """
+    tools = getRequestMemo(context, REQUEST_TOOLS)
+    if tools is None:
+        return getToolByName(context, name)
+    tool = tools.get(name)
+    if tool is None:
+        tool = tools[name] = getToolByName(context, name)
+    return tool
+
+class MemoTranslator(object):
+    """Call the translation service, memoizing plain message ids.
+
+    Calls with a mapping or any other parameter, and message objects (they
+    may carry a mapping and a default) are not memoized.
+    """
+
+    def __init__(self, translator, memo):
+        self._translator = translator
+        self._memo = memo
+
+    def __call__(self, msgid, *args, **kw):
+        if args or kw or type(msgid) not in (str, unicode):
+            return self._translator(msgid, *args, **kw)
+        try:
+            return self._memo[msgid]
+        except KeyError:
+            translated = self._memo[msgid] = self._translator(msgid)
+            return translated
+
+    def __getattr__(self, name):
+        return getattr(self._translator, name)
+
+def getTranslator(context):
+    """Return the translation service, memoized for the request.
+
+    >>> class FakeTranslationService:
+    ...     calls = 0
+    ...     def __call__(self, msgid, mapping=None):
+    ...         self.calls += 1
+    ...         return msgid.upper()
+    ...     def getSelectedLanguage(self):
+    ...         return 'en'
+    >>> class FakeRequest:
+    ...     def __init__(self):
+    ...         self.other = {}
+    >>> class FakeContext:
+    ...     REQUEST = FakeRequest()
+    ...     translation_service = FakeTranslationService()
+    >>> cpsmcat = getTranslator(FakeContext())
+    >>> cpsmcat('label_yes'), cpsmcat('label_yes')
+    ('LABEL_YES', 'LABEL_YES')
+    >>> FakeContext.translation_service.calls
+    1
+
+    The memo is shared by all callers within the request:
+
+    >>> getTranslator(FakeContext())('label_yes')
+    'LABEL_YES'
+    >>> FakeContext.translation_service.calls
+    1
+
+    Calls with a mapping are passed through, as well as other attributes:
+
+    >>> cpsmcat('label_yes', mapping={})
+    'LABEL_YES'
+    >>> FakeContext.translation_service.calls
+    2
+    >>> cpsmcat.getSelectedLanguage()
+    'en'
+    """
+    translator = getRequestTool(context, 'translation_service')
+    memo = getRequestMemo(context, REQUEST_TRANSLATIONS)
+    if memo is None:
+        return translator
+    return MemoTranslator(translator, memo)
@@ -21,16 +21,21 @@
 """ Catalog Tabular Widgets. """
 
 import logging
+import base64
 from copy import deepcopy
 
 from Globals import InitializeClass
+from DateTime import DateTime
 from AccessControl import Unauthorized
 from AccessControl import getSecurityManager
+from ZPublisher.Converters import type_converters
 from ZODB.loglevels import TRACE as TRACE
 
 from Products.CMFCore.utils import _checkPermission, getToolByName
 from Products.CMFCore.permissions import View, ListFolderContents
 
+from Products.CPSUtil import minjson as json
+
 from Products.CPSSchemas.Widget import CPSWidget
 from Products.CPSSchemas.Widget import widgetRegistry
 from Products.CPSSchemas.DataModel import DataModel
@@ -38,10 +43,86 @@ from Products.CPSSchemas.DataStructure import DataStructure
 from Products.CPSSchemas.BasicWidgets import renderHtmlTag
 
 from Products.CPSDashboards.braindatamodel import BrainDataModel
+from Products.CPSDashboards.cache import LRUCache, fingerprint
+from Products.CPSDashboards.cache import getCatalogGeneration
+from Products.CPSDashboards.query import normalizeQuery, queryFingerprint
 from Products.CPSDashboards.widgets.tabular import TabularWidget
 
 logger = logging.getLogger('CPSDashboards.widgets.catalog')
 
+# keys in catalog queries that are about sorting
+SORT_ON_KEYS = ('sort_on', 'sort-on')
+SORT_KEYS = SORT_ON_KEYS + ('sort_order', 'sort-order',
+                            'sort_limit', 'sort-limit')
+
+# Process wide cache of catalog results, as (record ids, total number).
+# Keys are computed by CatalogTabularWidget.getResultsCacheKey()
+# The time to live bounds staleness of time dependent queries
+# (e.g., effective dates).
+RESULTS_CACHE = LRUCache(max_entries=500, max_size=2000000,
+                         sizeof=lambda v: len(v[0]), ttl=300)
+
+# Last known number of results of Lucene queries, by user and query
+# fingerprint. Used to jump directly to the last page.
+OUT_OF_CACHE = LRUCache(max_entries=5000, sizeof=lambda v: 1, ttl=3600)
+
+# keys computed by BrainDataModel without fetching objects
+BRAIN_COMPUTED_KEYS = ('rpath', 'url')
+
+# properties whose changes trigger the check of brain only mode
+BRAIN_ONLY_PROPS = ('row_layout', 'brain_only', 'brain_only_defaults')
+
+# suffix of the form key carrying the keyset (seek) token
+SEEK_SUFFIX = '_after'
+
+def encodeSeekToken(page, query_fp, value, path, charset='ascii'):
+    """Encode what's needed to seek the given page after (value, path).
+
+    The result is safe for URLs. DateTime values are supported."""
+    if isinstance(value, DateTime):
+        value = {'DateTime': value.timeTime()}
+    string = json.write([page, query_fp, value, path])
+    if isinstance(string, unicode):
+        string = string.encode(charset)
+    return base64.urlsafe_b64encode(string)
+
+def decodeSeekToken(token, charset='ascii'):
+    """Return (page, query fingerprint, sort value, path) or None."""
+    try:
+        data = json.read(base64.urlsafe_b64decode(token).decode(charset))
+        page, query_fp, value, path = data
+        if isinstance(value, dict):
+            value = DateTime(value['DateTime'])
+        elif isinstance(value, unicode):
+            value = value.encode(charset)
+        return int(page), str(query_fp), value, path.encode(charset)
+    except Exception:
+        # tokens come from URLs, minjson may raise about anything
+        return None
+
+def queryCatalog(catalog, query, sort_limit=None):
+    """Return results and total number of results.
+
+    With sort_limit, the results are truncated, and the total number
+    is either provided by the catalog or computed with an unsorted query,
+    that's much cheaper.
+    """
+    if sort_limit is None:
+        brains = catalog(**query)
+        return brains, len(brains)
+
+    query['sort_limit'] = sort_limit
+    brains = catalog(**query)
+    nb_results = getattr(brains, 'actual_result_count', None)
+    if nb_results is None:
+        if len(brains) < sort_limit:
+            nb_results = len(brains)
+        else:
+            count_query = dict((k, v) for k, v in query.items()
+                               if k not in SORT_KEYS)
+            nb_results = len(catalog(**count_query))
+    return brains, nb_results
+
 class CatalogTabularWidget(TabularWidget):
     """ A tabular portlet widget that performs a catalog query.
 
@@ -68,6 +149,17 @@ class CatalogTabularWidget(TabularWidget):
          'label': "Suffix for widget ids that encode a min range bound",},
         {'id': 'range_max_suffix', 'type': 'string', 'mode': 'w',
          'label': "Suffix for widget ids that encode a max range bound",},
+        {'id': 'cache_results', 'type': 'boolean', 'mode': 'w',
+         'label': "Cache results across requests (until catalog changes)",},
+        {'id': 'use_sort_limit', 'type': 'boolean', 'mode': 'w',
+         'label': "Sort results up to the displayed page only",},
+        {'id': 'keyset_pagination', 'type': 'boolean', 'mode': 'w',
+         'label': "Next page links seek from the last displayed row",},
+        {'id': 'brain_only', 'type': 'boolean', 'mode': 'w',
+         'label': "Rows must be rendered from catalog metadata only",},
+        {'id': 'brain_only_defaults', 'type': 'lines', 'mode': 'w',
+         'label': "Defaults for missing metadata in brain only mode "
+         "(key=value)",},
         )
 
     # support for more than one full text index.
@@ -77,12 +169,142 @@ class CatalogTabularWidget(TabularWidget):
     users_groups_filters = ()
     range_min_suffix = "_min"
     range_max_suffix = "_max"
+    cache_results = False
+    use_sort_limit = True
+    keyset_pagination = False
+    brain_only = False
+    brain_only_defaults = ()
+
+    _v_next_seek = None
 
     layout_row_view = TabularWidget.table_layout_row_view
 
     def getMethodContext(self, datastructure):
         return self
 
+    def manage_changeProperties(self, REQUEST=None, **kw):
+        """Change properties and check row layout against catalog metadata.
+        """
+        props = {}
+        if REQUEST is not None:
+            for prop in BRAIN_ONLY_PROPS:
+                if REQUEST.has_key(prop):
+                    props[prop] = REQUEST[prop]
+        props.update(kw)
+        self.checkBrainOnlyChanges(props)
+        return TabularWidget.manage_changeProperties(self, REQUEST=REQUEST,
+                                                     **kw)
+
+    def manage_editProperties(self, REQUEST):
+        """Edit properties and check row layout against catalog metadata.
+        """
+        # the ZMI form omits unchecked checkboxes and empty fields
+        self.checkBrainOnlyChanges(REQUEST, missing='')
+        return TabularWidget.manage_editProperties(self, REQUEST)
+
+    def getBrainOnlyDefaults(self, lines=None):
+        """Return the dict of defaults for missing metadata.
+
+        lines defaults to the brain_only_defaults property."""
+        if lines is None:
+            lines = self.brain_only_defaults
+        defaults = {}
+        for line in lines:
+            key, value = (line.split('=', 1) + [''])[:2]
+            defaults[key.strip()] = value.strip()
+        return defaults
+
+    def checkRowLayoutMetadata(self, layout=None, catalog=None,
+                               row_layout=None, defaults=None):
+        """Return the list of (widget id, field) that aren't catalog metadata.
+
+        These would need the object to be fetched for each row. Fields
+        having a default in brain only mode are not reported. Nothing can be
+        checked if the row layout is not in the layouts tool, or outside of
+        a portal. row_layout and defaults (a dict) default to the ones of the
+        widget.
+        """
+        if layout is None:
+            if row_layout is None:
+                row_layout = self.row_layout
+            ltool = getToolByName(self, 'portal_layouts', None)
+            if ltool is None:
+                return []
+            layout = ltool._getOb(row_layout, None)
+            if layout is None:
+                return []
+        if catalog is None:
+            catalog = getToolByName(self, 'portal_catalog', None)
+            if catalog is None:
+                return []
+        if defaults is None:
+            defaults = self.getBrainOnlyDefaults()
+
+        available = set(catalog.schema())
+        available.update(BRAIN_COMPUTED_KEYS)
+        available.update(defaults)
+
+        missing = []
+        for wid, widget in layout.items():
+            for field in getattr(widget, 'fields', ()):
+                if field and field != '?' and field not in available:
+                    missing.append((wid, field))
+        return missing
+
+    def checkBrainOnly(self, row_layout=None, brain_only=None,
+                       brain_only_defaults=None):
+        """Report fields of the row layout that aren't catalog metadata.
+
+        In brain only mode, this is a configuration error. Arguments
+        default to the properties of the widget.
+        """
+        if row_layout is None:
+            row_layout = self.row_layout
+        if brain_only is None:
+            brain_only = self.brain_only
+        missing = self.checkRowLayoutMetadata(
+            row_layout=row_layout,
+            defaults=self.getBrainOnlyDefaults(brain_only_defaults))
+        if not missing:
+            return
+        msg = "Row layout %r of widget %r uses non metadata fields: %s" % (
+            row_layout, self.getWidgetId(),
+            ', '.join(['%s (%s)' % m for m in missing]))
+        if brain_only:
+            raise ValueError(msg)
+        logger.warning(msg)
+
+    def checkBrainOnlyChanges(self, props, missing=None):
+        """Check the configuration that would result of changing props.
+
+        To be called before the properties are applied, so that the widget
+        is left untouched by an invalid change. Nothing is checked unless
+        one of BRAIN_ONLY_PROPS is changed. Properties that aren't in props
+        are unchanged, or set to missing if it isn't None.
+        """
+        values = {}
+        changed = False
+        for prop in BRAIN_ONLY_PROPS:
+            current = getattr(self, prop)
+            value = props.get(prop, missing)
+            if value is None:
+                values[prop] = current
+                continue
+            if isinstance(value, str):
+                converter = type_converters.get(self.getPropertyType(prop))
+                if converter is not None:
+                    value = converter(value)
+            if prop == 'brain_only':
+                value = bool(value)
+            elif prop == 'brain_only_defaults':
+                value = tuple(value)
+                current = tuple(current)
+            values[prop] = value
+            if value != current:
+                changed = True
+        if changed:
+            self.checkBrainOnly(**values)
+
     def filtersToQuery(self, filters):
         """Updates dict to build a query from filters.
 
@@ -165,18 +387,241 @@ class CatalogTabularWidget(TabularWidget):
             path = '%s/%s' % (portal_path, path)
         filters['path'] = path
 
+    def getQueryCacheKey(self, query):
+        """Return a canonical hashable form of query, for cache keys."""
+        return normalizeQuery(query, fulltext_keys=self.fulltext_keys)
+
+    def getQueryFingerprint(self, query):
+        """Return a stable digest of query, for logs and metrics."""
+        return queryFingerprint(query, fulltext_keys=self.fulltext_keys)
+
+    def getResultsCacheKey(self, catalog, query):
+        """Return the key for results of query in RESULTS_CACHE.
+
+        Catalog results depend on the current user's roles and groups, and
+        of course on the catalog generation.
+        """
+        user = getSecurityManager().getUser()
+        listAllowed = getattr(catalog, '_listAllowedRolesAndUsers', None)
+        if listAllowed is None:
+            allowed = [user.getId()]
+        else:
+            allowed = list(listAllowed(user))
+            allowed.sort()
+
+        return ('/'.join(catalog.getPhysicalPath()),
+                getCatalogGeneration(catalog),
+                fingerprint(*allowed),
+                self.getQueryCacheKey(query))
+
+    def _extractRids(self, brains):
+        """Return the list of record ids for brains.
+
+        Avoids instantiating all brains if they are lazily built from rids.
+        """
+        seq = getattr(brains, '_seq', None)
+        if seq is not None and len(seq) == len(brains):
+            rids = list(seq)
+            if not rids or isinstance(rids[0], int):
+                return rids
+        return [brain.getRID() for brain in brains]
+
+    def getSortLimit(self, query, b_start, b_size):
+        """Return the sort limit to pass to the catalog, or None.
+
+        Sorted queries need to be sorted up to the end of the current page
+        only. ZCatalog then does a partial sort (using a heap).
+        """
+        if not self.use_sort_limit:
+            return None
+        for key in SORT_ON_KEYS:
+            if query.get(key):
+                return b_start + b_size
+        return None
+
+    def _queryCatalog(self, catalog, query, sort_limit=None):
+        """Return results and total number of results (see queryCatalog).
+        """
+        return queryCatalog(catalog, query, sort_limit=sort_limit)
+
+    def _clampStart(self, b_start, b_size, nb_results):
+        """Switch to last page in case of out-of-range b_start."""
+        if nb_results and b_start >= nb_results:
+            b_page = self.getNbPages(nb_results, items_per_page=b_size)
+            b_start = b_size * (b_page - 1)
+        return b_start
+
+    def _doCachedBatchedQuery(self, catalog, b_start, b_size, query):
+        """Same as _doBatchedQuery, working on cached record ids.
+
+        In case of limited sort, cached record ids may not go far enough for
+        the requested page, in which case the query is issued again.
+        """
+
+        key = self.getResultsCacheKey(catalog, query)
+        cached = RESULTS_CACHE.get(key)
+        if cached is not None:
+            rids, nb_results = cached
+            b_start = self._clampStart(b_start, b_size, nb_results)
+            if len(rids) < min(b_start + b_size, nb_results):
+                logger.debug("Not enough sorted results in cache for %r", key)
+                cached = None
+            else:
+                logger.debug("Found results in cache for %r", key)
+
+        if cached is None:
+            sort_limit = self.getSortLimit(query, b_start, b_size)
+            brains, nb_results = self._queryCatalog(catalog, query,
+                                                    sort_limit=sort_limit)
+            rids = self._extractRids(brains)
+            RESULTS_CACHE.set(key, (rids, nb_results))
+            b_start = self._clampStart(b_start, b_size, nb_results)
+
+        getBrain = catalog._catalog.__getitem__
+        brains = []
+        for rid in rids[b_start:b_start+b_size]:
+            try:
+                brains.append(getBrain(rid))
+            except KeyError:
+                # uncataloged in the current transaction
+                pass
+        return brains, nb_results, b_start
+
     def _doBatchedQuery(self, catalog, b_start, b_size, query):
         """ Return batched results, total number of results.
 
         query will be changed to what was actually sent to the catalog."""
 
-        brains = catalog(**query)
-        nb_results = len(brains)
-        if nb_results and b_start >= nb_results:
-            # out-of-range: let's switch to last page
-            b_page = self.getNbPages(nb_results)
-            b_start = b_size * (b_page - 1)
-        return brains[b_start:b_start+b_size], len(brains), b_start
+        if self.cache_results:
+            return self._doCachedBatchedQuery(catalog, b_start, b_size, query)
+
+        sort_limit = self.getSortLimit(query, b_start, b_size)
+        brains, nb_results = self._queryCatalog(catalog, query,
+                                                sort_limit=sort_limit)
+        # out-of-range pages are before the limit, no need to query again
+        b_start = self._clampStart(b_start, b_size, nb_results)
+        return brains[b_start:b_start+b_size], nb_results, b_start
+
+    def getKeysetSort(self, query):
+        """Return (sort index, reverse) if keyset pagination applies to query.
+
+        Keyset pagination needs a single sort index, that's not also used
+        to filter. It's pointless if results are cached.
+        """
+        if not self.keyset_pagination or self.cache_results:
+            return None
+        sort_on = query.get('sort_on') or query.get('sort-on')
+        if not isinstance(sort_on, basestring) or sort_on in query:
+            return None
+        order = query.get('sort_order') or query.get('sort-order') or ''
+        return sort_on, order.lower() in ('reverse', 'descending')
+
+    def readSeekToken(self, datastructure, b_page, query_fp):
+        """Return (sort value, path) to seek from, if the request has it.
+
+        Tokens meant for another page or another query are ignored.
+        """
+        token = datastructure.get(self.getWidgetId() + SEEK_SUFFIX)
+        if not token:
+            return None
+        decoded = decodeSeekToken(token, charset=self.default_charset)
+        if decoded is None:
+            logger.debug("Malformed seek token %r", token)
+            return None
+        page, token_fp, value, path = decoded
+        if page != b_page or token_fp != query_fp:
+            return None
+        return value, path
+
+    def makeSeekToken(self, b_page, query_fp, sort_on, brain):
+        """Return the token to seek page b_page from brain, or None.
+
+        The sort index must be also a metadata column for this to work."""
+        value = getattr(brain, sort_on, None)
+        if callable(value):
+            value = value()
+        if value is None:
+            return None
+        return encodeSeekToken(b_page, query_fp, value, brain.getPath(),
+                               charset=self.default_charset)
+
+    def _fetchKeysetRows(self, catalog, query, keyset_sort, needed,
+                         keep=None):
+        """Return (sort value, path, brain) rows in keyset order.
+
+        Rows are sorted by sort value, then by path, whatever the order in
+        which the catalog returns documents having the same sort value.
+        The sort limit is raised until the group of rows having the same
+        sort value as the needed-th one is complete. keep is an optional
+        predicate that rows must satisfy.
+        """
+        sort_on, reverse = keyset_sort
+        query = query.copy()
+        limit = needed + max(needed, 10)
+        while True:
+            query['sort_limit'] = limit
+            brains = catalog(**query)
+            rows = [(getattr(brain, sort_on, None), brain.getPath(), brain)
+                    for brain in brains]
+            rows.sort(reverse=reverse)
+            if keep is not None:
+                rows = [row for row in rows if keep(row)]
+            if len(brains) < limit or (
+                len(rows) > needed and rows[needed-1][0] != rows[-1][0]):
+                return rows
+            limit *= 2
+
+    def _doKeysetOffsetQuery(self, catalog, b_start, b_size, query,
+                             keyset_sort):
+        """Return results, total number of results and b_start.
+
+        Same as _doBatchedQuery, except that documents are in keyset order
+        (see _fetchKeysetRows), so that the token of the page designates
+        the same boundary as the page displays.
+        """
+        count_query = dict((k, v) for k, v in query.items()
+                           if k not in SORT_KEYS)
+        nb_results = len(catalog(**count_query))
+        b_start = self._clampStart(b_start, b_size, nb_results)
+        rows = self._fetchKeysetRows(catalog, query, keyset_sort,
+                                     b_start + b_size)
+        brains = [row[2] for row in rows[b_start:b_start+b_size]]
+        return brains, nb_results, b_start
+
+    def _doKeysetBatchedQuery(self, catalog, b_start, b_size, query,
+                              keyset_sort, seek):
+        """Return results after seek, total number of results and b_start.
+
+        Instead of sorting and slicing results up to b_start, results are
+        looked for with a range query from the seek value on. Paths break
+        ties among results having the same sort value. The total number of
+        results is computed by an unsorted query, which is much cheaper.
+
+        Return None if the page can't be computed that way, e.g., if items
+        got removed so that b_start is out of range.
+        """
+        sort_on, reverse = keyset_sort
+        seek_value, seek_path = seek
+
+        count_query = dict((k, v) for k, v in query.items()
+                           if k not in SORT_KEYS)
+        nb_results = len(catalog(**count_query))
+        if b_start >= nb_results:
+            return None
+
+        seek_query = query.copy()
+        if reverse:
+            seek_query[sort_on] = {'query': seek_value, 'range': 'max'}
+            keep = lambda row: row[:2] < (seek_value, seek_path)
+        else:
+            seek_query[sort_on] = {'query': seek_value, 'range': 'min'}
+            keep = lambda row: row[:2] > (seek_value, seek_path)
+
+        rows = self._fetchKeysetRows(catalog, seek_query, keyset_sort, b_size,
+                                     keep=keep)
+        if not rows:
+            return None
+        return [row[2] for row in rows[:b_size]], nb_results, b_start
 
     def listRowDataStructures(self, datastructure, layout, filters=None, **kw):
         """Return datastructures holding search results meta-data & batch info.
@@ -190,22 +635,56 @@ class CatalogTabularWidget(TabularWidget):
         query = filters
         self.filtersToQuery(query)
         (b_page, b_start, b_size) = self.getBatchParams(datastructure, filters=filters)
-
-        logger.log(TRACE, query)
-        brains, nb_results, b_start = self._doBatchedQuery(
-            catalog, b_start, b_size, query)
+        self.markPhase('filtersToQuery')
+
+        if logger.isEnabledFor(TRACE):
+            logger.log(TRACE, "query %s: %r",
+                       self.getQueryFingerprint(query), query)
+
+        self._v_next_seek = None
+        keyset_sort = self.getKeysetSort(query)
+        result = None
+        if keyset_sort is not None:
+            query_fp = self.getQueryFingerprint(query)
+            seek = self.readSeekToken(datastructure, b_page, query_fp)
+            if seek is not None:
+                result = self._doKeysetBatchedQuery(catalog, b_start, b_size,
+                                                    query, keyset_sort, seek)
+            if result is None:
+                result = self._doKeysetOffsetQuery(catalog, b_start, b_size,
+                                                   query, keyset_sort)
+        if result is None:
+            result = self._doBatchedQuery(catalog, b_start, b_size, query)
+        brains, nb_results, b_start = result
+        self.markPhase('query')
 
         b_page = 1 + b_start / b_size # might have changed
         nb_pages = self.getNbPages(nb_results, items_per_page=b_size)
+        if keyset_sort is not None and b_page < nb_pages and brains:
+            self._v_next_seek = self.makeSeekToken(b_page + 1, query_fp,
+                                                   keyset_sort[0], brains[-1])
         logger.debug("CatalogTabularWidget: "
                      "%d results, %d pages (current %d)" % (nb_results,
                                                             nb_pages,
                                                             b_page))
 
-        dms = (BrainDataModel(brain) for brain in brains)
+        if self.brain_only:
+            defaults = self.getBrainOnlyDefaults()
+            dms = (BrainDataModel(brain, strict=True, defaults=defaults)
+                   for brain in brains)
+        else:
+            dms = (BrainDataModel(brain) for brain in brains)
         datastructures = (DataStructure(datamodel=dm) for dm in dms)
-        return ([self.prepareRowDataStructure(layout, ds)
-                 for ds in datastructures], b_page, nb_pages)
+        row_dss = self.prepareRowDataStructures(layout, datastructures)
+        self.markPhase('prepare')
+        return row_dss, b_page, nb_pages
+
+    def getBatchingInfo(self, current_page, nb_pages):
+        """Add the keyset token for the next page, if any."""
+        info = TabularWidget.getBatchingInfo(self, current_page, nb_pages)
+        info['next_page_seek'] = self._v_next_seek
+        info['seek_key'] = self.getHtmlWidgetId() + SEEK_SUFFIX
+        return info
 
 InitializeClass(CatalogTabularWidget)
 
@@ -216,10 +695,54 @@ class LuceneTabularWidget(CatalogTabularWidget):
 
     meta_type = 'Lucene Tabular Widget'
 
+    def getKeysetSort(self, query):
+        """Lucene does its own batching. No keyset pagination."""
+        return None
+
+    def getOutOfKey(self, query):
+        """Return the key for the known number of results of query."""
+        user = getSecurityManager().getUser()
+        return (user.getId(), self.getQueryFingerprint(query))
+
     def _doBatchedQuery(self, catalog, b_start, b_size, query):
         """ Return batched results, total number of results.
 
-        query will be changed to what wbas actually sent to the catalog."""
+        query will be changed to what was actually sent to the catalog.
+
+        The last known number of results for the query is used to switch
+        directly to the last page in case of out-of-range requests. If the
+        catalog provides the clampedSearchResults method, that takes care of
+        out-of-range requests by itself, a single request is issued anyway.
+        """
+
+        key = self.getOutOfKey(query)
+        req_start = b_start
+        known_out_of = OUT_OF_CACHE.get(key)
+        if known_out_of is not None:
+            b_start = self._clampStart(b_start, b_size, known_out_of)
+
+        clamped_search = getattr(catalog, 'clampedSearchResults', None)
+        if clamped_search is not None:
+            query['b_start'] = b_start
+            query['b_size'] = b_size
+            brains, nb_results, b_start = clamped_search(**deepcopy(query))
+            query['b_start'] = b_start
+        else:
+            brains, nb_results, b_start = self._doLuceneBatchedQuery(
+                catalog, b_start, b_size, query)
+
+        if b_start < req_start and req_start < nb_results:
+            # the number of results has grown since it's been remembered
+            logger.debug("Known number of results %s was wrong",
+                         known_out_of)
+            brains, nb_results, b_start = self._doLuceneBatchedQuery(
+                catalog, req_start, b_size, query)
+
+        OUT_OF_CACHE.set(key, nb_results)
+        return brains, nb_results, b_start
+
+    def _doLuceneBatchedQuery(self, catalog, b_start, b_size, query):
+        """Query catalog, issuing further requests if out-of-range."""
 
         query['b_start'] = b_start
         query['b_size'] = b_size
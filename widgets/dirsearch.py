@@ -23,6 +23,7 @@
 import logging
 
 from Globals import InitializeClass
+from Acquisition import aq_base
 from AccessControl import Unauthorized
 
 from Products.CMFCore.utils import _checkPermission, getToolByName
@@ -39,6 +40,78 @@ from Products.CPSDashboards.widgets.tabular import TabularWidget
 
 logger = logging.getLogger('CPSDashBoards.widgets.dirsearch')
 
+class EntryRecord(object):
+    """A directory entry, as returned by a search with return_fields.
+
+    Meant to be wrapped in a BrainDataModel. Fields that were not returned
+    by the search are looked up in the entry's full datamodel, through the
+    getObject() and getDataModel() methods that BrainDataModel falls back
+    on.
+
+    >>> from Products.CPSDashboards.braindatamodel import FakeDataModel
+    >>> class FakeDirectory:
+    ...     def _getDataModel(self, entry_id, check_acl=1):
+    ...         dm = FakeDataModel(id=entry_id, email='jdoe@example.com')
+    ...         dm._adapters = ()
+    ...         return dm
+    >>> dm = BrainDataModel(EntryRecord(FakeDirectory(), 'jdoe',
+    ...                                 {'id': 'jdoe', 'sn': 'Doe'}))
+    >>> dm['sn']
+    'Doe'
+    >>> dm.isObjectLoaded()
+    False
+    >>> dm['email']
+    'jdoe@example.com'
+    >>> dm.getFallbackKeys()
+    ['email']
+    """
+
+    def __init__(self, directory, entry_id, fields):
+        self._directory = directory
+        self._entry_id = entry_id
+        self._fields = fields
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_fields'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def getObject(self):
+        return self
+
+    def getDataModel(self, proxy=None):
+        return self._directory._getDataModel(self._entry_id, check_acl=1)
+
+
+def isProjectable(field):
+    """Tell whether field can be read straight from search results.
+
+    Fields having read access control or computed on read have to be read
+    from the entry's datamodel, that takes care of them.
+
+    >>> class FakeField:
+    ...     acl_read_permissions = acl_read_roles = acl_read_expr = ''
+    ...     read_ignore_storage = False
+    ...     read_process_expr = ''
+    >>> field = FakeField()
+    >>> isProjectable(field)
+    True
+    >>> field.acl_read_roles = 'Manager'
+    >>> isProjectable(field)
+    False
+    >>> field = FakeField()
+    >>> field.read_process_expr = 'python: value.upper()'
+    >>> isProjectable(field)
+    False
+    """
+    for attr in ('acl_read_permissions', 'acl_read_roles', 'acl_read_expr',
+                 'read_ignore_storage', 'read_process_expr'):
+        if getattr(field, attr, None):
+            return False
+    return True
+
+
 class DirectoryTabularWidget(TabularWidget):
     """ A widget that renders a search form or search results for directories.
 
@@ -80,39 +153,94 @@ class DirectoryTabularWidget(TabularWidget):
         dtool = getToolByName(self, 'portal_directories')
         return dtool._getOb(self.directory)
 
-    def _doBatchedQuery(self, directory, b_start, b_size, query):
+    def getProjectedFields(self, layout, directory):
+        """Return the fields of directory used by the row layout widgets.
+
+        The id field is always included. Fields that the directory doesn't
+        know of, and fields that aren't projectable (see isProjectable())
+        are left to the fallback on full datamodels, that checks them.
+        """
+        known = {}
+        for field_id, field in directory._getFieldItems():
+            if isProjectable(field):
+                known[field_id] = None
+        fields = {directory.id_field: None}
+        for wid, widget in layout.items():
+            for field in getattr(widget, 'fields', ()):
+                if field in known:
+                    fields[field] = None
+        fields = fields.keys()
+        fields.sort()
+        return fields
+
+    def _filterViewable(self, directory, entry_ids):
+        """Return the ids of entries the user is allowed to view.
+
+        Unless the directory has entry local roles, this is a single
+        check for all entries.
+        """
+        if not getattr(aq_base(directory), 'entry_local_roles', ()):
+            if directory.isViewEntryAllowed():
+                return entry_ids
+            return []
+        allowed = []
+        for entry_id in entry_ids:
+            if directory.isViewEntryAllowed(id=entry_id):
+                allowed.append(entry_id)
+            else:
+                logger.debug("Entry %r not viewable, skipped", entry_id)
+        return allowed
+
+    def _doBatchedQuery(self, directory, b_start, b_size, query,
+                        return_fields=None):
         """ Return batched results, total number of results.
 
-        the results are datamodels and can be a generator.
-        TODO: apply View permission
+        The directory is first searched for ids only. View permission is
+        checked on all of them, so that the total is the number of
+        viewable entries. The given fields are then fetched for the
+        entries of the page only, by a second search on their ids. Other
+        fields are looked up in the entry's full datamodel, if needed (see
+        EntryRecord).
         """
 
-        results = directory.searchEntries(**query)
-        results_batch = results[b_start:b_start+b_size]
-        return (directory._getDataModel(r, check_acl=1)
-                for r in results_batch), len(results)
+        entry_ids = self._filterViewable(directory,
+                                         directory.searchEntries(**query))
+        page_ids = entry_ids[b_start:b_start+b_size]
+        if not page_ids:
+            return [], len(entry_ids)
+
+        id_field = directory.id_field
+        if return_fields is None:
+            fetched = {}
+        else:
+            results = directory.searchEntries(return_fields=return_fields,
+                                              **{id_field: list(page_ids)})
+            fetched = dict(results)
+        return ([BrainDataModel(EntryRecord(directory, entry_id,
+                                            fetched.get(entry_id,
+                                                        {id_field: entry_id})))
+                 for entry_id in page_ids], len(entry_ids))
 
     def listRowDataStructures(self, datastructure, layout, filters=None, **kw):
         """Return datastructures filled with search results meta-data
 
-        Currently, this will give an iterator on the full entry datamodels.
-        It would be much better to have
+        The fields the row layout uses are fetched for the current page
+        only (see _doBatchedQuery()).
         """
 
         if filters is None:
             raise ValueError('Filters is None')
 
         query = filters
-
-        dtool = getToolByName(self, 'portal_directories')
-        cpsdir = dtool[self.directory]
-
-        entries = cpsdir.searchEntries(**query) # checks security
         (b_page, b_start, b_size) = self.getBatchParams(datastructure,
                                                         filters=filters)
 
-        dms, nb_results = self._doBatchedQuery(self._getDirectory(),
-                                               b_start, b_size, query)
+        directory = self._getDirectory()
+        return_fields = self.getProjectedFields(layout, directory)
+        dms, nb_results = self._doBatchedQuery(directory, b_start, b_size,
+                                               query,
+                                               return_fields=return_fields)
+        self.markPhase('query')
 
         nb_pages = self.getNbPages(nb_results, items_per_page=b_size)
         logger.debug("DirectoryTabularWidget: "
@@ -121,8 +249,9 @@ class DirectoryTabularWidget(TabularWidget):
                                                             b_page))
 
         datastructures = (DataStructure(datamodel=dm) for dm in dms)
-        return ([self.prepareRowDataStructure(layout, ds)
-                 for ds in datastructures], b_page, nb_pages)
+        row_dss = self.prepareRowDataStructures(layout, datastructures)
+        self.markPhase('prepare')
+        return row_dss, b_page, nb_pages
 
 InitializeClass(DirectoryTabularWidget)
 
@@ -35,7 +35,9 @@ from Products.CPSSchemas.BasicWidgets import (CPSSelectWidget,
 from Products.CPSSchemas.SearchWidgets import CPSSearchLocationWidget
 from Products.CPSSchemas.ExtendedWidgets import (CPSDateTimeWidget,
                                                  CPSGenericSelectWidget)
-from Products.CPSDashboards.utils import unserializeFromCookie
+from Products.CPSDashboards.utils import decodeCookie
+from Products.CPSDashboards.filterstate import FILTER_STATES
+from Products.CPSDashboards.filterstate import isFilterStateToken
 
 from Products.CPSSchemas.Widget import widgetname
 
@@ -93,10 +95,14 @@ class FilterWidgetMixin:
             if cookie is None:
                 return
 
-            # we have to convert from unicode. There should be only identifiers
-            # so we don't catch UnicodeEncodeErrors
-            cookie = unserializeFromCookie(string=cookie,
-                                           charset=self.default_charset)
+            if isFilterStateToken(cookie):
+                # state kept server side, an unknown token means it's lost
+                cookie = FILTER_STATES.lookup(self, cookie) or {}
+            else:
+                # we have to convert from unicode. There should be only
+                # identifiers so we don't catch UnicodeEncodeErrors
+                cookie = decodeCookie(string=cookie,
+                                      charset=self.default_charset)
             logger.debug('Widget %s, read cookie:%s', wid, cookie)
             ds_cookies[self.cookie_id] = cookie
 
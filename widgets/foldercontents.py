@@ -21,10 +21,13 @@
 """ Folder Contents Portlet Widgets. """
 
 import logging
+from heapq import nsmallest, nlargest
 from Globals import InitializeClass
+from Acquisition import aq_base
 from AccessControl import Unauthorized
 
 from Products.CMFCore.utils import _checkPermission
+from Products.CMFCore.utils import getToolByName
 from Products.CMFCore.permissions import View, ListFolderContents
 
 from Products.CPSSchemas.Widget import CPSWidget
@@ -33,18 +36,94 @@ from Products.CPSSchemas.DataModel import DataModel
 from Products.CPSSchemas.DataStructure import DataStructure
 from Products.CPSSchemas.BasicWidgets import renderHtmlTag
 from Products.CPSDashboards.utils import serializeForCookie
+from Products.CPSDashboards.braindatamodel import BrainDataModel
+from Products.CPSDashboards.cache import LRUCache
 
 from Products.CPSDashboards.widgets.tabular import TabularWidget
+from Products.CPSDashboards.widgets.catalog import queryCatalog, SORT_KEYS
 
 logger = logging.getLogger('CPSDashboards.widgets.foldercontents')
 
 _missed = object()
 
+# CPS catalogs proxies once per language, under this path segment
+VIEW_LANGUAGE = '/viewLanguage/'
+
+# sort values of folders children, see FolderContentsWidget.getSortValues()
+SORT_VALUES = LRUCache(max_entries=200, ttl=300)
+
+class _BrainItem(object):
+    """Dict-like access to the metadata of a brain, for passFilters."""
+
+    def __init__(self, brain):
+        self._brain = brain
+
+    def get(self, key, default=None):
+        return getattr(self._brain, key, default)
+
+def dedupeLanguages(brains, lang=None):
+    """Return brains, keeping one for each proxy.
+
+    Proxies are cataloged once per language, under
+    <proxy path>/viewLanguage/<lang>. The brain in language lang is kept
+    if any, the first one otherwise, at the position of the first one.
+
+    >>> class FakeBrain:
+    ...     def __init__(self, path):
+    ...         self.path = path
+    ...     def getPath(self):
+    ...         return self.path
+    >>> brains = [FakeBrain('/ws/doc'), FakeBrain('/ws/other'),
+    ...           FakeBrain('/ws/doc/viewLanguage/fr')]
+    >>> [b.getPath() for b in dedupeLanguages(brains, 'fr')]
+    ['/ws/doc/viewLanguage/fr', '/ws/other']
+    >>> [b.getPath() for b in dedupeLanguages(brains, 'en')]
+    ['/ws/doc', '/ws/other']
+    """
+    res = []
+    positions = {} # proxy path -> position in res
+    for brain in brains:
+        parts = brain.getPath().split(VIEW_LANGUAGE, 1)
+        pos = positions.get(parts[0])
+        if pos is None:
+            positions[parts[0]] = len(res)
+            res.append(brain)
+        elif len(parts) == 2 and parts[1] == lang:
+            res[pos] = brain
+    return res
+
+def selectPage(items, b_start, b_size, count_all=False):
+    """Return (page, number of items seen, more items after the page).
+
+    items can be a lazy iterable: it's consumed up to the item following
+    the page, or up to the end if count_all is True.
+
+    >>> selectPage(iter(range(10)), 4, 3)
+    ([4, 5, 6], 7, True)
+    >>> selectPage(iter(range(5)), 3, 3)
+    ([3, 4], 5, False)
+    >>> selectPage(iter(range(5)), 6, 3)
+    ([], 5, False)
+    >>> selectPage(iter(range(10)), 4, 3, count_all=True)
+    ([4, 5, 6], 10, False)
+    """
+    page = []
+    nb_seen = 0
+    for item in items:
+        if nb_seen >= b_start + b_size:
+            if not count_all:
+                return page, nb_seen, True
+        elif nb_seen >= b_start:
+            page.append(item)
+        nb_seen += 1
+    return page, nb_seen, False
+
 class FolderContentsWidget(TabularWidget):
     """ A tabular portlet widget that performs a simple folder listing.
 
     Information is fetched from the folder's objects of a given meta-type.
-    There's no batching or sorting.
+    With the use_catalog property, the listing is answered by the catalog
+    instead, and only the displayed page of results is looked at.
 
     >>> FolderContentsWidget('the_id')
     <FolderContentsWidget at the_id>
@@ -54,6 +133,13 @@ class FolderContentsWidget(TabularWidget):
     _properties = TabularWidget._properties + (
         {'id': 'listed_meta_types', 'type': 'lines', 'mode': 'w',
          'label': 'Meta types to list', 'is_required' : 1},
+        {'id': 'use_catalog', 'type': 'boolean', 'mode': 'w',
+         'label': 'List, sort and batch contents through the catalog'},
+        {'id': 'container_index', 'type': 'string', 'mode': 'w',
+         'label': 'Catalog index holding the path of the container'},
+        {'id': 'pushdown_filters', 'type': 'tokens', 'mode': 'w',
+         'label': 'Filters to apply before batching, on proxies or catalog '
+         'metadata'},
         )
 
     listed_meta_types = (
@@ -62,6 +148,10 @@ class FolderContentsWidget(TabularWidget):
        'CPS Proxy Folderish Document',
        )
 
+    use_catalog = False
+    container_index = 'container_path'
+    pushdown_filters = ('portal_type', 'review_state')
+
     cookie_id = ''
 
     filter_button = ''
@@ -102,13 +192,54 @@ class FolderContentsWidget(TabularWidget):
         else:
             return True
 
+    def splitFilters(self, filters):
+        """Return (filters to push down, filters needing prepared rows).
+
+        >>> widg = FolderContentsWidget('')
+        >>> widg.splitFilters({'portal_type': 'File', 'Title': 'x'})
+        ({'portal_type': 'File'}, {'Title': 'x'})
+        """
+        pushed = {}
+        remaining = {}
+        for key, value in filters.items():
+            if key in self.pushdown_filters:
+                pushed[key] = value
+            else:
+                remaining[key] = value
+        return pushed, remaining
+
+    def getCheapValue(self, proxy, key):
+        """Return the value of a pushed down filter key for proxy.
+
+        The proxy's content is not fetched.
+        """
+        if key == 'review_state':
+            wftool = getToolByName(self, 'portal_workflow')
+            return wftool.getInfoFor(proxy, key, None)
+        value = getattr(proxy, key, None)
+        if callable(value):
+            value = value()
+        return value
+
+    def passRowFilters(self, widgets, datastructure, filters):
+        """Prepare the widgets filters apply to, and apply them.
+
+        widgets maps widget ids to the row layout widgets. Other widgets
+        are not prepared.
+        """
+        for key in filters:
+            widget = widgets.get(key)
+            if widget is not None:
+                widget.prepare(datastructure)
+        return self.passFilters(datastructure, filters)
+
     def listRowDataStructures(self, datastructure, layout, filters=None, **kw):
         """Return an iterator for folder contents datastructures
 
-        We cannot avoid finally fetching all objects, but we try to
-        avoid fetching all of them at once.
-
-        Implememtation has become rotten and in need of serious refactoring
+        Filters on keys listed in the pushdown_filters property are applied
+        before batching, on proxies or catalog metadata. Other filters need
+        rows to be prepared: only the widgets they apply to are prepared
+        beyond the current page, to count matching rows.
         """
         folder = kw.get('context_obj') # typical of portlets
         if folder is None:
@@ -127,39 +258,236 @@ class FolderContentsWidget(TabularWidget):
         sort_key = filters.pop('sort-on', None)
         sort_order = filters.pop('sort-order', None)
         sort_col = filters.pop('sort-col', None)
-        ### XXX the filtering algorithm is dead wrong
-        if sort_key is None:
-          o_ids = folder.objectIds(meta_types)
+        pushed, remaining = self.splitFilters(filters)
+
+        listed = None
+        if self.use_catalog:
+            sort_limit = None
+            if not remaining:
+                sort_limit = b_start + b_size
+            listed = self.listCatalogCandidates(folder, meta_types, pushed,
+                                                sort_key, sort_order,
+                                                sort_limit=sort_limit)
+            makeDataModel = lambda brain: BrainDataModel(brain,
+                                                         context=folder)
+        if listed is None:
+            limit = None
+            if not remaining:
+                limit = b_start + b_size
+            listed = self.listFolderCandidates(folder, meta_types, pushed,
+                                               sort_key, sort_order,
+                                               limit=limit)
+            makeDataModel = lambda proxy: self.getProxyDataModel(proxy,
+                                                                 folder)
+        candidates, nb_items = listed
+        self.markPhase('query')
+
+        if not remaining:
+            dss = [DataStructure(datamodel=makeDataModel(candidate))
+                   for candidate in candidates[b_start:b_start+b_size]]
+            nb_pages = self.getNbPages(nb_items, b_size)
+        else:
+            widgets = dict((widget.getWidgetId(), widget)
+                           for wid, widget in layout.items())
+            dss = (DataStructure(datamodel=makeDataModel(candidate))
+                   for candidate in candidates)
+            dss = (ds for ds in dss
+                   if self.passRowFilters(widgets, ds, remaining))
+            dss, nb_items, more = selectPage(dss, b_start, b_size,
+                                             count_all=True)
+            nb_pages = self.getNbPages(nb_items, b_size)
+
+        row_dss = self.prepareRowDataStructures(layout, dss)
+        self.markPhase('prepare')
+        return row_dss, b_page, nb_pages
+
+    def getProxyDataModel(self, proxy, folder):
+        """Return the datamodel of proxy's content."""
+        doc = proxy.getContent()
+        return doc.getTypeInfo().getDataModel(doc, proxy=proxy, context=folder)
+
+    def listFolderCandidates(self, folder, meta_types, pushed,
+                             sort_key=None, sort_order=None, limit=None):
+        """Return (viewable proxies matching pushed filters, their number).
+
+        Proxies are sorted up to limit only, if not None, using a heap.
+        Sort values are taken from a cache, see getSortValues().
+        """
+        proxies = [proxy for proxy in folder.objectValues(meta_types)
+                   if _checkPermission(View, proxy)]
+        for key, value in pushed.items():
+            proxies = [proxy for proxy in proxies
+                       if self.getCheapValue(proxy, key) == value]
+        nb_items = len(proxies)
+
+        if sort_key is None or not proxies:
+            return proxies, nb_items
+
+        values = self.getSortValues(folder, proxies, sort_key)
+        weighted = [(values[proxy.getId()], proxy.getId(), proxy)
+                    for proxy in proxies]
+        reverse = sort_order == 'reverse'
+        if limit is not None and limit < nb_items:
+            if reverse:
+                weighted = nlargest(limit, weighted)
+            else:
+                weighted = nsmallest(limit, weighted)
+        else:
+            weighted.sort()
+            if reverse:
+                weighted.reverse()
+        return [w_item[2] for w_item in weighted], nb_items
+
+    def getSortStamp(self, proxy):
+        """Return a stamp that changes along with proxy or its content.
+
+        Editing a document doesn't touch its proxy, hence the content's
+        modification time, and the revision the proxy points to if any.
+        None is returned if modification times are unknown.
+        """
+        content = proxy.getContent()
+        mtimes = (getattr(aq_base(proxy), '_p_mtime', None),
+                  getattr(aq_base(content), '_p_mtime', None))
+        if None in mtimes:
+            return None
+        getRevision = getattr(aq_base(proxy), 'getRevision', None)
+        revision = None
+        if getRevision is not None:
+            revision = proxy.getRevision()
+        return mtimes + (revision,)
+
+    def getSortValues(self, folder, proxies, sort_key):
+        """Return a dict mapping ids of proxies to their sort values.
+
+        Values are read on the proxies contents (calling them if needed),
+        and cached per folder and sort key. A cached value is used as long
+        as the stamp of the child doesn't change (see getSortStamp()).
+
+        >>> class FakeContent:
+        ...     _p_mtime = 1327156800.0
+        ...     calls = 0
+        ...     def Title(self):
+        ...         FakeContent.calls += 1
+        ...         return 'the title'
+        >>> class FakeProxy:
+        ...     _p_mtime = 1327156800.0
+        ...     def __init__(self, id):
+        ...         self.id = id
+        ...         self.content = FakeContent()
+        ...     def getId(self):
+        ...         return self.id
+        ...     def getContent(self):
+        ...         return self.content
+        >>> class FakeFolder:
+        ...     def getPhysicalPath(self):
+        ...         return ('', 'folder')
+        >>> proxies = [FakeProxy('a'), FakeProxy('b')]
+        >>> widg = FolderContentsWidget('')
+        >>> widg.getSortValues(FakeFolder(), proxies, 'Title')
+        {'a': 'the title', 'b': 'the title'}
+        >>> widg.getSortValues(FakeFolder(), proxies, 'Title') and None
+        >>> FakeContent.calls
+        2
+        >>> proxies[0]._p_mtime += 1
+        >>> widg.getSortValues(FakeFolder(), proxies, 'Title') and None
+        >>> FakeContent.calls
+        3
+
+        Editing a content invalidates its value only:
+
+        >>> proxies[1].content._p_mtime += 1
+        >>> widg.getSortValues(FakeFolder(), proxies, 'Title') and None
+        >>> FakeContent.calls
+        4
+        """
+        cache_key = ('/'.join(folder.getPhysicalPath()), sort_key)
+        cached = SORT_VALUES.get(cache_key) or {}
+        values = {}
+        fresh = {}
+        for proxy in proxies:
+            pid = proxy.getId()
+            stamp = self.getSortStamp(proxy)
+            entry = cached.get(pid)
+            if entry is not None and stamp is not None and entry[0] == stamp:
+                value = entry[1]
+            else:
+                value = getattr(proxy.getContent(), sort_key)
+                if callable(value):
+                    value = value()
+            values[pid] = value
+            if stamp is not None:
+                fresh[pid] = (stamp, value)
+        # rebuilt, so that removed children don't stay in cache
+        SORT_VALUES.set(cache_key, fresh)
+        return values
+
+    def listCatalogCandidates(self, folder, meta_types, pushed,
+                              sort_key=None, sort_order=None, sort_limit=None):
+        """Return (brains, total number of brains) or None.
+
+        The catalog is queried for the direct children of folder. View
+        permission is enforced by the catalog. Pushed filters are part of
+        the query if they are catalog indexes, or else checked on metadata.
+        Results are sorted up to sort_limit only, if not None.
+
+        Proxies are cataloged once per language: only one brain is kept
+        for each (see dedupeLanguages()). If results are truncated, the
+        number of proxies is then given by an unsorted query.
+
+        None is returned if the sort key isn't a catalog index.
+        """
+        catalog = getToolByName(self, 'portal_catalog')
+        indexes = catalog.indexes()
+        if sort_key is not None and sort_key not in indexes:
+            logger.debug("Can't sort on %r with the catalog", sort_key)
+            return None
+
+        query = {self.container_index: '/'.join(folder.getPhysicalPath())}
+        if 'meta_type' in indexes:
+            query['meta_type'] = list(meta_types)
+        on_metadata = {}
+        for key, value in pushed.items():
+            if key in indexes:
+                query[key] = value
+            else:
+                on_metadata[key] = value
+        if sort_key is not None:
+            query['sort_on'] = sort_key
+            if sort_order == 'reverse':
+                query['sort_order'] = 'reverse'
         else:
-          o_items = folder.objectItems(meta_types)
-          # Check Dublin core case
-          first = o_items and o_items[0][1].getContent()
-          if o_items and callable(getattr(first, sort_key)):
-              weighted_items = [(getattr(item.getContent(), sort_key)(), oid)
-                                for oid, item in o_items]
-          else:
-              weighted_items = [(getattr(item.getContent(), sort_key), oid)
-                                for oid, item in o_items]
-
-          weighted_items.sort()
-          o_ids = [w_item[1] for w_item in weighted_items]
-          if sort_order == 'reverse':
-              o_ids.reverse()
-
-        nb_pages = self.getNbPages(len(o_ids), b_size)
-        batched_ids = o_ids[b_start:b_start+b_size]
-        iterprox = (folder[p_id] for p_id in batched_ids)
-        iterprox = (proxy for proxy in iterprox
-                    if _checkPermission(View, proxy))
-        iterdocs = ( (proxy.getContent(), proxy) for proxy in iterprox)
-        iterdms = (doc.getTypeInfo().getDataModel(doc,
-                                                  proxy=proxy, context=folder)
-                   for doc, proxy in iterdocs)
-        iterds = (self.prepareRowDataStructure(layout,
-                                               DataStructure(datamodel=dm))
-                  for dm in iterdms)
-        return ((ds for ds in iterds if self.passFilters(ds, filters)),
-                b_page, nb_pages)
+            sort_limit = None
+
+        cpsmcat = getToolByName(self, 'translation_service', None)
+        lang = None
+        if cpsmcat is not None:
+            lang = cpsmcat.getSelectedLanguage()
+
+        if on_metadata:
+            brains = [brain for brain in catalog(**query)
+                      if self.passFilters(_BrainItem(brain), on_metadata)]
+            brains = dedupeLanguages(brains, lang)
+            return brains, len(brains)
+
+        brains, nb_results = queryCatalog(catalog, query.copy(),
+                                          sort_limit=sort_limit)
+        proxies = dedupeLanguages(brains, lang)
+        if len(brains) >= nb_results:
+            return proxies, len(proxies)
+
+        count_query = dict((k, v) for k, v in query.items()
+                           if k not in SORT_KEYS)
+        proxy_paths = {}
+        for brain in catalog(**count_query):
+            proxy_paths[brain.getPath().split(VIEW_LANGUAGE, 1)[0]] = None
+        nb_proxies = len(proxy_paths)
+        # duplicates may have pushed proxies of the page beyond the limit
+        limit = sort_limit
+        while len(proxies) < min(sort_limit, nb_proxies):
+            limit *= 2
+            query['sort_limit'] = limit
+            proxies = dedupeLanguages(catalog(**query), lang)
+        return proxies, nb_proxies
 
 InitializeClass(FolderContentsWidget)
 
@@ -24,9 +24,9 @@ import re
 from cgi import escape
 from datetime import datetime
 from Globals import InitializeClass
+from Acquisition import aq_base
 from DateTime import DateTime
 
-from Products.CMFCore.utils import getToolByName
 from Products.CPSSchemas.Widget import CPSWidget
 from Products.CPSSchemas.Widget import widgetRegistry
 from Products.CPSSchemas.BasicWidgets import renderHtmlTag
@@ -38,6 +38,12 @@ from Products.CPSSchemas.BasicWidgets import (CPSStringWidget,
 from Products.CPSSchemas.ExtendedWidgets import CPSDateTimeWidget
 from Products.CPSSchemas.widgets.image import CPSImageWidget
 
+from Products.CPSDashboards.cache import LRUCache
+from Products.CPSDashboards.localroles import getMergedLocalRoles
+from Products.CPSDashboards.utils import getRequestMemo
+from Products.CPSDashboards.utils import getRequestTool
+from Products.CPSDashboards.utils import getTranslator
+
 
 logger = logging.getLogger('CPSDashboards.widgets.row_widgets')
 
@@ -48,6 +54,31 @@ def xlate(s, cpsmcat):
     return cpsmcat(s)
 
 
+_missing = object()
+
+# rendered type icons, see CPSTypeIconWidget.getTypeIconTable()
+TYPE_ICONS = LRUCache(max_entries=100)
+REQUEST_TYPE_ICONS = '_cpsdashboards_type_icons'
+
+# titles of members and groups, see CPSUsersWithRolesWidget.resolveTitles()
+MEMBER_TITLES = LRUCache(max_entries=5000, sizeof=lambda v: 1, ttl=300)
+
+def getTypesStamp(ttool):
+    """Return a stamp that changes whenever ttool or a type info changes.
+
+    Return None if some of them has uncommitted changes, or has never been
+    committed: the stamp could not be relied upon.
+    """
+    stamps = []
+    for ob in [ttool] + list(ttool.objectValues()):
+        ob = aq_base(ob)
+        mtime = getattr(ob, '_p_mtime', None)
+        if mtime is None or getattr(ob, '_p_changed', False):
+            return None
+        stamps.append(mtime)
+    return max(stamps)
+
+
 class CPSTypeIconWidget(CPSWidget):
     """widget showing the icon associated to the object's portal_type. """
     meta_type = 'Type Icon Widget'
@@ -66,24 +97,63 @@ class CPSTypeIconWidget(CPSWidget):
         """Validate datastructure and update datamodel."""
         return 1
 
-    def render(self, mode, datastructure, **kw):
-        """Render in mode from datastructure."""
-
-        ptype = datastructure.get(self.getWidgetId())
-        if ptype is None:
-            return ''
+    def getTypeIconTable(self):
+        """Return the table of rendered icons for the current language.
 
-        ttool = getToolByName(self, 'portal_types')
+        The table maps portal types to the <img> tags and is filled as
+        rows need them. It is shared among widgets for a given types tool,
+        language and base URL, and dropped as soon as the types tool or any
+        type information changes. Within a request, the table is looked up
+        only once.
+        """
+        memo = getRequestMemo(self, REQUEST_TYPE_ICONS)
+        if memo is not None:
+            table = memo.get('table')
+            if table is not None:
+                return table
+
+        ttool = getRequestTool(self, 'portal_types')
+        stamp = getTypesStamp(ttool)
+        if stamp is None:
+            table = {}
+        else:
+            utool = getRequestTool(self, 'portal_url')
+            lang = getTranslator(self).getSelectedLanguage()
+            key = (ttool.getPhysicalPath(), lang, utool.getBaseUrl(), stamp)
+            table = TYPE_ICONS.get(key)
+            if table is None:
+                table = {}
+                TYPE_ICONS.set(key, table)
+        if memo is not None:
+            memo['table'] = table
+        return table
+
+    def renderTypeIcon(self, ptype):
+        """Render the <img> tag for ptype."""
+        ttool = getRequestTool(self, 'portal_types')
         fti = getattr(ttool, ptype)
         icon = fti.getIcon()
 
-        utool = getToolByName(self, 'portal_url')
+        utool = getRequestTool(self, 'portal_url')
         uri = utool.getBaseUrl() + icon
         title = fti.title_or_id()
-        cpsmcat = getToolByName(self, 'translation_service')
+        cpsmcat = getTranslator(self)
         title = cpsmcat(title)
         return renderHtmlTag('img', src=uri, alt=title)
 
+    def render(self, mode, datastructure, **kw):
+        """Render in mode from datastructure."""
+
+        ptype = datastructure.get(self.getWidgetId())
+        if ptype is None:
+            return ''
+
+        table = self.getTypeIconTable()
+        tag = table.get(ptype)
+        if tag is None:
+            tag = table[ptype] = self.renderTypeIcon(ptype)
+        return tag
+
 InitializeClass(CPSTypeIconWidget)
 
 
@@ -98,20 +168,48 @@ class CPSWorkflowVariableWidget(CPSWidget):
     _properties = CPSWidget._properties + (
         {'id': 'wf_var_id', 'type' : 'string', 'mode' : 'w',
          'label': 'Name of the workflow variable to pick'},
+        {'id': 'use_brain_metadata', 'type' : 'boolean', 'mode' : 'w',
+         'label': 'Read the variable from catalog metadata if available'},
         )
 
     wf_var_id = 'review_state'
+    use_brain_metadata = False
 
     def prepare(self, datastructure, **kw):
         """Prepare datastructure from workflow var."""
+        self.prepareBatch((datastructure,), **kw)
 
-        dm = datastructure.getDataModel()
-        proxy = dm.getProxy()
-        if proxy is None:
-            return ''
-        wftool = getToolByName(self, 'portal_workflow')
-        datastructure[self.getWidgetId()] = wftool.getInfoFor(proxy,
-                                                              self.wf_var_id)
+    def prepareBatch(self, datastructures, **kw):
+        """Prepare datastructures of a whole page of rows.
+
+        If use_brain_metadata is set, the variable is read from the catalog
+        metadata of the same name, and the proxy is fetched only for rows
+        lacking it. Rows that did fetch it are recorded by the brain
+        datamodel, and show up in the load statistics.
+        """
+
+        wid = self.getWidgetId()
+        var_id = self.wf_var_id
+        wftool = None
+        for datastructure in datastructures:
+            dm = datastructure.getDataModel()
+            if self.use_brain_metadata:
+                getMetadata = getattr(dm, 'getBrainMetadata', None)
+                if getMetadata is not None:
+                    value = getMetadata(var_id, _missing)
+                    if value is not _missing:
+                        datastructure[wid] = value
+                        continue
+
+            proxy = dm.getProxy()
+            if proxy is None:
+                continue
+            record = getattr(dm, 'recordFallbackKey', None)
+            if record is not None:
+                record('workflow:%s' % var_id)
+            if wftool is None:
+                wftool = getRequestTool(self, 'portal_workflow')
+            datastructure[wid] = wftool.getInfoFor(proxy, var_id)
 
     def validate(self, datastructure, **kw):
         """Validate datastructure and update datamodel."""
@@ -123,7 +221,7 @@ class CPSWorkflowVariableWidget(CPSWidget):
         state = datastructure[self.getWidgetId()]
         if state is None:
             return ''
-        cpsmcat = getToolByName(self, 'translation_service')
+        cpsmcat = getTranslator(self)
         return escape(cpsmcat(state))
 
 
@@ -139,7 +237,7 @@ class CPSReviewStateStringWidget(CPSStringWidget):
         if mode != 'view':
             return ''
         value = datastructure[self.getWidgetId()]
-        cpsmcat = getToolByName(self, 'translation_service')
+        cpsmcat = getTranslator(self)
         xlated = cpsmcat(value)
         return renderHtmlTag('span', css_class=value, contents=xlated)
 
@@ -203,23 +301,31 @@ class CPSQualifiedLinkWidget(CPSWidget):
 
     def prepare(self, datastructure, **kw):
         """Prepare datastructure from datamodel."""
+        self.prepareBatch((datastructure,), **kw)
 
-        w_id = self.getWidgetId()
-        dm = datastructure.getDataModel()
+    def prepareBatch(self, datastructures, **kw):
+        """Prepare datastructures of a whole page of rows.
 
+        The URL tool and base URL are looked up once for all."""
+
+        w_id = self.getWidgetId()
         suffixes = ('contents', 'title', 'href')
-        for suffix, fid in zip(suffixes, self.fields):
-            datastructure['%s_%s' % (w_id, suffix)] = dm[fid]
-        if len(self.fields) < 3: # no url field
-            proxy = dm.getProxy()
-            if proxy is None:
-                raise ValueError(
-                    "No field provided for link, no proxy object found")
-            utool = getToolByName(self, 'portal_url')
+        no_url_field = len(self.fields) < 3
+        if no_url_field:
+            utool = getRequestTool(self, 'portal_url')
             base_url = utool.getBaseUrl()
-            rpath = utool.getRpath(proxy)
 
-            datastructure['%s_%s' % (w_id, 'href')] = base_url+rpath
+        for datastructure in datastructures:
+            dm = datastructure.getDataModel()
+            for suffix, fid in zip(suffixes, self.fields):
+                datastructure['%s_%s' % (w_id, suffix)] = dm[fid]
+            if no_url_field:
+                proxy = dm.getProxy()
+                if proxy is None:
+                    raise ValueError(
+                        "No field provided for link, no proxy object found")
+                rpath = utool.getRpath(proxy)
+                datastructure['%s_%s' % (w_id, 'href')] = base_url+rpath
 
     def validate(self, datastructure, **kw):
         """Validate datastructure and update datamodel."""
@@ -232,7 +338,7 @@ class CPSQualifiedLinkWidget(CPSWidget):
         params = dict((suffix, datastructure['%s_%s' % (w_id, suffix)])
                        for suffix in ('href', 'title', 'contents',))
         if self.is_display_i18n:
-            cpsmcat = getToolByName(self, 'translation_service')
+            cpsmcat = getTranslator(self)
             for key in ['title', 'contents']:
                 params[key] = xlate(params[key], cpsmcat)
         if self.target:
@@ -387,7 +493,7 @@ class CPSTimeLeftWidget(CPSIntWidget):
             css_class = 'inTime'
 
         if self.is_display_i18n:
-            cpsmcat = getToolByName(self, 'translation_service')
+            cpsmcat = getTranslator(self)
             xlated = cpsmcat('cpscourrier_timeleft:${plus_sign}${d}',
                                     {'d': base_rendered,
                                     'plus_sign': plus_sign})
@@ -436,7 +542,7 @@ class CPSIconBooleanWidget(CPSBooleanWidget):
         if mode != 'view':
             return CPSBooleanWidget.render(self, mode, datastructure, **kw)
 
-        utool = getToolByName(self, 'portal_url')
+        utool = getRequestTool(self, 'portal_url')
         if value:
             icon = self.icon_true
             label = self.label_true
@@ -449,7 +555,7 @@ class CPSIconBooleanWidget(CPSBooleanWidget):
 
         uri = utool.getBaseUrl() + icon
 
-        cpsmcat = getToolByName(self, 'translation_service')
+        cpsmcat = getTranslator(self)
         label = cpsmcat(label)
 
         return renderHtmlTag('img', src=uri, alt=label)
@@ -496,7 +602,7 @@ class CPSIconSelectWidget(CPSSelectWidget):
         if mode != 'view':
             return CPSSelectWidget.render(self, mode, datastructure, **kw)
 
-        utool = getToolByName(self, 'portal_url')
+        utool = getRequestTool(self, 'portal_url')
         label = self.label
         if self.icons and value:
             icon = self.prefix+value.replace(' ' ,'_')+self.suffix
@@ -506,7 +612,7 @@ class CPSIconSelectWidget(CPSSelectWidget):
             return ''
         uri = utool.getBaseUrl() + icon
 
-        cpsmcat = getToolByName(self, 'translation_service')
+        cpsmcat = getTranslator(self)
         label = cpsmcat(label)
         return renderHtmlTag('img', src=uri, alt=label)
 
@@ -536,12 +642,68 @@ class CPSUsersWithRolesWidget(CPSLinesWidget):
         """Analyses the contets."""
         return False
 
-    def _extractMembers(self, prefix, mdir, members, l10n=None):
+    def resolveTitles(self, mdir, ids):
+        """Return a mapping from ids to titles of entries of mdir.
+
+        Titles are kept in a process wide cache, for a few minutes. Those
+        that aren't cached are fetched with a single search. Unknown ids
+        are mapped to None.
+        """
+        getPath = getattr(aq_base(mdir), 'getPhysicalPath', None)
+        if getPath is None:
+            dir_path = None # not cacheable
+        else:
+            dir_path = '/'.join(mdir.getPhysicalPath())
+
+        titles = {}
+        missing = []
+        for mid in ids:
+            if dir_path is not None:
+                title = MEMBER_TITLES.get((dir_path, mid), _missing)
+                if title is not _missing:
+                    titles[mid] = title
+                    continue
+            missing.append(mid)
+        if not missing:
+            return titles
+
+        title_field = mdir.title_field
+        fetched = None
+        search = getattr(aq_base(mdir), '_searchEntries', None)
+        # a single entry is as well fetched directly
+        if search is not None and len(missing) > 1:
+            query = {mdir.id_field: missing}
+            fetched = {}
+            for mid, entry in mdir._searchEntries(return_fields=[title_field],
+                                                  **query):
+                fetched[mid] = entry.get(title_field)
+        for mid in missing:
+            if fetched is not None:
+                title = fetched.get(mid)
+            else:
+                entry = mdir._getEntry(mid, default=None)
+                if entry is None:
+                    title = None
+                else:
+                    title = entry[title_field]
+            titles[mid] = title
+            if dir_path is not None:
+                MEMBER_TITLES.set((dir_path, mid), title)
+        return titles
+
+    def _extractMembers(self, prefix, mdir, members, l10n=None, titles=None):
         """Convert member id as returned by Membership Tool.
+
+        titles is the mapping of ids to titles, as returned by
+        resolveTitles(). It is computed if not provided.
         """
 
         pref_len = len(prefix)
-        title_field = mdir.title_field
+        if titles is None:
+            titles = self.resolveTitles(
+                mdir, [mid[pref_len:] for mid in members
+                       if mid.startswith(prefix)
+                       and not mid.startswith(prefix + 'role:')])
 
         res = []
         for mid in members:
@@ -555,32 +717,52 @@ class CPSUsersWithRolesWidget(CPSLinesWidget):
                 else:
                     title = mid
             else:
-                entry = mdir._getEntry(mid, default=None)
-                if entry is not None:
-                    title = entry[title_field]
+                title = titles.get(mid)
             if title is not None:
                 res.append(title)
         return res
 
     def prepare(self, datastructure, **kw):
-        proxy = datastructure.getDataModel().getProxy()
+        self.prepareBatch((datastructure,), **kw)
+
+    def prepareBatch(self, datastructures, **kw):
+        """Prepare datastructures of a whole page of rows.
+
+        Ids of members having the wanted roles are gathered for all rows
+        first, so that their titles are resolved at once, for the users and
+        groups directories.
+        """
 
         if not self.merge_roles:
             raise NotImplementedError
         wanted_roles = set(self.roles)
-        mtool = getToolByName(self, 'portal_membership')
-
-        roles_info = mtool.getMergedLocalRoles(proxy)
-        logger.debug(roles_info)
-        members = [mid for mid, m_roles in roles_info.items()
-                   if wanted_roles.intersection(m_roles)]
+        wid = self.getWidgetId()
 
-        if not members:
-            datastructure[self.getWidgetId()] = []
+        rows = []
+        user_ids = {}
+        group_ids = {}
+        for datastructure in datastructures:
+            proxy = datastructure.getDataModel().getProxy()
+            roles_info = getMergedLocalRoles(proxy)
+            logger.debug(roles_info)
+            members = [mid for mid, m_roles in roles_info.items()
+                       if wanted_roles.intersection(m_roles)]
+            if not members:
+                datastructure[wid] = []
+                continue
+            rows.append((datastructure, members))
+            for mid in members:
+                if mid.startswith('user:'):
+                    user_ids[mid[5:]] = None
+                elif mid.startswith('group:') and not (
+                    mid.startswith('group:role:')):
+                    group_ids[mid[6:]] = None
+
+        if not rows:
             return
 
-        aclu = getToolByName(self, 'acl_users')
-        dtool = getToolByName(self, 'portal_directories')
+        aclu = getRequestTool(self, 'acl_users')
+        dtool = getRequestTool(self, 'portal_directories')
         if aclu.meta_type == 'CPS User Folder':
             udir_id = aclu.users_dir
             gdir_id = aclu.groups_dir
@@ -589,13 +771,18 @@ class CPSUsersWithRolesWidget(CPSLinesWidget):
             gdir_id = 'groups'
         udir = dtool[udir_id]
         gdir = dtool[gdir_id]
-        l10n = getToolByName(self, 'translation_service')
-        users = self._extractMembers('user:', udir, members, l10n=l10n)
-        groups = self._extractMembers('group:', gdir, members, l10n=l10n)
+        user_titles = self.resolveTitles(udir, user_ids.keys())
+        group_titles = self.resolveTitles(gdir, group_ids.keys())
+        l10n = getTranslator(self)
 
-        lines = users + groups
-        logger.debug(lines)
-        datastructure[self.getWidgetId()] = lines
+        for datastructure, members in rows:
+            users = self._extractMembers('user:', udir, members, l10n=l10n,
+                                         titles=user_titles)
+            groups = self._extractMembers('group:', gdir, members, l10n=l10n,
+                                          titles=group_titles)
+            lines = users + groups
+            logger.debug(lines)
+            datastructure[wid] = lines
 
 
 InitializeClass(CPSUsersWithRolesWidget)
@@ -635,7 +822,7 @@ class CPSMultiBooleanWidget(CPSWidget):
             raise NotImplementedError
         rendered = datastructure[self.getWidgetId()]
         if self.is_display_i18n:
-            cpsmcat = getToolByName(self, 'translation_service')
+            cpsmcat = getTranslator(self)
             rendered = cpsmcat(rendered)
         return rendered
 
@@ -716,7 +903,7 @@ class CPSQuickDisplayDateTimeWidget(CPSDateTimeWidget):
             return ''
         format = self.render_format
         if self.render_format_i18n:
-            cpsmcat = getToolByName(self, 'translation_service')
+            cpsmcat = getTranslator(self)
             format = xlate(format, cpsmcat)
         return escape(value.strftime(format))
 
@@ -751,7 +938,7 @@ class CPSImageWithLinkWidget(CPSImageWidget):
             if proxy is None:
                 raise ValueError(
                     "No field provided for link, no proxy object found")
-            utool = getToolByName(self, 'portal_url')
+            utool = getRequestTool(self, 'portal_url')
             base_url = utool.getBaseUrl()
             rpath = utool.getRpath(proxy)
 
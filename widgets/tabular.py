@@ -24,7 +24,8 @@ import logging
 from urllib import quote
 
 from Globals import InitializeClass
-from DateTime.DateTime import DateTime
+from Acquisition import aq_base
+from AccessControl import getSecurityManager
 
 from Products.CMFCore.utils import getToolByName
 
@@ -35,8 +36,11 @@ from Products.CPSSchemas.Widget import widgetname
 from Products.CPSSchemas.DataStructure import DataStructure
 from Products.CPSDocument.FlexibleTypeInformation import FlexibleTypeInformation
 from Products.CPSPortlets.widgets.generic import CPSPortletWidget
-from Products.CPSDashboards.utils import serializeForCookie
-from Products.CPSDashboards.utils import unserializeFromCookie
+from Products.CPSDashboards.utils import encodeCookie
+from Products.CPSDashboards.cache import LRUCache, fingerprint
+from Products.CPSDashboards.filterstate import FILTER_STATES
+from Products.CPSDashboards.timing import PhaseTimer
+from Products.CPSDashboards.loadstats import LOAD_STATS, getTransferCount
 from Products.CPSDashboards.widgets.filter_widgets import CPSIntFilterWidget
 
 from Products.CPSDocument.interfaces import ICPSDocument
@@ -47,6 +51,55 @@ SCOPE_SUFFIX = '_scope' # see explanations in filter_widgets
 
 _missed = object()
 
+# datastructure attributes used by the rendered rows cache
+DS_ROW_CACHE_KEY = '_row_cache_key'
+DS_ROW_RENDERED = '_row_rendered'
+
+# Process wide cache of rendered rows, shared by all tabular widgets.
+# Keys are computed by TabularWidget.getRowCacheKey()
+ROWS_CACHE = LRUCache(max_entries=20000, max_size=32*1024*1024)
+
+# Process wide record of whether compiled row renderers give the same HTML
+# as the generic layout rendering. Keys are computed by
+# TabularWidget.getCompiledRowRenderer()
+COMPILED_ROWS = LRUCache(max_entries=1000, sizeof=lambda v: 1)
+
+def getLayoutVersion(layout):
+    """Return a stamp that changes whenever the layout or its widgets do."""
+    obs = [layout] + list(layout.objectValues())
+    return max([getattr(aq_base(ob), '_p_mtime', None) or 0 for ob in obs])
+
+class CompiledRowRenderer(object):
+    """Render rows straight into a string, given a computed row layout.
+
+    This does what the layout rendering followed by
+    TabularWidget.table_layout_row_view does, without the generic layout
+    machinery. It holds the widgets of the layout structure, therefore it
+    can't be kept from one request to another.
+    """
+
+    def __init__(self, layout_structure, encoding):
+        self.encoding = encoding
+        self.cells = [(row[0]['widget'], row[0]['widget_mode'],
+                       row[0].get('widget_css_class'))
+                      for row in layout_structure['rows']]
+
+    def getSignature(self):
+        """Return what the rendering depends on, apart from widgets."""
+        return tuple([(widget.getWidgetId(), mode, css_class)
+                      for widget, mode, css_class in self.cells])
+
+    def __call__(self, datastructure):
+        encoding = self.encoding
+        tags = []
+        for widget, mode, css_class in self.cells:
+            tag = renderHtmlTag('td', css_class=css_class,
+                                contents=widget.render(mode, datastructure))
+            if isinstance(tag, unicode):
+                tag = tag.encode(encoding)
+            tags.append(tag)
+        return ''.join(tags)
+
 
 class TabularWidget(CPSIntFilterWidget):
     """ A generic portlet widget to display tabular contents.
@@ -85,6 +138,10 @@ class TabularWidget(CPSIntFilterWidget):
          'label': 'Name of the batch perform method'},
         {'id': 'cookie_id', 'type': 'string', 'mode': 'w',
          'label': 'Name of cookie for filter params (no cookie if empty)', },
+        {'id': 'filter_state_store', 'type': 'selection', 'mode': 'w',
+         'select_variable': 'filter_state_stores',
+         'label': 'Where to keep filter params (the cookie holds a token '
+         'if not in cookie)', },
         {'id': 'filter_button', 'type': 'string', 'mode': 'w',
          'label': 'Name of the button used to trigger filtering', },
         {'id': 'filter_prefix', 'type': 'string', 'mode': 'w',
@@ -101,6 +158,10 @@ class TabularWidget(CPSIntFilterWidget):
          'label': 'onMouseOver to put on rows'},
         {'id': 'row_mouseout', 'type': 'string', 'mode': 'w',
          'label': 'onMouseOut to put on rows'},
+        {'id': 'row_cache', 'type': 'boolean', 'mode': 'w',
+         'label': 'Cache rendered rows across requests (catalog results only)'},
+        {'id': 'compiled_rows', 'type': 'boolean', 'mode': 'w',
+         'label': 'Render rows without the generic layout machinery'},
         )
 
     row_layout = ''
@@ -111,6 +172,8 @@ class TabularWidget(CPSIntFilterWidget):
     batch_perform_view_name = 'batchperform.html'
     actions = ()
     cookie_id = ''
+    filter_state_stores = ('cookie', 'ram', 'persistent')
+    filter_state_store = 'cookie'
     filter_button = ''
     filter_prefix = 'q_'
     items_per_page = 10
@@ -119,12 +182,210 @@ class TabularWidget(CPSIntFilterWidget):
     row_click = ''
     row_mouseover = ''
     row_mouseout = ''
+    row_cache = False
+    compiled_rows = False
+
+    _v_row_cache_context = None
+    _v_phase_timer = None
+    _v_last_loads = None
 
     def prepareRowDataStructure(self, layout, datastructure):
-        """Have layout prepare row datastructure and return it."""
-        layout.prepareLayoutWidgets(datastructure)
+        """Have layout prepare row datastructure and return it.
+
+        Preparation is skipped if the row rendering is already in cache.
+        """
+        if not self._lookupRowCache(datastructure):
+            layout.prepareLayoutWidgets(datastructure)
         return datastructure
 
+    def prepareRowDataStructures(self, layout, datastructures):
+        """Have layout widgets prepare the row datastructures of a page.
+
+        Widgets that provide a prepareBatch(datastructures, **kw) method get
+        all rows at once, so that they can do bulk lookups. The other ones
+        prepare rows one by one. Rows whose rendering is in cache are
+        skipped. Return the list of datastructures.
+        """
+        datastructures = list(datastructures)
+        to_prepare = [ds for ds in datastructures
+                      if not self._lookupRowCache(ds)]
+        if not to_prepare:
+            return datastructures
+
+        for wid, widget in layout.items():
+            prepareBatch = getattr(widget, 'prepareBatch', None)
+            if prepareBatch is not None:
+                prepareBatch(to_prepare)
+            else:
+                for ds in to_prepare:
+                    widget.prepare(ds)
+        return datastructures
+
+    def _lookupRowCache(self, datastructure):
+        """Return True if the row rendering is in cache.
+
+        Otherwise, remember on datastructure the key to store it.
+        """
+        key = self.getRowCacheKey(datastructure)
+        if key is None:
+            return False
+        rendered = ROWS_CACHE.get(key)
+        if rendered is not None:
+            setattr(datastructure, DS_ROW_RENDERED, rendered)
+            return True
+        setattr(datastructure, DS_ROW_CACHE_KEY, key)
+        return False
+
+    def getRowCacheContext(self, row_layout):
+        """Return the part of rows cache keys that is common to all rows.
+
+        This is made of the row layout path and version, the language, the
+        base URL and a fingerprint of the user roles and groups. Return
+        None if the rows cache is disabled.
+
+        Neither the user id nor anything portal wide is part of it, so
+        that rows are shared across users and requests. Changes of
+        documents are tracked row by row (see getRowCacheKey).
+        """
+        if not self.row_cache:
+            return None
+
+        lpath = '/'.join(row_layout.getPhysicalPath())
+        cpsmcat = getToolByName(self, 'translation_service', None)
+        lang = ''
+        if cpsmcat is not None:
+            lang = cpsmcat.getSelectedLanguage()
+        base_url = getToolByName(self, 'portal_url').getBaseUrl()
+        user = getSecurityManager().getUser()
+        groups = getattr(aq_base(user), 'getGroups', None)
+        groups = groups is not None and user.getGroups() or ()
+        principals = list(user.getRoles()) + ['group:' + g for g in groups]
+        principals.sort()
+
+        return (self.meta_type, lpath, getLayoutVersion(row_layout), lang,
+                base_url, fingerprint(*principals))
+
+    def getRowCacheKey(self, datastructure):
+        """Return the key to cache the rendering of the row or None.
+
+        Rows can be cached only if the datamodel provides a stamp of the
+        underlying data (see BrainDataModel.getBrainStamp), that changes
+        with the modification date, the review state and the roles and
+        users allowed to view the document.
+
+        The user id ends the key only if it has been granted local roles
+        on the document (or if that can't be told).
+        """
+        context = self._v_row_cache_context
+        if context is None:
+            return None
+
+        dm = datastructure.getDataModel()
+        getStamp = getattr(dm, 'getBrainStamp', None)
+        if getStamp is None:
+            return None
+        stamp = getStamp()
+        if stamp is None:
+            return None
+
+        principal = 'user:%s' % getSecurityManager().getUser().getId()
+        allowed = dm.getAllowedRolesAndUsers()
+        if allowed is not None and principal not in allowed:
+            principal = None
+        return context + stamp + (principal,)
+
+    def getCompiledRowRenderer(self, row_layout, layout_structure):
+        """Return a compiled row renderer and whether it's known to be right.
+
+        Return None, None if compiled rendering is disabled or known to
+        differ from the generic one. Otherwise the second value is None if
+        there's no verdict yet for this layout version, in which case the
+        caller is expected to call recordCompiledRowVerdict().
+        """
+        if not self.compiled_rows:
+            return None, None
+        renderer = CompiledRowRenderer(layout_structure,
+                                       get_final_encoding(self))
+        key = (self.meta_type, '/'.join(row_layout.getPhysicalPath()),
+               getLayoutVersion(row_layout), renderer.getSignature())
+        renderer.key = key
+        verified = COMPILED_ROWS.get(key)
+        if verified is False:
+            return None, None
+        return renderer, verified
+
+    def recordCompiledRowVerdict(self, renderer, row_ds, rendered):
+        """Compare the compiled rendering of row_ds with rendered.
+
+        Return whether they are equal, and remember it for the layout
+        version.
+        """
+        verified = renderer(row_ds) == rendered
+        COMPILED_ROWS.set(renderer.key, verified)
+        if not verified:
+            logger.warning("Compiled rendering of row layout %r differs from "
+                           "the generic one. Widget %r will not use it.",
+                           renderer.key[1], self.getWidgetId())
+        return verified
+
+    def markPhase(self, phase):
+        """Record the time spent since the last mark for phase.
+
+        Subclasses call this to refine timings within listRowDataStructures.
+        """
+        timer = self._v_phase_timer
+        if timer is not None:
+            timer.mark(phase)
+
+    def emitPhaseTimings(self):
+        """Log timings and put them in the Server-Timing header."""
+        timer = self._v_phase_timer
+        if timer is None:
+            return
+        self._v_phase_timer = None
+        request = getattr(self, 'REQUEST', None)
+        timer.emit(getattr(request, 'RESPONSE', None))
+
+    def recordObjectLoads(self, row_dms, zodb_loads):
+        """Record objects woken up by rows in LOAD_STATS and return figures.
+
+        Only datamodels that can avoid fetching objects (see BrainDataModel)
+        are examined. zodb_loads is the number of objects loaded from the
+        ZODB while listing and rendering rows, or None if unknown.
+        """
+        woken_rows = 0
+        fallback_keys = {}
+        for dm in row_dms:
+            getKeys = getattr(dm, 'getFallbackKeys', None)
+            if getKeys is None:
+                continue
+            if dm.isObjectLoaded():
+                woken_rows += 1
+            for key in getKeys():
+                fallback_keys[key] = fallback_keys.get(key, 0) + 1
+
+        widget = '/'.join(self.getPhysicalPath())
+        LOAD_STATS.record(widget, self.row_layout, rows=len(row_dms),
+                          woken_rows=woken_rows, fallback_keys=fallback_keys,
+                          zodb_loads=zodb_loads or 0)
+        if woken_rows:
+            logger.debug("%s: %d/%d rows woke objects up, because of %r, "
+                         "%s ZODB loads", widget, woken_rows, len(row_dms),
+                         fallback_keys, zodb_loads)
+        return {'rows': len(row_dms),
+                'woken_rows': woken_rows,
+                'fallback_keys': fallback_keys,
+                'zodb_loads': zodb_loads,
+                }
+
+    def getLastRenderLoads(self):
+        """Return object loads figures of the last rendering in this thread.
+
+        See recordObjectLoads for the format. Aggregated figures for all
+        renderings are available from the LOAD_STATS object.
+        """
+        return self._v_last_loads
+
     def listRowDataStructures(self, datastructure, layout, **kw):
         """Return items datastructures, prepared by layout
 
@@ -158,20 +419,25 @@ class TabularWidget(CPSIntFilterWidget):
         return datastructure.getDataModel().getContext()
 
     def setCookieFromMapping(self, request, mapping, path_method=False):
-        """Set a dict in cookie."""
+        """Set a dict in cookie.
+
+        Depending on the filter_state_store property, the dict is either
+        serialized in the cookie, or stored server side (see filterstate
+        module) and the cookie holds a token.
+        """
 
         if path_method:
             path = request['URLPATH0']
         else:
             path = request['URLPATH1']
 
-        # DateTime widget puts plenty info enough to rebuild the object
-        # We should not put them in filter and serialize more tightly, but this
-        # is good enough for now
-        to_cook = dict( (k,v) for (k,v) in mapping.items()
-                        if not isinstance(v, DateTime) )
-
-        cookie = serializeForCookie(to_cook, charset=self.default_charset)
+        to_cook = dict(mapping)
+        store = self.filter_state_store
+        if store in ('ram', 'persistent'):
+            cookie = FILTER_STATES.store(self, to_cook,
+                                         persistent=store == 'persistent')
+        else:
+            cookie = encodeCookie(to_cook, charset=self.default_charset)
         logger.debug("Setting cookie, path=%s, size=%d", path, len(cookie))
         request.RESPONSE.setCookie(self.cookie_id, cookie, path=path)
 
@@ -383,6 +649,8 @@ class TabularWidget(CPSIntFilterWidget):
         if calling_obj is None: # happens on creation
             return ''
 
+        self._v_phase_timer = PhaseTimer(self.getWidgetId())
+
         # GR tired of this duplication. refactor
         proxy = datastructure.get('context_obj') # if from portlet
         if proxy is None:
@@ -401,35 +669,70 @@ class TabularWidget(CPSIntFilterWidget):
             row_layout = getattr(ltool, lid)
             fti = FlexibleTypeInformation('transient')
 
+        self.markPhase('layout')
+
         # build filters and maybe set cookie
         filters = self.buildFilters(datastructure,
                                     cookie_path_method=mode=='search')
+        self.markPhase('buildFilters')
+
+        # read by prepareRowDataStructure
+        self._v_row_cache_context = self.getRowCacheContext(row_layout)
 
         # fetch prepared row datastructures
+        loads_before = getTransferCount(self)
         row_dss, current_page, nb_pages = self.listRowDataStructures(
             datastructure, row_layout, filters=filters, **kw)
+        # what subclasses did not account for by finer phases
+        self.markPhase('listRows')
 
         layout_structures = None
+        compiled = compiled_ok = None
 
         # rows rendering
         rendered_rows = []
+        row_dms = []
         meth_context = self.getMethodContext(datastructure)
         for row_ds in row_dss:
+            row_dm = row_ds.getDataModel()
+            row_dms.append(row_dm)
             # compute layout_structures if needed
             if layout_structures is None:
-                row_dm = row_ds.getDataModel()
                 layout_structures = [
                     row_layout.computeLayoutStructure('view', row_dm)]
-
-            # render from row_ds
-            rendered = fti._renderLayouts(layout_structures,
-                                          row_ds,
-                                          context=meth_context,
-                                          layout_mode='view',
-                                          )
+                compiled, compiled_ok = self.getCompiledRowRenderer(
+                    row_layout, layout_structures[0])
+
+            # render from row_ds, unless it's been found in cache
+            rendered = getattr(row_ds, DS_ROW_RENDERED, None)
+            if rendered is None:
+                if compiled_ok:
+                    rendered = compiled(row_ds)
+                else:
+                    rendered = fti._renderLayouts(layout_structures,
+                                                  row_ds,
+                                                  context=meth_context,
+                                                  layout_mode='view',
+                                                  )
+                    if compiled is not None:
+                        # first time for this layout version
+                        compiled_ok = self.recordCompiledRowVerdict(
+                            compiled, row_ds, rendered)
+                        if not compiled_ok:
+                            compiled = None
+                key = getattr(row_ds, DS_ROW_CACHE_KEY, None)
+                if key is not None:
+                    ROWS_CACHE.set(key, rendered)
             rendered_rows.append(rendered)
+        self.markPhase('rows')
+
+        zodb_loads = None
+        if loads_before is not None:
+            zodb_loads = getTransferCount(self) - loads_before
+        self._v_last_loads = self.recordObjectLoads(row_dms, zodb_loads)
 
         if not self.render_method: # default behaviour that can still be useful
+            self.emitPhaseTimings()
             return '\n'.join(rendered_rows)
 
         meth = getattr(meth_context, self.render_method, None)
@@ -468,16 +771,22 @@ class TabularWidget(CPSIntFilterWidget):
         css_class=self.getCssClass(
             kw.get('layout_mode', mode), datamodel) or None
 
-        return meth(tabular_widget=self, mode=mode, columns=columns,
-                    batch_perform_view_name=self.batch_perform_view_name,
-                    rows=rendered_rows, actions=actions,
-                    here_url=here_url, batching_info=batching_info,
-                    base_url=getToolByName(self, 'portal_url').getBaseUrl(),
-                    empty_message=self.empty_message,
-                    row_click = self.row_click or None,
-                    row_mouseover = self.row_mouseover or None,
-                    row_mouseout = self.row_mouseout or None,
-                    css_class=css_class)
+        base_url = getToolByName(self, 'portal_url').getBaseUrl()
+        self.markPhase('columns')
+
+        rendered = meth(tabular_widget=self, mode=mode, columns=columns,
+                        batch_perform_view_name=self.batch_perform_view_name,
+                        rows=rendered_rows, actions=actions,
+                        here_url=here_url, batching_info=batching_info,
+                        base_url=base_url,
+                        empty_message=self.empty_message,
+                        row_click = self.row_click or None,
+                        row_mouseover = self.row_mouseover or None,
+                        row_mouseout = self.row_mouseout or None,
+                        css_class=css_class)
+        self.markPhase('render_method')
+        self.emitPhaseTimings()
+        return rendered
 
     def table_layout_row_view(self, layout=None, **kw):
         """Render method for rows layouts in 'view' mode.